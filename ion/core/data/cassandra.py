@@ -39,6 +39,12 @@ CONF = ioninit.config(__name__)
 
 
 cassandra_timeout = CONF.getValue('CassandraTimeout',10.0)
+# Number of rows sent in a single batch_mutate and the number of batches which may be in flight at once
+cassandra_batch_size = CONF.getValue('CassandraBatchSize', 200)
+cassandra_batch_window = CONF.getValue('CassandraBatchWindow', 4)
+# Number of rows fetched by each get_indexed_slices call of a query
+cassandra_query_page_size = CONF.getValue('CassandraQueryPageSize', 100)
+
 class CassandraError(Exception):
     """
     An exception class for ION Cassandra Client errors
@@ -65,6 +71,10 @@ class CassandraStore(TCPConnection):
 
     implements(store.IStore)
 
+    # Class attributes - the bootstrap subclasses do not call this __init__
+    batch_size = cassandra_batch_size
+    batch_window = cassandra_batch_window
+
     def __init__(self, persistent_technology, persistent_archive, credentials, cache):
         """
         functional wrapper around active client instance
@@ -113,6 +123,28 @@ class CassandraStore(TCPConnection):
             value = None
         defer.returnValue(value)
 
+    @timeout(cassandra_timeout)
+    @defer.inlineCallbacks
+    def get_many(self, keys):
+        """
+        @brief Return the values corresponding to a list of keys using a single multiget
+        @param keys an iterable of keys
+        @retval Deferred that fires with a dictionary of key to value, None if the key is not found
+        """
+        keys = list(keys)
+        result = {}
+        if len(keys) == 0:
+            defer.returnValue(result)
+
+        rows = yield self.client.multiget(keys, self._cache_name, column='value')
+        for key in keys:
+            columns = rows.get(key)
+            if columns:
+                result[key] = columns[0].column.value
+            else:
+                result[key] = None
+        defer.returnValue(result)
+
     @timeout(cassandra_timeout)
     @defer.inlineCallbacks
     def put(self, key, value):
@@ -128,6 +160,49 @@ class CassandraStore(TCPConnection):
         columns = {"value": value, "has_key":"1"}
         yield self.client.batch_insert(key, self._cache_name, columns)
 
+    def put_many(self, items):
+        """
+        @brief Write many key/value pairs into cassandra using batch mutations
+        @param items a dictionary or an iterable of (key, value) pairs
+        @retval Deferred for success
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+
+        mutations = [(key, {"value": value, "has_key":"1"}) for key, value in items]
+        return self._put_mutations(mutations)
+
+    @timeout(cassandra_timeout)
+    def _batch_mutate(self, mutation_map):
+        """
+        @brief Send a single batch mutation - the timeout applies to each batch not the whole put
+        """
+        return self.client.batch_mutate(mutation_map)
+
+    def _put_mutations(self, mutations):
+        """
+        @brief Send a list of (key, columns) row mutations in batches of batch_size rows with at most
+        batch_window batches outstanding at any time.
+        @retval Deferred which fires when all of the batches are complete
+        """
+        if len(mutations) == 0:
+            return defer.succeed(None)
+
+        semaphore = defer.DeferredSemaphore(max(int(self.batch_window), 1))
+        batch_size = max(int(self.batch_size), 1)
+
+        def_list = []
+        for start in xrange(0, len(mutations), batch_size):
+            mutation_map = {}
+            for key, columns in mutations[start:start + batch_size]:
+                mutation_map[key] = {self._cache_name: columns}
+
+            def_list.append(semaphore.run(self._batch_mutate, mutation_map))
+
+        d = defer.DeferredList(def_list, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda results: None)
+        return d
+
     @timeout(cassandra_timeout)
     @defer.inlineCallbacks
     def has_key(self, key):
@@ -218,6 +293,33 @@ class CassandraIndexedStore(CassandraStore):
         
         yield self.client.batch_insert(key, self._cache_name, index_cols)
 
+    @defer.inlineCallbacks
+    def put_many(self, rows):
+        """
+        Put many rows using batch mutations.
+
+        @param rows an iterable of (key, value, index_attributes) tuples, index_attributes is optional
+        """
+        yield self._load_query_attribute_names()
+
+        mutations = []
+        for row in rows:
+            key, value = row[:2]
+            index_attributes = None
+            if len(row) > 2:
+                index_attributes = row[2]
+
+            if index_attributes is None:
+                index_cols = {}
+            else:
+                index_cols = dict(**index_attributes)
+
+            self._validate_index(index_cols)
+            index_cols.update({"value":value, "has_key":"1"})
+            mutations.append((key, index_cols))
+
+        yield self._put_mutations(mutations)
+
     @timeout(cassandra_timeout)
     @defer.inlineCallbacks
     def update_index(self, key, index_attributes):
@@ -243,12 +345,22 @@ class CassandraIndexedStore(CassandraStore):
         This method raises an IndexStoreError exception if the index_attribute dictionary has keys that 
         are not the names of the columns indexed. 
         """
-        #Get the set of indexes the first time this is called.
+        yield self._load_query_attribute_names()
+        self._validate_index(index_attributes)
+
+    @defer.inlineCallbacks
+    def _load_query_attribute_names(self):
+        """
+        Get the set of indexes the first time this is called.
+        """
         if self._query_attribute_names is None:
             query_attributes =  yield self.get_query_attributes()
             self._query_attribute_names = set(query_attributes)
 
-
+    def _validate_index(self, index_attributes):
+        """
+        Synchronous part of _check_index - the query attribute names must already be loaded.
+        """
         index_attribute_names = set(index_attributes.keys())
         
         if not index_attribute_names.issubset(self._query_attribute_names):
@@ -263,20 +375,38 @@ class CassandraIndexedStore(CassandraStore):
             raise IndexStoreError("Values for the indexed columns must be of type str.")
         
 
-    @timeout(cassandra_timeout)
     @defer.inlineCallbacks
-    def query(self, query_predicates, row_count=100):
+    def query(self, query_predicates, columns=None):
         """
         Search for rows in the Cassandra instance.
     
         @param indexed_attributes is a dictionary with column:value mappings.
         Rows are returned that have columns set to the value specified in 
         the dictionary
+        @param columns optional list of column names to return for each row, eg. only the index attributes
+        without the value.
         
-        @retVal a dictionary containing the keys and values which match the query.
+        @retVal a dictionary containing the keys and values which match the query. All of the matching rows are
+        returned, fetched in pages of cassandra_query_page_size rows.
         
         raises a CassandraError if the query_predicate object is malformed.
         """
+        result = {}
+        start_key = ''
+        while start_key is not None:
+            rows, start_key = yield self.query_page(query_predicates, start_key=start_key,
+                                                    page_size=cassandra_query_page_size, columns=columns)
+            result.update(rows)
+
+        defer.returnValue(result)
+
+    @timeout(cassandra_timeout)
+    @defer.inlineCallbacks
+    def query_page(self, query_predicates, start_key='', page_size=cassandra_query_page_size, columns=None):
+        """
+        @see IIndexStore.query_page
+        Rows are in the order of the partitioner, the start_key of the next page is only meaningful to this store.
+        """
         #log.info('Query against cache: %s' % self._cache_name)
         predicates = query_predicates.get_predicates()
         def fix_preds(query_tuple):
@@ -290,9 +420,16 @@ class CassandraIndexedStore(CassandraStore):
             return IndexExpression(**args)
         selection_predicates = map(fix_preds, predicates)
         #log.debug("Calling get_indexed_slices selection_predicate %s " % (selection_predicates,))
-        
-        rows = yield self.client.get_indexed_slices(self._cache_name, selection_predicates, count=row_count)
+
+        # Ask for one extra row - the start key of the next page, since get_indexed_slices includes the start key
+        rows = yield self.client.get_indexed_slices(self._cache_name, selection_predicates, names=columns,
+                                                    start_key=start_key, count=page_size + 1)
         #log.info("Got rows back")
+        next_key = None
+        if len(rows) > page_size:
+            next_key = rows[page_size].key
+            rows = rows[:page_size]
+
         result ={}
         for row in rows:
             row_vals = {}
@@ -300,7 +437,13 @@ class CassandraIndexedStore(CassandraStore):
                 row_vals[column.column.name] = column.column.value
             result[row.key] = row_vals
 
-        defer.returnValue(result)
+        defer.returnValue((result, next_key))
+
+    def query_cursor(self, query_predicates, page_size=cassandra_query_page_size, columns=None):
+        """
+        @see IIndexStore.query_cursor
+        """
+        return store.QueryCursor(self, query_predicates, page_size, columns)
         
     @timeout(cassandra_timeout)
     @defer.inlineCallbacks
@@ -399,15 +399,15 @@ class CassandraQueryBenchmarks(CassandraPerformanceTester):
         dl = []
         t1 = time.time()
         for i in range(50):
-            query_def =  self.store.query(q,row_count=1000)
+            query_def =  self.store.query_page(q, page_size=1000)
             dl.append(query_def)
         yield defer.DeferredList(dl)    
         t2 = time.time()
         diff = t2 - t1
-        rows = dl[0]
-        #print len(rows.result)
+        rows, next_key = dl[0].result
+        #print len(rows)
         #print diff
-        print "Returns %s_rows in %s query %s " % (len(rows.result), diff, pred_type)
+        print "Returns %s_rows in %s query %s " % (len(rows), diff, pred_type)
             
     
     @defer.inlineCallbacks
@@ -112,9 +112,11 @@ class IndexStoreService(ServiceProcess):
             r.key = key
 
 
-            r.value = row.pop('value')
+            r.value = row['value']
 
             for name, val in row.items():
+                if name == 'value':
+                    continue
                 col = r.cols.add()
                 col.column_name = name
                 col.column_value = val
@@ -275,6 +277,15 @@ class IndexStoreServiceClient(ServiceClient):
 
         defer.returnValue(content)
 
+    @defer.inlineCallbacks
+    def put_many(self, rows):
+        """
+        The service has no batch put operation - issue the puts concurrently.
+        """
+        log.info("Called Index Store Service client: put_many")
+
+        yield defer.DeferredList([self.put(*row) for row in rows], fireOnOneErrback=True, consumeErrors=True)
+
     @defer.inlineCallbacks
     def update_index(self, key, index_attributes):
         """
@@ -313,6 +324,17 @@ class IndexStoreServiceClient(ServiceClient):
         else:
             defer.returnValue(None)
         
+    @defer.inlineCallbacks
+    def get_many(self, keys):
+        """
+        The service has no multi get operation - issue the gets concurrently.
+        """
+        log.info("Called Index Store Service client: get_many")
+        keys = list(keys)
+        results = yield defer.DeferredList([self.get(key) for key in keys], fireOnOneErrback=True, consumeErrors=True)
+
+        defer.returnValue(dict((key, value) for key, (success, value) in zip(keys, results)))
+
     @defer.inlineCallbacks
     def remove(self, key):
         log.info("Called Index Store Service client: remove")
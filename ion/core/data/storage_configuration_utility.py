@@ -52,6 +52,14 @@ COMMIT_INDEXED_COLUMNS=[REPOSITORY_KEY, BRANCH_NAME, SUBJECT_KEY, SUBJECT_BRANCH
                      PREDICATE_BRANCH, PREDICATE_COMMIT, OBJECT_KEY, OBJECT_BRANCH, OBJECT_COMMIT, KEYWORD, RESOURCE_LIFE_CYCLE_STATE, RESOURCE_OBJECT_TYPE]
 
 
+### IDENTITY SUBJECT INDEX SETUP
+IDENTITY_CACHE = 'identities'
+
+IDENTITY = 'identity'
+
+IDENTITY_INDEXED_COLUMNS=[IDENTITY]
+
+
 # Common Columns:
 VALUE = 'value'
 
@@ -99,6 +107,17 @@ blob_cf = base_cf_def.copy()
 blob_cf['name']=BLOB_CACHE
 # No columns to declare for indexing
 
+identity_cols = []
+for col_name in IDENTITY_INDEXED_COLUMNS:
+    col_def = base_col_def.copy()
+    col_def['name']=col_name
+    col_def['index_type']=IndexType.KEYS
+    identity_cols.append(col_def)
+
+identity_cf = base_cf_def.copy()
+identity_cf['name']=IDENTITY_CACHE
+identity_cf['column_metadata'] = identity_cols
+
 ### Storage Keyspace Name is provided by the sysname!!!
 #ion_ks = base_ks_def.copy()
 #ion_ks['cf_defs'] = [blob_cf, commit_cf]
@@ -130,6 +149,7 @@ def get_cassandra_configuration(sysname=None):
     """
     my_blob_cf = blob_cf.copy()
     my_commit_cf = commit_cf.copy()
+    my_identity_cf = identity_cf.copy()
 
     ion_ks = base_ks_def.copy()
 
@@ -159,11 +179,11 @@ def get_cassandra_configuration(sysname=None):
         else:
             ion_ks[k]=v
 
-    # The blob cache and the commit cache are not configurable in this object!
+    # The blob cache, the commit cache and the identity cache are not configurable in this object!
     if ion_ks['cf_defs'] is None:
         ion_ks['cf_defs'] =[]
 
-    ion_ks['cf_defs'].extend( [my_blob_cf, my_commit_cf])
+    ion_ks['cf_defs'].extend( [my_blob_cf, my_commit_cf, my_identity_cf])
 
     # update the sysname
     sysname = sysname or ioninit.sys_name
@@ -176,6 +196,7 @@ def get_cassandra_configuration(sysname=None):
     ion_ks['name'] = sysname
     my_blob_cf['keyspace'] = sysname
     my_commit_cf['keyspace'] = sysname
+    my_identity_cf['keyspace'] = sysname
 
     return confdict
 
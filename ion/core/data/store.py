@@ -9,6 +9,7 @@
         in memory implementation
 """
 import os
+import bisect
 from zope.interface import Interface
 from zope.interface import implements
 
@@ -18,6 +19,8 @@ from twisted.internet import defer
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+# The default number of rows in a page of a paged query
+QUERY_PAGE_SIZE = 100
 
 
 class IStore(Interface):
@@ -34,6 +37,12 @@ class IStore(Interface):
         @retval Deferred, for value associated with key, or None if not existing.
         """
 
+    def get_many(keys):
+        """
+        @param keys  an iterable of immutable keys
+        @retval Deferred, for a dictionary mapping each key to its value, or None if not existing.
+        """
+
     def put(key, value):
         """
         @param key  an immutable key to be associated with a value
@@ -42,6 +51,12 @@ class IStore(Interface):
         @retval Deferred, for success of this operation
         """
 
+    def put_many(items):
+        """
+        @param items  a dictionary or an iterable of (key, value) pairs to put
+        @retval Deferred, for success of this operation
+        """
+
     def remove(key):
         """
         @param key  an immutable key associated with a value
@@ -68,12 +83,25 @@ class Store(object):
         """
         return defer.maybeDeferred(self.kvs.get, key, None)
 
+    def get_many(self, keys):
+        """
+        @see IStore.get_many
+        """
+        kvs = self.kvs
+        return defer.succeed(dict((key, kvs.get(key, None)) for key in keys))
+
     def put(self, key, value):
         """
         @see IStore.put
         """
         return defer.maybeDeferred(self.kvs.update, {key:value})
 
+    def put_many(self, items):
+        """
+        @see IStore.put_many
+        """
+        return defer.maybeDeferred(self.kvs.update, items)
+
     def remove(self, key):
         """
         @see IStore.remove
@@ -107,6 +135,12 @@ class IIndexStore(IStore):
         @retval Deferred, for value associated with key, or None if not existing.
         """
 
+    def get_many(keys):
+        """
+        @param keys  an iterable of immutable keys
+        @retval Deferred, for a dictionary mapping each key to its value, or None if not existing.
+        """
+
     def put(key, value, index_attributes=None):
         """
         @param key  an immutable key to be associated with a value
@@ -115,6 +149,13 @@ class IIndexStore(IStore):
         @param index_attributes a dictionary of attributes by which to index this value of this key
         @retval Deferred, for success of this operation
         """
+
+    def put_many(rows):
+        """
+        @param rows  an iterable of (key, value, index_attributes) tuples to put. As in put,
+                index_attributes is optional: (key, value) pairs are also accepted.
+        @retval Deferred, for success of this operation
+        """
     
     def remove(key):
         """
@@ -123,12 +164,33 @@ class IIndexStore(IStore):
      
         """
         
-    def query(query_predicates):
+    def query(query_predicates, columns=None):
         """
         Search for rows in the Cassandra instance.
         @param query_predicates is a store.Query object
+        @param columns optional list of column names to return for each row, eg. only the index attributes without
+        the value. All columns are returned by default.
         @retVal a thrift representation of the rows returned by the query.
         """
+
+    def query_page(query_predicates, start_key='', page_size=QUERY_PAGE_SIZE, columns=None):
+        """
+        Search for one page of the rows matching a query, in key order.
+        @param query_predicates is a store.Query object
+        @param start_key the key of the first row of the page, '' for the first page
+        @param page_size the maximum number of rows in the page
+        @param columns optional list of column names to return for each row
+        @retVal Deferred, for a tuple of the dictionary of rows in the page and the start_key of the next page, or
+        None if this is the last page.
+        """
+
+    def query_cursor(query_predicates, page_size=QUERY_PAGE_SIZE, columns=None):
+        """
+        @param query_predicates is a store.Query object
+        @param page_size the maximum number of rows in each page
+        @param columns optional list of column names to return for each row
+        @retVal a QueryCursor over the pages of rows matching the query
+        """
         
     def update_index(key, index_attributes):
         """
@@ -153,6 +215,133 @@ class IndexStoreError(Exception):
     An exception class for the index store
     """
 
+
+class QueryCursor(object):
+    """
+    Iterates over the rows matching a query one page at a time, so that a large result is never held in memory
+    at once. Each page is a dictionary of rows as returned by IIndexStore.query. Use next() until it returns None:
+
+        cursor = index_store.query_cursor(q, page_size=50)
+        while True:
+            rows = yield cursor.next()
+            if rows is None:
+                break
+
+    Or iterate over the cursor, waiting for each page before asking for the next:
+
+        for d in index_store.query_cursor(q):
+            rows = yield d
+    """
+
+    def __init__(self, index_store, query_predicates, page_size=None, columns=None):
+        """
+        @param index_store an IIndexStore implementation providing query_page
+        @param query_predicates is a store.Query object
+        @param page_size the maximum number of rows in each page
+        @param columns optional list of column names to return for each row
+        """
+        self.index_store = index_store
+        self.query_predicates = query_predicates
+        self.page_size = page_size or QUERY_PAGE_SIZE
+        self.columns = columns
+
+        self.start_key = ''
+        self.done = False
+        self.pages = 0
+        self.rows = 0
+
+    def next(self):
+        """
+        @retVal Deferred, for the dictionary of rows in the next page, or None when there are no more pages.
+        """
+        if self.done:
+            return defer.succeed(None)
+
+        d = self.index_store.query_page(self.query_predicates, start_key=self.start_key, page_size=self.page_size,
+                                        columns=self.columns)
+        d.addCallback(self._got_page)
+        return d
+
+    def _got_page(self, result):
+        rows, next_key = result
+        if next_key is None:
+            self.done = True
+        else:
+            self.start_key = next_key
+
+        if not rows and self.done:
+            return None
+
+        self.pages += 1
+        self.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        while not self.done:
+            yield self.next()
+
+
+def project_row(row, columns):
+    """
+    Returns the columns of a row which are in columns. A row is returned as is when columns is None.
+    """
+    if columns is None:
+        return row
+    return dict((name, row[name]) for name in columns if name in row)
+
+_EMPTY_SET = frozenset()
+
+class AttributeIndex(dict):
+    """
+    The index for one attribute of the IndexStore - a dictionary of attribute value to the set of row keys with
+    that value. The distinct values are also kept in a sorted list so that range predicates are answered with a
+    binary search instead of a scan of every value.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.sorted_values = []
+
+    def add_key(self, value, key):
+        keys = self.get(value)
+        if keys is None:
+            keys = set()
+            self[value] = keys
+            bisect.insort(self.sorted_values, value)
+        keys.add(key)
+
+    def discard_key(self, value, key):
+        keys = self.get(value)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del self[value]
+            del self.sorted_values[bisect.bisect_left(self.sorted_values, value)]
+
+    def count_keys_greater_than(self, value, limit):
+        """
+        The number of row keys which have a value greater than value - counting stops once limit is exceeded
+        """
+        values = self.sorted_values
+        count = 0
+        for i in xrange(bisect.bisect_right(values, value), len(values)):
+            count += len(self[values[i]])
+            if count > limit:
+                break
+        return count
+
+    def keys_greater_than(self, value):
+        """
+        The set of row keys which have a value greater than value
+        """
+        values = self.sorted_values
+        matches = set()
+        for i in xrange(bisect.bisect_right(values, value), len(values)):
+            matches.update(self[values[i]])
+        return matches
+
+
 class IndexStore(object):
     """
     Memory implementation of an asynchronous key/value store, using a dict.
@@ -170,6 +359,7 @@ class IndexStore(object):
     
     self.indices is an index to map attribute names to attribute values to keys
         {attr_names:{attr_value: set( keys)}}.
+    Each attribute index is an AttributeIndex which also keeps its values sorted for range queries.
     """
     implements(IIndexStore)
 
@@ -183,7 +373,7 @@ class IndexStore(object):
         if kwargs.has_key('indices'):
             for name in kwargs.get('indices'):
                 if not self.indices.has_key(name):
-                    self.indices[name]={}
+                    self.indices[name]=AttributeIndex()
 
     def get(self, key):
         """
@@ -195,6 +385,19 @@ class IndexStore(object):
         else:
             return defer.maybeDeferred(row.get, "value")
 
+    def get_many(self, keys):
+        """
+        @see IStore.get_many
+        """
+        result = {}
+        for key in keys:
+            row = self.kvs.get(key, None)
+            if row is None:
+                result[key] = None
+            else:
+                result[key] = row.get("value")
+        return defer.succeed(result)
+
     def put(self, key, value, index_attributes=None):
         """
         @see IStore.put
@@ -204,73 +407,135 @@ class IndexStore(object):
         if index_attributes is None:
             index_attributes = {}
             
-        self._update_index(key, index_attributes)
+        self._update_index(key, index_attributes, replace=True)
                         
         return defer.maybeDeferred(self.kvs.update, {key: dict({"value":value},**index_attributes)})        
+
+    def put_many(self, rows):
+        """
+        @see IIndexStore.put_many
+        Raises an exception if any of the index_attibutes contain attributes that are not indexed
+        by the underlying store.
+        """
+        def put_rows():
+            for row in rows:
+                self.put(*row)
+
+        return defer.maybeDeferred(put_rows)
     
     def remove(self, key):
         """
         @see IStore.remove
         """
         # could test for existence of key. this will error otherwise
-        if self.kvs.has_key(key):
-            del self.kvs[key]            
+        row = self.kvs.pop(key, None)
+        if row is not None:
+            for k, v in row.iteritems():
+                kindex = self.indices.get(k, None)
+                if kindex is not None:
+                    kindex.discard_key(v, key)
         return defer.succeed(None)
         
-    def query(self, query_predicates):
+    def query(self, query_predicates, columns=None):
         """
         Search for rows in the Cassandra instance.
     
         @param indexed_attributes is a dictionary with column:value mappings.
         Rows are returned that have columns set to the value specified in 
         the dictionary
+        @param columns optional list of column names to return for each row
         
         @retVal A data structure representing Cassandra rows. See the class
-        docstring for the description of the data structure.
+        docstring for the description of the data structure. The row dictionaries
+        are returned by reference - the caller must not modify them.
+        """
+        log.debug("In query: predicates %s", query_predicates)
+
+        result = {}
+        for k in self._query_keys(query_predicates):
+            row = self.kvs.get(k)
+            if row is not None:
+                result[k] = project_row(row, columns)
+
+        log.debug("Query Results: %d rows", len(result))
+
+        return defer.succeed(result)
+
+    def query_page(self, query_predicates, start_key='', page_size=QUERY_PAGE_SIZE, columns=None):
+        """
+        @see IIndexStore.query_page
+        """
+        keys = sorted(key for key in self._query_keys(query_predicates) if key in self.kvs)
+
+        first = bisect.bisect_left(keys, start_key)
+        page_keys = keys[first:first + page_size]
+
+        next_key = None
+        if first + page_size < len(keys):
+            next_key = keys[first + page_size]
+
+        rows = dict((k, project_row(self.kvs[k], columns)) for k in page_keys)
+        return defer.succeed((rows, next_key))
+
+    def query_cursor(self, query_predicates, page_size=QUERY_PAGE_SIZE, columns=None):
+        """
+        @see IIndexStore.query_cursor
+        """
+        return QueryCursor(self, query_predicates, page_size, columns)
+
+    def _query_keys(self, query_predicates):
+        """
+        The set of row keys which match the query predicates, from the attribute indices.
         """
-        log.debug("In query: predicates %s" % query_predicates)
 
         predicates = query_predicates.get_predicates()
 
-        eq_filter = lambda x: x[2] == Query.EQ
-        preds_eq = filter(eq_filter, predicates)
-        keys = set()
+        preds_eq = [pred for pred in predicates if pred[2] == Query.EQ]
+        preds_gt = [pred for pred in predicates if pred[2] == Query.GT]
         if len(preds_eq) == 0:
             raise IndexStoreError('Invalid arguments to IndexStore - must provide at least one equal to operator for search!')
-        else:
-            k,v,pred = preds_eq.pop()
+
+        # Intersect the equality matches starting from the most selective (smallest) set
+        eq_sets = []
+        for k,v,p in preds_eq:
             kindex = self.indices.get(k, None)
-            if kindex:
-                keys.update(kindex.get(v,set()))
-
-        for k,v,p in predicates:
-
-            kindex = self.indices.get(k,None)
-            if p == Query.EQ:
-                
-                if kindex:
-                    keys.intersection_update(kindex.get(v,set()))
-            elif p == Query.GT:
-                
-                matches = set()
-                for attr_val in kindex.keys():
-                    if attr_val > v:
-                        matches.update(kindex.get(attr_val,set()))
-                keys.intersection_update(matches)
-
-        #log.debug("keys: "+ str(keys))
-        result = {}
-        for k in keys:
-            # This is stupid, but now remove effectively works - delete keys are no longer visible!
-            if self.kvs.has_key(k):
-                result[k] = self.kvs.get(k).copy()
+            if kindex is None:
+                eq_sets.append(_EMPTY_SET)
+            else:
+                eq_sets.append(kindex.get(v, _EMPTY_SET))
+        eq_sets.sort(key=len)
+
+        keys = set(eq_sets[0])
+        for key_set in eq_sets[1:]:
+            if not keys:
+                break
+            keys.intersection_update(key_set)
+
+        # Apply the range predicates - either check each remaining candidate row or intersect with the union of
+        # the matching values from the sorted index, whichever touches fewer entries.
+        for k,v,p in preds_gt:
+            if not keys:
+                break
 
-        log.debug("Query Results: %s" % result)
+            kindex = self.indices.get(k, None)
+            if kindex is None:
+                keys.clear()
+                break
 
-        return defer.succeed(result)                
+            if len(keys) <= kindex.count_keys_greater_than(v, len(keys)):
+                keys = set(key for key in keys if key in self.kvs and self.kvs[key].get(k, v) > v)
+            else:
+                keys.intersection_update(kindex.keys_greater_than(v))
+
+        return keys
     
-    def _update_index(self, key, index_attributes):
-        log.debug("In _update_index: key %s index_attributes %s" % (key,index_attributes))
+    def _update_index(self, key, index_attributes, replace=False):
+        """
+        Update the attribute indices for a row.
+        @param replace if True all of the current attributes of the row are removed from the index, otherwise only
+        those which are being updated.
+        """
+        log.debug("In _update_index: key %s index_attributes %s", key, index_attributes)
         #Ensure that we are updating attributes that are indexed.
         query_attribute_names = set(self.indices.keys())
         index_attribute_names = set(index_attributes.keys())
@@ -282,26 +547,18 @@ class IndexStore(object):
         current_attrs = self.kvs.get(key)
         if current_attrs is not None:
 
-            changed_attrs = {}
-            for k in index_attributes.keys():
-                if current_attrs.has_key(k):
-                    changed_attrs[k] = current_attrs.get(k)
+            if replace:
+                changed_attrs = current_attrs
+            else:
+                changed_attrs = index_attributes
 
-
-            for k,v in changed_attrs.items():
+            for k in changed_attrs.keys():
                 kindex = self.indices.get(k)
-                # Create a set of keys if it does not already exist
-                kindex[v].discard(key)
-
+                if kindex is not None and current_attrs.has_key(k):
+                    kindex.discard_key(current_attrs[k], key)
 
         for k, v in index_attributes.items():
-            kindex = self.indices.get(k, None)
-            #if not kindex:
-            #    kindex = {}
-            #    self.indices[k] = kindex
-            # Create a set of keys if it does not already exist
-            kindex[v] = kindex.get(v, set())
-            kindex[v].add(key)
+            self.indices[k].add_key(v, key)
     
 
     def update_index(self, key, index_attributes):
@@ -175,6 +175,17 @@ class StoreServiceClient(ServiceClient):
 
         defer.returnValue(content)
 
+    @defer.inlineCallbacks
+    def put_many(self, items):
+        """
+        The service has no batch put operation - issue the puts concurrently.
+        """
+        log.info("Called Store Service client: put_many")
+        if isinstance(items, dict):
+            items = items.iteritems()
+
+        yield defer.DeferredList([self.put(key, value) for key, value in items], fireOnOneErrback=True, consumeErrors=True)
+
 
     @defer.inlineCallbacks
     def get(self, key):
@@ -189,6 +200,17 @@ class StoreServiceClient(ServiceClient):
         else:
             defer.returnValue(None)
         
+    @defer.inlineCallbacks
+    def get_many(self, keys):
+        """
+        The service has no multi get operation - issue the gets concurrently.
+        """
+        log.info("Called Store Service client: get_many")
+        keys = list(keys)
+        results = yield defer.DeferredList([self.get(key) for key in keys], fireOnOneErrback=True, consumeErrors=True)
+
+        defer.returnValue(dict((key, value) for key, (success, value) in zip(keys, results)))
+
     @defer.inlineCallbacks
     def remove(self, key):
         log.info("Called Store Service client: remove")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/data/test/benchmark_store.py
+@test Micro-benchmark of the sorted IndexStore query against the original scanning query. Not part of the unit
+tests, run it with trial ion.core.data.test.benchmark_store
+"""
+
+import time
+
+from twisted.trial import unittest
+
+from ion.core.data import store
+from ion.core.data.store import Query
+from ion.core.data.test.test_store import scan_query
+
+
+class IndexStoreQueryBenchmark(unittest.TestCase):
+
+    columns = ['repository_key', 'branch_name', 'lcs']
+
+    def setUp(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+        self.ds = store.IndexStore(indices=self.columns)
+
+        self.nrepos = 1000
+        for i in xrange(20000):
+            attrs = {'repository_key':'repo_%d' % (i % self.nrepos),
+                     'branch_name':['', 'master', 'branch_%d' % i][i % 3],
+                     'lcs':str(i % 10)}
+            self.ds.put('key_%d' % i, 'value', attrs)
+
+    def tearDown(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+    def _time_queries(self, query_func, queries):
+        tzero = time.time()
+        results = [query_func(q) for q in queries]
+        return time.time() - tzero, results
+
+    def test_query_performance(self):
+
+        queries = []
+        for i in xrange(200):
+            q = Query()
+            q.add_predicate_eq('repository_key', 'repo_%d' % (i % self.nrepos))
+            q.add_predicate_gt('branch_name', '')
+            if i % 2:
+                q.add_predicate_gt('lcs', '4')
+            queries.append(q)
+
+        def sync_query(q):
+            result = []
+            self.ds.query(q).addCallback(result.append)
+            return result[0]
+
+        new_time, new_results = self._time_queries(sync_query, queries)
+        old_time, old_results = self._time_queries(lambda q: scan_query(self.ds, q), queries)
+
+        self.assertEqual(new_results, old_results)
+
+        print('IndexStore query: %f elapsed, scanning query: %f elapsed, %d queries' % (new_time, old_time, len(queries)))
@@ -95,6 +95,33 @@ class IStoreTest(unittest.TestCase):
         defer.returnValue(None)
 
 
+    @defer.inlineCallbacks
+    def test_get_many(self):
+        key2 = object_utils.sha1bin(str(uuid4()))
+        value2 = object_utils.sha1bin(str(uuid4()))
+        missing = object_utils.sha1bin(str(uuid4()))
+
+        yield self.ds.put(self.key, self.value)
+        yield self.ds.put(key2, value2)
+
+        result = yield self.ds.get_many([self.key, key2, missing])
+        self.assertEqual(result, {self.key:self.value, key2:value2, missing:None})
+
+        result = yield self.ds.get_many([])
+        self.assertEqual(result, {})
+
+    @defer.inlineCallbacks
+    def test_put_many(self):
+        key2 = object_utils.sha1bin(str(uuid4()))
+        value2 = object_utils.sha1bin(str(uuid4()))
+
+        yield self.ds.put_many([(self.key, self.value), (key2, value2)])
+
+        b = yield self.ds.get(self.key)
+        self.failUnlessEqual(self.value, b)
+        b = yield self.ds.get(key2)
+        self.failUnlessEqual(value2, b)
+
     @defer.inlineCallbacks
     def test_has_key(self):
         yield self.ds.put(self.key, self.value)
@@ -206,6 +233,21 @@ class IndexStoreTest(IStoreTest):
             self.assertIn(key, rows['prothfuss'])
 
         defer.returnValue(None)
+    @defer.inlineCallbacks
+    def test_query_then_get(self):
+
+        query = Query()
+        query.add_predicate_eq('birth_date', '1973')
+        rows = yield self.ds.query(query)
+        self.assertEqual(rows['prothfuss']['value'], self.binary_value2)
+
+        # Querying must not change the stored row
+        value = yield self.ds.get('prothfuss')
+        self.assertEqual(value, self.binary_value2)
+
+        rows = yield self.ds.query(query)
+        self.assertEqual(rows['prothfuss']['value'], self.binary_value2)
+
     # Test a single query, multiple result
     @defer.inlineCallbacks
     def test_query_single_2(self):
@@ -340,6 +382,22 @@ class IndexStoreTest(IStoreTest):
 
 
 
+    @defer.inlineCallbacks
+    def test_put_many_indexed(self):
+
+        d5 = {'full_name':'Terry Pratchett', 'birth_date': '1948', 'state':'UK'}
+        d6 = {'full_name':'Neil Gaiman', 'birth_date': '1960', 'state':'UK'}
+
+        yield self.ds.put_many([('tpratchett', 'BinaryValue for Terry Pratchett', d5),
+                                ('ngaiman', 'BinaryValue for Neil Gaiman', d6)])
+
+        query = Query()
+        query.add_predicate_eq('state', 'UK')
+        rows = yield self.ds.query(query)
+        self.assertEqual(len(rows),2)
+        self.assertEqual(rows['tpratchett']['value'], 'BinaryValue for Terry Pratchett')
+        self.assertEqual(rows['ngaiman']['birth_date'], '1960')
+
     @defer.inlineCallbacks
     def test_update_index_blank(self):
 
@@ -394,6 +452,156 @@ class IndexStoreTest(IStoreTest):
 
 
 
+def scan_query(index_store, query_predicates):
+    """
+    The original IndexStore query which scans every value in the attribute index for a GT predicate and copies
+    each row. Used as the reference for the query benchmark.
+    """
+    predicates = query_predicates.get_predicates()
+
+    keys = set()
+    preds_eq = filter(lambda x: x[2] == Query.EQ, predicates)
+    k,v,pred = preds_eq.pop()
+    kindex = index_store.indices.get(k, None)
+    if kindex:
+        keys.update(kindex.get(v,set()))
+
+    for k,v,p in predicates:
+        kindex = index_store.indices.get(k,None)
+        if p == Query.EQ:
+            if kindex:
+                keys.intersection_update(kindex.get(v,set()))
+        elif p == Query.GT:
+            matches = set()
+            for attr_val in kindex.keys():
+                if attr_val > v:
+                    matches.update(kindex.get(attr_val,set()))
+            keys.intersection_update(matches)
+
+    result = {}
+    for k in keys:
+        if index_store.kvs.has_key(k):
+            result[k] = index_store.kvs.get(k).copy()
+    return result
+
+
+class IndexStoreSortedQueryTest(unittest.TestCase):
+    """
+    The sorted index query must return the same rows as the original scanning query.
+    @see benchmark_store for the timing comparison
+    """
+
+    columns = ['repository_key', 'branch_name', 'lcs']
+
+    def setUp(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+        self.ds = store.IndexStore(indices=self.columns)
+
+        self.nrepos = 100
+        for i in xrange(2000):
+            attrs = {'repository_key':'repo_%d' % (i % self.nrepos),
+                     'branch_name':['', 'master', 'branch_%d' % i][i % 3],
+                     'lcs':str(i % 10)}
+            self.ds.put('key_%d' % i, 'value', attrs)
+
+    def tearDown(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+    @defer.inlineCallbacks
+    def test_query_matches_scan(self):
+
+        for i in xrange(self.nrepos):
+            q = Query()
+            q.add_predicate_eq('repository_key', 'repo_%d' % i)
+            q.add_predicate_gt('branch_name', '')
+            if i % 2:
+                q.add_predicate_gt('lcs', '4')
+
+            rows = yield self.ds.query(q)
+            self.assertEqual(rows, scan_query(self.ds, q))
+
+
+class IndexStorePagedQueryTest(unittest.TestCase):
+
+    columns = ['state', 'birth_date']
+
+    def setUp(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+        self.ds = store.IndexStore(indices=self.columns)
+        for i in xrange(25):
+            self.ds.put('key_%02d' % i, 'value %d' % i, {'state':['UT', 'WI'][i % 2], 'birth_date':str(1950 + i)})
+
+        self.query = Query()
+        self.query.add_predicate_eq('state', 'UT')
+
+    def tearDown(self):
+        store.IndexStore.kvs.clear()
+        store.IndexStore.indices.clear()
+
+    @defer.inlineCallbacks
+    def test_query_page(self):
+        rows, next_key = yield self.ds.query_page(self.query, page_size=5)
+        self.assertEqual(sorted(rows.keys()), ['key_00', 'key_02', 'key_04', 'key_06', 'key_08'])
+        self.assertEqual(next_key, 'key_10')
+
+        rows, next_key = yield self.ds.query_page(self.query, start_key=next_key, page_size=5)
+        self.assertEqual(sorted(rows.keys()), ['key_10', 'key_12', 'key_14', 'key_16', 'key_18'])
+
+        rows, next_key = yield self.ds.query_page(self.query, start_key=next_key, page_size=5)
+        self.assertEqual(sorted(rows.keys()), ['key_20', 'key_22', 'key_24'])
+        self.assertEqual(next_key, None)
+
+    @defer.inlineCallbacks
+    def test_query_cursor(self):
+        all_rows = yield self.ds.query(self.query)
+
+        cursor = self.ds.query_cursor(self.query, page_size=4)
+        paged_rows = {}
+        for d in cursor:
+            rows = yield d
+            self.assertTrue(len(rows) <= 4)
+            paged_rows.update(rows)
+
+        self.assertEqual(paged_rows, all_rows)
+        self.assertEqual(cursor.pages, 4)
+        self.assertEqual(cursor.rows, 13)
+
+        rows = yield cursor.next()
+        self.assertEqual(rows, None)
+
+    @defer.inlineCallbacks
+    def test_query_cursor_exact_pages(self):
+        cursor = self.ds.query_cursor(self.query, page_size=13)
+        rows = yield cursor.next()
+        self.assertEqual(len(rows), 13)
+        rows = yield cursor.next()
+        self.assertEqual(rows, None)
+
+        q = Query()
+        q.add_predicate_eq('state', 'CA')
+        cursor = self.ds.query_cursor(q)
+        rows = yield cursor.next()
+        self.assertEqual(rows, None)
+
+    @defer.inlineCallbacks
+    def test_query_columns(self):
+        rows = yield self.ds.query(self.query, columns=['birth_date'])
+        self.assertEqual(len(rows), 13)
+        self.assertEqual(rows['key_02'], {'birth_date':'1952'})
+
+        rows, next_key = yield self.ds.query_page(self.query, page_size=2, columns=['state', 'birth_date'])
+        self.assertEqual(rows['key_00'], {'state':'UT', 'birth_date':'1950'})
+
+        # the rows themselves are not modified by the projection
+        value = yield self.ds.get('key_00')
+        self.assertEqual(value, 'value 0')
+
+
 class IndexStoreServiceTest(IndexStoreTest, IonTestCase):
 
 
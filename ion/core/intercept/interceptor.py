@@ -25,6 +25,13 @@ class Interceptor(ContainerProcess):
     """
     Interceptor that processes messages as the come along and passes them on.
     """
+    def is_active(self, path):
+        """
+        @param path Invocation.PATH_IN or Invocation.PATH_OUT
+        @retval False if the interceptor does nothing on the given path except
+            invocation.proceed(), so the interceptor system can leave it out
+        """
+        return True
 
 class EnvelopeInterceptor(Interceptor):
     """
@@ -36,12 +43,12 @@ class EnvelopeInterceptor(Interceptor):
     def process(self, invocation):
         """
         @param invocation container object for parameters
-        @retval invocation instance, may be modified
+        @retval invocation instance, may be modified, or a Deferred for it
         """
         if invocation.path == Invocation.PATH_IN:
-            return defer.maybeDeferred(self.before, invocation)
+            return self.before(invocation)
         elif invocation.path == Invocation.PATH_OUT:
-            return defer.maybeDeferred(self.after, invocation)
+            return self.after(invocation)
         else:
             raise ConfigurationError("Illegal EnvelopeInterceptor path: %s" % invocation.path)
 
@@ -52,8 +59,11 @@ class EnvelopeInterceptor(Interceptor):
 
 class PassThroughInterceptor(EnvelopeInterceptor):
     """
-    Interceptor that drops messages.
+    Interceptor that passes messages on.
     """
+    def is_active(self, path):
+        return False
+
     def before(self, invocation):
         invocation.proceed()
         return invocation
@@ -6,6 +6,7 @@
 @brief Process Manager for capability container
 """
 
+import time
 import types
 
 from twisted.internet import defer
@@ -32,6 +33,7 @@ class InterceptorSystem(Interceptor):
 
         self.interceptors = {}
         self.paths = {}
+        self.compiled_paths = {}
 
     # Life cycle
 
@@ -66,36 +68,22 @@ class InterceptorSystem(Interceptor):
             # have priorities and alternative routes
 
     # API
-    @defer.inlineCallbacks
     def process(self, invocation):
         """
         @param invocation container object for parameters
-        @retval invocation instance, may be modified
+        @retval Deferred for the invocation instance, may be modified
         """
-        pathname = invocation.path
-        path = self.paths.get(pathname, None)
+        path = self.compiled_paths.get(invocation.path, None)
         if not path:
-            raise RuntimeError("Path %s unknown" % invocation.path)
-        for path_element in path:
-            invocation.path = pathname
-            intc = path_element['interceptor_instance']
-            #log.debug("Process path %s step %s" % (invocation.path, path_element['name']))
-            try:
-                invocation = yield defer.maybeDeferred(intc.process, invocation)
-            except Exception, ex:
-                log.exception("Error in interceptor path %s step %s" % (
-                    invocation.path, path_element['name']))
-                invocation.error(str(ex))
-                raise ex
+            return defer.fail(RuntimeError("Path %s unknown" % invocation.path))
+        return defer.maybeDeferred(path.process, invocation)
 
-            # Continuation
-            if invocation.status == Invocation.STATUS_DROP:
-                #log.debug("Process path %s step %s: DROP" % (invocation.path, path_element['name']))
-                break
-            if invocation.status == Invocation.STATUS_DONE:
-                #log.debug("Process path %s step %s: DONE" % (invocation.path, path_element['name']))
-                break
-        defer.returnValue(invocation)
+    def stats(self):
+        """
+        @retval dict path name -> stage name -> dict with the number of messages
+            processed and the total seconds spent in the stage
+        """
+        return dict((name, path.stats()) for name, path in self.compiled_paths.items())
 
     # Helpers
 
@@ -123,6 +111,9 @@ class InterceptorSystem(Interceptor):
         if 'paths' in config:
             raise NotImplementedError("Not implemented")
 
+        for pathname, path in self.paths.items():
+            self.compiled_paths[pathname] = InterceptorPath(pathname, path)
+
     @defer.inlineCallbacks
     def _create_interceptor(self, name, config):
         #log.debug("Create Interceptor '%s' from config: %s" % (name, config))
@@ -161,3 +152,99 @@ class InterceptorSystem(Interceptor):
     def _reversed_intercept_path(self, int_path):
         assert type(int_path) is list
         return list(reversed(int_path))
+
+
+class InterceptorPath(object):
+    """
+    An interceptor path compiled into a call chain of its active stages.
+    Stages that are not active on the path are left out; the chain calls
+    invocation.proceed() in their place. The chain runs synchronously and only
+    continues asynchronously once a stage returns a Deferred.
+    """
+
+    def __init__(self, pathname, path):
+        """
+        @param pathname Invocation.PATH_IN or Invocation.PATH_OUT
+        @param path list of path elements with 'name' and 'interceptor_instance'
+        """
+        self.pathname = pathname
+        # List of [name, interceptor, proceed] with proceed True when left out
+        # stages follow the stage
+        self.stages = []
+        self.proceed_first = False
+        # Stage name -> [number of messages, seconds]
+        self.timing = {}
+
+        for path_element in path:
+            intc = path_element['interceptor_instance']
+            if intc.is_active(pathname):
+                self.stages.append([path_element['name'], intc, False])
+                self.timing[path_element['name']] = [0, 0.0]
+            elif self.stages:
+                self.stages[-1][2] = True
+            else:
+                self.proceed_first = True
+
+        log.debug("Interceptor path %s compiled: %s" % (pathname, [stage[0] for stage in self.stages]))
+
+    def process(self, invocation):
+        """
+        @param invocation container object for parameters
+        @retval invocation instance, may be modified, or a Deferred for it
+        """
+        if self.proceed_first:
+            invocation.proceed()
+        return self._run(invocation, 0)
+
+    def stats(self):
+        return dict((name, {'count':count, 'time':seconds}) for name, (count, seconds) in self.timing.items())
+
+    def _run(self, invocation, index):
+        while index < len(self.stages):
+            name, intc, proceed = self.stages[index]
+            invocation.path = self.pathname
+            start = time.time()
+            try:
+                result = intc.process(invocation)
+            except Exception, ex:
+                log.exception("Error in interceptor path %s step %s" % (self.pathname, name))
+                invocation.error(str(ex))
+                raise
+
+            if isinstance(result, defer.Deferred):
+                result.addCallbacks(self._resume, self._errback,
+                                    callbackArgs=(index, start), errbackArgs=(invocation, name))
+                return result
+
+            invocation = result
+            if self._finish_stage(invocation, index, start):
+                break
+            index += 1
+        return invocation
+
+    def _resume(self, invocation, index, start):
+        if self._finish_stage(invocation, index, start):
+            return invocation
+        return self._run(invocation, index + 1)
+
+    def _errback(self, reason, invocation, name):
+        log.error("Error in interceptor path %s step %s: %s" % (self.pathname, name, reason.getTraceback()))
+        invocation.error(str(reason.value))
+        return reason
+
+    def _finish_stage(self, invocation, index, start):
+        """
+        @retval True if the invocation does not continue along the path
+        """
+        name, intc, proceed = self.stages[index]
+        timing = self.timing[name]
+        timing[0] += 1
+        timing[1] += time.time() - start
+
+        # Continuation
+        if invocation.status in (Invocation.STATUS_DROP, Invocation.STATUS_DONE):
+            #log.debug("Process path %s step %s: %s" % (self.pathname, name, invocation.status))
+            return True
+        if proceed:
+            invocation.proceed()
+        return False
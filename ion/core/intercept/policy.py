@@ -21,16 +21,21 @@ from ion.core.process.cprocess import Invocation
 
 import time
 
+from ion.util.cache import LRUDict
 from ion.util.config import Config
+from ion.util.state_object import BasicStates
 
 from ion.services.coi.datastore_bootstrap.ion_preload_config import OWNED_BY_ID
 from ion.services.dm.inventory.association_service import AssociationServiceClient, ASSOCIATION_QUERY_MSG_TYPE
 from ion.services.dm.inventory.association_service import IDREF_TYPE
 from ion.core.messaging.message_client import MessageClient
+from ion.services.dm.distribution.events import OwnershipChangeEventSubscriber
 
 from google.protobuf.internal.containers import RepeatedScalarFieldContainer
 
 CONF = ioninit.config(__name__)
+OWNER_CACHE_TTL = CONF.getValue('owner_cache_ttl', 60)
+OWNER_CACHE_SIZE = CONF.getValue('owner_cache_size', 10000)
 # Master set of roles and their user-friendly names
 all_roles = {'ANONYMOUS': 'Guest', 'AUTHENTICATED': 'User', 'DATA_PROVIDER': 'Data Provider',
              'MARINE_OPERATOR': 'Marine Operator', 'EARLY_ADOPTER': 'Early Adopter',
@@ -170,7 +175,51 @@ def subject_has_early_adopter_role(subject):
 def user_has_early_adopter_role(ooi_id):
     return user_has_role(ooi_id, 'EARLY_ADOPTER')
 
+class OwnerDecisionCache(object):
+    """
+    Results of ownership checks keyed by (user_id, resource_id). Entries expire after ttl seconds and are
+    invalidated when an ownership change event names the resource.
+    """
+
+    def __init__(self, ttl=OWNER_CACHE_TTL, size=OWNER_CACHE_SIZE):
+        self.ttl = ttl
+        self.decisions = LRUDict(size)
+
+    def get(self, user_id, resource_id):
+        """
+        @retval True or False for a cached decision, None if there is none
+        """
+        entry = self.decisions.get((user_id, resource_id))
+        if entry is None:
+            return None
+        owner, expires = entry
+        if expires < time.time():
+            del self.decisions[(user_id, resource_id)]
+            return None
+        return owner
+
+    def put(self, user_id, resource_id, owner):
+        if self.ttl > 0:
+            self.decisions[(user_id, resource_id)] = (owner, time.time() + self.ttl)
+
+    def invalidate(self, resource_id=None):
+        """
+        @param resource_id drop the decisions for this resource, or all decisions if None
+        """
+        if resource_id is None:
+            self.decisions.clear()
+            return
+        for key in [key for key in self.decisions.keys() if key[1] == resource_id]:
+            del self.decisions[key]
+
+owner_decision_cache = OwnerDecisionCache()
+
+
 class PolicyInterceptor(EnvelopeInterceptor):
+
+    # Subscriber to ownership change events, attached to a process handling requests
+    ownership_subscriber = None
+
     def before(self, invocation):
         msg = invocation.content
         return self.is_authorized(msg, invocation)
@@ -178,7 +227,6 @@ class PolicyInterceptor(EnvelopeInterceptor):
     def after(self, invocation):
         return invocation
 
-    @defer.inlineCallbacks
     def is_authorized(self, msg, invocation):
         """
         @brief Policy enforcement method which implements the functionality
@@ -199,30 +247,31 @@ class PolicyInterceptor(EnvelopeInterceptor):
             ANONYMOUS, AUTHORIZED, OWNER, ADMIN
         @param msg: message content from invocation
         @param invocation: invocation object passed on interceptor stack.
-        @return: invocation object indicating status of authority check
+        @return: invocation object indicating status of authority check, or a
+            Deferred for it if resource ownership must be checked
         """
 
         # Ignore messages that are not of performative 'request'
         if msg.get('performative', None) != 'request':
-            defer.returnValue(invocation)
+            return invocation
 
         # Reject improperly defined messages
         if not 'user-id' in msg:
             log.error("Policy Interceptor: Rejecting improperly defined message missing user-id [%s]." % str(msg))
             invocation.drop(note='Error: no user-id defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
         if not 'expiry' in msg:
             log.error("Policy Interceptor: Rejecting improperly defined message missing expiry [%s]." % str(msg))
             invocation.drop(note='Error: no expiry defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
         if not 'receiver' in msg:
             log.error("Policy Interceptor: Rejecting improperly defined message missing receiver [%s]." % str(msg))
             invocation.drop(note='Error: no receiver defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
         if not 'op'in msg:
             log.error("Policy Interceptor: Rejecting improperly defined message missing op [%s]." % str(msg))
             invocation.drop(note='Error: no op defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
 
         user_id = msg['user-id']
         expirystr = msg['expiry']
@@ -230,14 +279,14 @@ class PolicyInterceptor(EnvelopeInterceptor):
         if not type(expirystr) is str:
             log.error("Policy Interceptor: Rejecting improperly defined message with bad expiry [%s]." % str(expirystr))
             invocation.drop(note='Error: expiry improperly defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
 
         try:
             expiry = int(expirystr)
         except ValueError, ex:
             log.error("Policy Interceptor: Rejecting improperly defined message with bad expiry [%s]." % str(expirystr))
             invocation.drop(note='Error: expiry improperly defined in message header!', code=Invocation.CODE_BAD_REQUEST)
-            defer.returnValue(invocation)
+            return invocation
 
         rcvr = msg['receiver']
         service = rcvr.rsplit('.',1)[-1]
@@ -265,7 +314,7 @@ class PolicyInterceptor(EnvelopeInterceptor):
                     if user_id == 'ANONYMOUS':
                         log.warn('Policy Interceptor: Authentication failed for service [%s] operation [%s] resource [%s] user_id [%s] expiry [%s] for roles [%s]. Returning Not Authorized.' % (service, operation, '*', user_id, expiry, str(role_entry)))
                         invocation.drop(note='Not authorized', code=Invocation.CODE_UNAUTHORIZED)
-                        defer.returnValue(invocation)
+                        return invocation
 
                     isOwnershipPolicy = False
                     for role in role_entry:
@@ -277,23 +326,31 @@ class PolicyInterceptor(EnvelopeInterceptor):
                         return_uuid_list = self.find_uuids(invocation, msg, user_id, service_list[operation]['resources'])
                         if invocation.status != Invocation.STATUS_PROCESS:
                             log.warn('Policy Interceptor: Authentication failed for service [%s] operation [%s] resource [%s] user_id [%s] expiry [%s] for role [OWNER].' % (service, operation, '*', user_id, expiry))
-                            defer.returnValue(invocation)
+                            return invocation
                             
-                        yield self.check_owner(user_id, return_uuid_list, invocation)
-                        if invocation.status != Invocation.STATUS_PROCESS:
-                            log.warn('Policy Interceptor: Authentication failed for service [%s] operation [%s] resource [%s] user_id [%s] expiry [%s] for role [OWNER].' % (service, operation, '*', user_id, expiry))
-                            defer.returnValue(invocation)
-                        else:
-                            log.info('Policy Interceptor: Role <OWNER> authentication matches')
+                        d = self.check_owner(user_id, return_uuid_list, invocation)
+                        d.addCallback(self._owner_checked, invocation, service, operation, user_id, expiry)
+                        return d
                     else:
                         log.warn('Policy Interceptor: Authentication failed for service [%s] operation [%s] resource [%s] user_id [%s] expiry [%s] for roles [%s]. Returning Not Authorized.' % (service, operation, '*', user_id, expiry, str(role_entry)))
                         invocation.drop(note='Not authorized', code=Invocation.CODE_UNAUTHORIZED)
-                        defer.returnValue(invocation)
+                        return invocation
             else:
                 log.info('Policy Interceptor: operation not in policy dictionary.')
         else:
             log.info('Policy Interceptor: service not in policy dictionary.')
 
+        return self.check_expiry(invocation, service, operation, user_id, expiry)
+
+    def _owner_checked(self, result, invocation, service, operation, user_id, expiry):
+        if invocation.status != Invocation.STATUS_PROCESS:
+            log.warn('Policy Interceptor: Authentication failed for service [%s] operation [%s] resource [%s] user_id [%s] expiry [%s] for role [OWNER].' % (service, operation, '*', user_id, expiry))
+            return invocation
+
+        log.info('Policy Interceptor: Role <OWNER> authentication matches')
+        return self.check_expiry(invocation, service, operation, user_id, expiry)
+
+    def check_expiry(self, invocation, service, operation, user_id, expiry):
         expiry_time = int(expiry)
         if (expiry_time > 0):
             current_time = time.time()
@@ -301,38 +358,91 @@ class PolicyInterceptor(EnvelopeInterceptor):
             if current_time > expiry_time:
                 log.warn('Policy Interceptor: Current time [%s] exceeds expiry [%s] for service [%s] operation [%s] resource [%s] user_id [%s] . Returning Not Authorized.' % (str(current_time), expiry, service, operation, '*', user_id))
                 invocation.drop(note='Authentication expired', code=Invocation.CODE_UNAUTHORIZED)
-                defer.returnValue(invocation)
+                return invocation
 
         log.info('Policy Interceptor: Returning Authorized.')
-        defer.returnValue(invocation)
+        return invocation
 
     @defer.inlineCallbacks
     def check_owner(self, user_id, uuid_list, invocation):
+        """
+        Check that the user owns all the resources. Decisions are taken from the owner decision cache, the
+        association service is asked about the rest all at once.
+        """
         self.mc = MessageClient(proc=invocation.process)
         self.asc = AssociationServiceClient(proc=invocation.process)
+        self._subscribe(invocation.process)
+
+        lookup_uuids = []
+        for uuid in uuid_list:
+            owner = owner_decision_cache.get(user_id, uuid)
+            if owner is None:
+                if uuid not in lookup_uuids:
+                    lookup_uuids.append(uuid)
+            elif not owner:
+                log.warn('Policy Interceptor: Authentication failed. User <%s> does not own resource <%s>.' % (user_id, uuid))
+                invocation.drop(note='Not authorized', code=Invocation.CODE_UNAUTHORIZED)
+                return
 
-        for uuid in uuid_list:        
-            request = yield self.mc.create_instance(ASSOCIATION_QUERY_MSG_TYPE)
-
-            request.object = request.CreateObject(IDREF_TYPE)
-            request.object.key = user_id
-
-            request.predicate = request.CreateObject(IDREF_TYPE)
-            request.predicate.key = OWNED_BY_ID
+        if not lookup_uuids:
+            return
 
-            request.subject = request.CreateObject(IDREF_TYPE)
-            request.subject.key = uuid
+        d = defer.DeferredList([self._association_exists(user_id, uuid) for uuid in lookup_uuids],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda reason: reason.value.subFailure)
+        results = yield d
 
-            # make the request
-            log.warn('Calling association service for user id <%s> and uuid <%s>' % (user_id, uuid))
-            result = yield self.asc.association_exists(request)
-            log.warn('Return from association service call for user id <%s> and uuid <%s>' % (user_id, uuid))
-            if result.result == False:
+        for success, (uuid, owner) in results:
+            owner_decision_cache.put(user_id, uuid, owner)
+            if not owner:
                 log.warn('Policy Interceptor: Authentication failed. User <%s> does not own resource <%s>.' % (user_id, uuid))
                 invocation.drop(note='Not authorized', code=Invocation.CODE_UNAUTHORIZED)
-                return
             else:
-                log.warn('Policy Interceptor: User <%s> owns resource <%s>.' % (user_id, uuid))
+                log.info('Policy Interceptor: User <%s> owns resource <%s>.' % (user_id, uuid))
+
+    @defer.inlineCallbacks
+    def _association_exists(self, user_id, uuid):
+        request = yield self.mc.create_instance(ASSOCIATION_QUERY_MSG_TYPE)
+
+        request.object = request.CreateObject(IDREF_TYPE)
+        request.object.key = user_id
+
+        request.predicate = request.CreateObject(IDREF_TYPE)
+        request.predicate.key = OWNED_BY_ID
+
+        request.subject = request.CreateObject(IDREF_TYPE)
+        request.subject.key = uuid
+
+        # make the request
+        log.debug('Calling association service for user id <%s> and uuid <%s>' % (user_id, uuid))
+        result = yield self.asc.association_exists(request)
+        defer.returnValue((uuid, result.result))
+
+    def _subscribe(self, process):
+        """
+        Listen to ownership change events with the process handling the request, unless a subscriber attached
+        to a process which is still active is listening already.
+        """
+        subscriber = self.ownership_subscriber
+        if subscriber is not None and subscriber._process._get_state() == BasicStates.S_ACTIVE:
+            return
+        if not hasattr(process, 'register_life_cycle_object'):
+            return
+
+        subscriber = OwnershipChangeEventSubscriber(process=process)
+        subscriber.ondata = self._ownership_changed
+        self.ownership_subscriber = subscriber
+
+        # Until the subscriber is listening changes can be missed, so start afresh
+        owner_decision_cache.invalidate()
+
+        d = process.register_life_cycle_object(subscriber)
+        d.addErrback(lambda reason: log.error('Policy Interceptor: Could not subscribe to ownership changes: %s' % reason))
+
+    def _ownership_changed(self, data):
+        resource_id = data['content'].origin
+        log.debug('Policy Interceptor: Ownership of resource <%s> changed' % resource_id)
+        owner_decision_cache.invalidate(resource_id)
 
     def find_uuids(self, invocation, msg, user_id, resources):
         """
@@ -359,49 +469,43 @@ class PolicyInterceptor(EnvelopeInterceptor):
             invocation.drop(note='Error: MessageInstance missing from message payload!', code=Invocation.CODE_BAD_REQUEST)
 
     def find_uuids_traverse_gpbs(self, invocation, msg, wrapper, repo, user_id, resources, uuid_list = None):
+        """
+        Collects the resource ids of the objects of the types in resources linked below wrapper.
+        Each object is visited once, however many links lead to it.
+        """
         log.info('Policy Interceptor: In check_resource_ownership_traverse_gpbs')
 
         if uuid_list is None:
             uuid_list = []
 
-        childLinksSet = wrapper.ChildLinks
-        
-        if len(childLinksSet) == 0:
-            log.info('Policy Interceptor: Returning from check_resource_ownership_traverse_gpbs.  ChildLinksSet zero length.')
-            return
-            
-        for link in wrapper.ChildLinks:
-            obj = repo.get_linked_object(link)
-            type = obj.ObjectType
-            typeId = type.object_id
-            log.info('Policy Interceptor: In check_resource_ownership_traverse_gpbs.  Child type: <%s>' % str(typeId))
-            if typeId in resources:
-                log.info('Policy Interceptor: In check_resource_ownership_traverse_gpbs.  Child type match found in resources')
-                gpbMessage = obj.GPBMessage
-                uuid = getattr(gpbMessage,resources[typeId])
-                log.info('Policy Interceptor: In check_resource_ownership_traverse_gpbs.  GPB type: %s UUID: %s' % (str(typeId),uuid))
-                if not uuid:
-                    log.error("Policy Interceptor: Rejecting improperly defined message missing expected uuid [%s]." % str(msg))
-                    invocation.drop(note='Error: Uuid missing from message payload!', code=Invocation.CODE_BAD_REQUEST)
-                    return
-                if uuid == '':
-                    log.error("Policy Interceptor: Rejecting improperly defined message missing expected uuid [%s]." % str(msg))
-                    invocation.drop(note='Error: Uuid missing from message payload!', code=Invocation.CODE_BAD_REQUEST)
-                    return
-                if isinstance(uuid, RepeatedScalarFieldContainer):
-                    uuid_values = uuid._values
-                    for id in uuid_values:
-                        uuid_list.append(id.decode('utf-8'))
-                elif isinstance(uuid, unicode):
-                    uuid_list.append(uuid.decode('utf-8'))
-                else:
-                    log.error("Policy Interceptor: Rejecting improperly defined message with unexpected uuid variable type [%s]." % str(msg))
-                    invocation.drop(note='Error: Uuid variable type not supported!', code=Invocation.CODE_BAD_REQUEST)
-                    return
-                log.info('Policy Interceptor: In check_resource_ownership_traverse_gpbs.  Added UUID: %s to return list' % uuid)
-
-            log.info('Policy Interceptor: Recursing.')
-            self.find_uuids_traverse_gpbs(invocation, msg, obj, repo, user_id, resources, uuid_list)
-        return uuid_list
-                
+        visited = set()
+        stack = [wrapper]
+        while stack:
+            for link in stack.pop().ChildLinks:
+                if link.key in visited:
+                    continue
+                visited.add(link.key)
+
+                obj = repo.get_linked_object(link)
+                typeId = obj.ObjectType.object_id
+                if typeId in resources:
+                    gpbMessage = obj.GPBMessage
+                    uuid = getattr(gpbMessage,resources[typeId])
+                    log.debug('Policy Interceptor: In check_resource_ownership_traverse_gpbs.  GPB type: %s UUID: %s' % (str(typeId),uuid))
+                    if not uuid:
+                        log.error("Policy Interceptor: Rejecting improperly defined message missing expected uuid [%s]." % str(msg))
+                        invocation.drop(note='Error: Uuid missing from message payload!', code=Invocation.CODE_BAD_REQUEST)
+                        return uuid_list
+                    if isinstance(uuid, RepeatedScalarFieldContainer):
+                        uuid_values = uuid._values
+                        for id in uuid_values:
+                            uuid_list.append(id.decode('utf-8'))
+                    elif isinstance(uuid, unicode):
+                        uuid_list.append(uuid.decode('utf-8'))
+                    else:
+                        log.error("Policy Interceptor: Rejecting improperly defined message with unexpected uuid variable type [%s]." % str(msg))
+                        invocation.drop(note='Error: Uuid variable type not supported!', code=Invocation.CODE_BAD_REQUEST)
+                        return uuid_list
 
+                stack.append(obj)
+        return uuid_list
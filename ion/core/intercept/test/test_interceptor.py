@@ -216,6 +216,89 @@ class InterceptorTest(IonTestCase):
         finally:
             yield self._stop_container()
 
+    @defer.inlineCallbacks
+    def test_compiled_path(self):
+        is_config1 = {
+            'interceptors':{
+                'pass':{
+                    'classname':'ion.core.intercept.interceptor.PassThroughInterceptor'
+                },
+                'test1':{
+                    'classname':'ion.core.intercept.test.test_interceptor.TestInterceptor',
+                },
+                'async1':{
+                    'classname':'ion.core.intercept.test.test_interceptor.AsyncTestInterceptor',
+                },
+            },
+            'stack':[
+                {'name':'pass1', 'interceptor':'pass' },
+                {'name':'test1', 'interceptor':'test1' },
+                {'name':'pass2', 'interceptor':'pass' },
+                {'name':'async1', 'interceptor':'async1' },
+            ]
+        }
+
+        intercept_sys = InterceptorSystem()
+        yield intercept_sys.initialize(is_config1)
+        yield intercept_sys.activate()
+
+        # The pass through stages are left out
+        compiled = intercept_sys.compiled_paths[Invocation.PATH_OUT]
+        self.assertEqual([stage[0] for stage in compiled.stages], ['test1', 'async1'])
+        self.assertEqual(len(intercept_sys.paths[Invocation.PATH_OUT]), 4)
+
+        # A stage returning a Deferred makes the rest of the chain asynchronous
+        ti1 = intercept_sys.interceptors['test1']
+        compiled_in = intercept_sys.compiled_paths[Invocation.PATH_IN]
+        result = compiled_in.process(Invocation(path=Invocation.PATH_IN, message="123"))
+        self.assertIsInstance(result, defer.Deferred)
+        self.assertEqual(ti1.numbefore, 1)
+
+        # Synchronous stages return the invocation itself
+        async1 = intercept_sys.interceptors['async1']
+        async1.status = Invocation.STATUS_DROP
+        result = compiled.process(Invocation(path=Invocation.PATH_OUT, message="123"))
+        self.assertIsInstance(result, Invocation)
+        self.assertEqual(result.status, Invocation.STATUS_DROP)
+        self.assertEqual(ti1.numafter, 1)
+        self.assertEqual(async1.numafter, 1)
+
+        inv1a = Invocation(path=Invocation.PATH_OUT, message="123")
+        inv1b = yield intercept_sys.process(inv1a)
+        self.assertEqual(inv1b.status, Invocation.STATUS_DROP)
+
+        stats = intercept_sys.stats()
+        self.assertEqual(stats[Invocation.PATH_OUT]['test1']['count'], 2)
+        self.assertEqual(stats[Invocation.PATH_OUT]['async1']['count'], 2)
+        self.assertEqual(stats[Invocation.PATH_IN]['async1']['count'], 1)
+        self.assertEqual(stats[Invocation.PATH_IN]['test1']['count'], 1)
+
+    @defer.inlineCallbacks
+    def test_compiled_path_error(self):
+        is_config1 = {
+            'interceptors':{
+                'async1':{
+                    'classname':'ion.core.intercept.test.test_interceptor.AsyncTestInterceptor',
+                },
+            },
+            'stack':[
+                {'name':'async1', 'interceptor':'async1' },
+            ]
+        }
+
+        intercept_sys = InterceptorSystem()
+        yield intercept_sys.initialize(is_config1)
+        yield intercept_sys.activate()
+        intercept_sys.interceptors['async1'].fail = True
+
+        inv = Invocation(path=Invocation.PATH_IN, message="123")
+        try:
+            yield intercept_sys.process(inv)
+            self.fail("RuntimeError expected")
+        except RuntimeError, re:
+            pass
+        self.assertEqual(inv.status, Invocation.STATUS_ERROR)
+
 class TestInterceptor(EnvelopeInterceptor):
     """
     Interceptor to test messages.
@@ -240,6 +323,26 @@ class TestInterceptor(EnvelopeInterceptor):
         return invocation
 
 
+class AsyncTestInterceptor(EnvelopeInterceptor):
+    """
+    Interceptor that returns a Deferred on the in path.
+    """
+    def on_initialize(self, *args, **kwargs):
+        self.numafter = 0
+        self.status = Invocation.STATUS_PROCESS
+        self.fail = False
+
+    def before(self, invocation):
+        if self.fail:
+            return defer.fail(RuntimeError('async interceptor failed'))
+        return defer.succeed(invocation)
+
+    def after(self, invocation):
+        self.numafter += 1
+        invocation.status = self.status
+        return invocation
+
+
 class TestSignature(IonTestCase):
 
     @defer.inlineCallbacks
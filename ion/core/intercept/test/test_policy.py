@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/intercept/test/test_policy.py
+@brief Tests for the ownership decision cache of the policy interceptor
+"""
+
+import time
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from ion.core.intercept import policy
+from ion.core.intercept.policy import PolicyInterceptor, OwnerDecisionCache
+from ion.core.process.cprocess import Invocation
+
+
+class OwnerDecisionCacheTest(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = OwnerDecisionCache(ttl=60, size=10)
+        self.assertEqual(cache.get('alice', 'r1'), None)
+
+        cache.put('alice', 'r1', True)
+        cache.put('bob', 'r1', False)
+        self.assertEqual(cache.get('alice', 'r1'), True)
+        self.assertEqual(cache.get('bob', 'r1'), False)
+        self.assertEqual(cache.get('alice', 'r2'), None)
+
+    def test_expiry(self):
+        cache = OwnerDecisionCache(ttl=60, size=10)
+        cache.put('alice', 'r1', True)
+
+        now = time.time()
+        self.patch(policy.time, 'time', lambda: now + 61)
+        self.assertEqual(cache.get('alice', 'r1'), None)
+        self.assertEqual(len(cache.decisions), 0)
+
+    def test_invalidate(self):
+        cache = OwnerDecisionCache(ttl=60, size=10)
+        cache.put('alice', 'r1', True)
+        cache.put('bob', 'r1', False)
+        cache.put('alice', 'r2', True)
+
+        cache.invalidate('r1')
+        self.assertEqual(cache.get('alice', 'r1'), None)
+        self.assertEqual(cache.get('bob', 'r1'), None)
+        self.assertEqual(cache.get('alice', 'r2'), True)
+
+        cache.invalidate()
+        self.assertEqual(len(cache.decisions), 0)
+
+    def test_disabled(self):
+        cache = OwnerDecisionCache(ttl=0, size=10)
+        cache.put('alice', 'r1', True)
+        self.assertEqual(cache.get('alice', 'r1'), None)
+
+
+class CheckOwnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = OwnerDecisionCache(ttl=60, size=10)
+        self.patch(policy, 'owner_decision_cache', self.cache)
+        self.patch(policy, 'MessageClient', lambda proc: None)
+        self.patch(policy, 'AssociationServiceClient', lambda proc: None)
+
+        self.owned = set(['r1', 'r2'])
+        self.pending = []
+
+        def association_exists(user_id, uuid):
+            d = defer.Deferred()
+            self.pending.append((d, uuid))
+            return d
+
+        self.pi = PolicyInterceptor('policy')
+        self.pi._association_exists = association_exists
+
+    def _answer(self):
+        pending, self.pending = self.pending, []
+        for d, uuid in pending:
+            d.callback((uuid, uuid in self.owned))
+
+    def test_concurrent_lookup(self):
+        invocation = Invocation()
+        d = self.pi.check_owner('alice', ['r1', 'r2', 'r1'], invocation)
+
+        # all lookups are made before any answer comes back, once per uuid
+        self.assertEqual([uuid for _, uuid in self.pending], ['r1', 'r2'])
+        self._answer()
+        self.assertEqual(invocation.status, Invocation.STATUS_PROCESS)
+
+        # the second request is decided from the cache
+        invocation = Invocation()
+        self.pi.check_owner('alice', ['r2'], invocation)
+        self.assertEqual(self.pending, [])
+        self.assertEqual(invocation.status, Invocation.STATUS_PROCESS)
+        return d
+
+    def test_not_owner(self):
+        invocation = Invocation()
+        self.pi.check_owner('alice', ['r1', 'r3'], invocation)
+        self._answer()
+        self.assertEqual(invocation.status, Invocation.STATUS_DROP)
+        self.assertEqual(self.cache.get('alice', 'r3'), False)
+
+        invocation = Invocation()
+        self.pi.check_owner('alice', ['r3'], invocation)
+        self.assertEqual(self.pending, [])
+        self.assertEqual(invocation.status, Invocation.STATUS_DROP)
+
+    def test_ownership_changed(self):
+        self.pi.check_owner('alice', ['r3'], Invocation())
+        self._answer()
+
+        self.owned.add('r3')
+
+        class Event(object):
+            origin = 'r3'
+        self.pi._ownership_changed({'content': Event()})
+
+        invocation = Invocation()
+        self.pi.check_owner('alice', ['r3'], invocation)
+        self.assertEqual(len(self.pending), 1)
+        self._answer()
+        self.assertEqual(invocation.status, Invocation.STATUS_PROCESS)
+
+    def test_lookup_error(self):
+        def association_exists(user_id, uuid):
+            return defer.fail(ValueError('association service failed'))
+        self.pi._association_exists = association_exists
+
+        d = self.pi.check_owner('alice', ['r1'], Invocation())
+        return self.assertFailure(d, ValueError)
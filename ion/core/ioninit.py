@@ -12,7 +12,7 @@ import logging.handlers
 import re
 import os, os.path
 
-from ion.util.context import ContextLocal
+from ion.util.context import ReactorContextLocal
 from ion.util.path import adjust_dir
 from ion.core import ionconst as ic
 from ion.util.config import Config
@@ -69,9 +69,11 @@ sys_name = None
 # Global flag determining whether currently running unit test
 testing = True
 
-# Static entry point for "thread local" context storage during request
-# processing, eg. to retaining user-id from request message
-request = ContextLocal()
+# Static entry point for context storage during request processing,
+# eg. to retaining user-id from request message. The context follows
+# a message through the reactor, see ion.util.context.ReactorContextLocal
+request = ReactorContextLocal()
+request.follow_deferreds()
 
 
 
@@ -7,8 +7,10 @@
 """
 
 import uuid
+from collections import deque
 
 from twisted.internet import defer
+from twisted.python import failure
 
 from txamqp.client import TwistedDelegate
 from txamqp.client import Closed
@@ -22,6 +24,12 @@ from ion.util.state_object import BasicLifecycleObject
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Keep publisher channels open between sends instead of opening one per message
+POOL_PUBLISHERS = CONF.getValue('pool_publishers', True)
+
 class AMQPEvents(TwistedDelegate):
     """
     This class defines handlers for asynchronous amqp events (events the
@@ -195,6 +203,7 @@ class ProcessExchangeSpace(ExchangeSpace):
         ExchangeSpace.__init__(self, message_space, name)
         self.type = "process"
         self.exchange = Exchange(name)
+        self.publisher_pool = PublisherPool(self)
 
     @defer.inlineCallbacks
     def send(self, to_name, message_data, publisher_config=None, **kwargs):
@@ -202,9 +211,146 @@ class ProcessExchangeSpace(ExchangeSpace):
 
         pub_config = {'routing_key' : str(to_name)}
         pub_config.update(publisher_config)
-        publisher = yield Publisher.name(self, pub_config)
-        yield publisher.send(message_data)
-        publisher.close()
+
+        if POOL_PUBLISHERS:
+            yield self.publisher_pool.send(pub_config, message_data)
+        else:
+            publisher = yield Publisher.name(self, pub_config)
+            yield publisher.send(message_data)
+            publisher.close()
+
+
+class PublisherPool(object):
+    """
+    Long lived publishers for an exchange space, one open channel for each
+    distinct publisher config (the routing key is given per message). Each
+    exchange is declared once per broker connection. A publisher whose
+    channel was closed by an error is dropped and reopened, declaring its
+    exchange again, on the next send.
+    """
+
+    def __init__(self, ex_space):
+        self.ex_space = ex_space
+
+        self._client = None
+        self._publishers = {}
+        self._opening = {}
+        self._declared = set()
+
+        self.opened = 0
+        self.reused = 0
+        self.declared = 0
+        self.recovered = 0
+        self.sent = 0
+
+    def _publisher_key(self, config):
+        """
+        Pool key - the full publisher config except for the routing key.
+        """
+        full_config = self.ex_space.exchange.config_dict.copy()
+        full_config.update(config)
+        full_config.pop('routing_key', None)
+        return tuple(sorted(full_config.items()))
+
+    def _exchange_key(self, key):
+        config = dict(key)
+        return (config.get('exchange'), config.get('exchange_type'), config.get('durable'), config.get('auto_delete'))
+
+    def _check_client(self):
+        """
+        Channels and exchange declarations belong to a broker connection - start over on a new one.
+        """
+        if self._client is not self.ex_space.client:
+            self._client = self.ex_space.client
+            self._publishers.clear()
+            self._declared.clear()
+
+    def _discard(self, key, publisher):
+        """
+        Drops a failed publisher. The broker may have closed the channel because the exchange went away, so
+        declare it again with the next publisher.
+        """
+        if self._publishers.get(key) is publisher:
+            del self._publishers[key]
+        self._declared.discard(self._exchange_key(key))
+        self.recovered += 1
+
+    @defer.inlineCallbacks
+    def get_publisher(self, config):
+        """
+        @param config The publisher config, as given to Publisher.name
+        @retval Deferred which fires with an open Publisher for the config
+        """
+        self._check_client()
+        key = self._publisher_key(config)
+
+        publisher = self._publishers.get(key)
+        if publisher is not None:
+            if not publisher.channel.closed:
+                self.reused += 1
+                defer.returnValue(publisher)
+
+            log.info('Publisher channel for exchange %s was closed, reopening' % publisher.exchange)
+            self._discard(key, publisher)
+
+        # Another send is already opening a channel for this config
+        if key in self._opening:
+            d = defer.Deferred()
+            self._opening[key].append(d)
+            publisher = yield d
+            defer.returnValue(publisher)
+
+        self._opening[key] = []
+        exchange_key = self._exchange_key(key)
+        declare = exchange_key not in self._declared
+        try:
+            publisher = yield Publisher.name(self.ex_space, config, declare=declare)
+        except Exception:
+            f = failure.Failure()
+            for d in self._opening.pop(key):
+                d.errback(f)
+            raise
+
+        self.opened += 1
+        if declare:
+            self._declared.add(exchange_key)
+            self.declared += 1
+
+        self._publishers[key] = publisher
+        for d in self._opening.pop(key):
+            d.callback(publisher)
+
+        defer.returnValue(publisher)
+
+    @defer.inlineCallbacks
+    def send(self, config, message_data):
+        """
+        Sends a message through a pooled publisher, retrying once on a fresh channel if the channel is closed.
+        @param config The publisher config, including the routing key
+        @param message_data The message to send
+        """
+        routing_key = config.get('routing_key')
+        publisher = yield self.get_publisher(config)
+        try:
+            yield publisher.send(message_data, routing_key=routing_key)
+        except Closed:
+            log.info('Publisher channel for exchange %s closed during send, retrying' % publisher.exchange)
+            self._discard(self._publisher_key(config), publisher)
+            publisher = yield self.get_publisher(config)
+            yield publisher.send(message_data, routing_key=routing_key)
+
+        self.sent += 1
+
+    def stats(self):
+        """
+        @retval A dict of pool counters and the number of open publishers
+        """
+        return {'size': len(self._publishers),
+                'opened': self.opened,
+                'reused': self.reused,
+                'declared': self.declared,
+                'recovered': self.recovered,
+                'sent': self.sent}
 
 
 class TopicExchangeSpace(ExchangeSpace):
@@ -275,8 +421,9 @@ class Message(object):
     received message; actions take place in the context of an amqp channel.
     """
 
-    def __init__(self, channel, amqp_message, **kwargs):
+    def __init__(self, channel, amqp_message, acks=None, **kwargs):
         self.channel = channel
+        self._acks = acks
         self._amqp_message = amqp_message
         self.body = amqp_message.content.body
         self.delivery_tag = amqp_message.delivery_tag
@@ -324,7 +471,10 @@ class Message(object):
         if self.acknowledged:
             raise self.MessageStateError(
                 "Message already acknowledged with state: %s" % self._state)
-        d = self.channel.basic_ack(self.delivery_tag)
+        if self._acks is not None:
+            d = self._acks.ack(self.delivery_tag)
+        else:
+            d = self.channel.basic_ack(self.delivery_tag)
         self._state = "ACK"
         return d
 
@@ -341,6 +491,8 @@ class Message(object):
             raise self.MessageStateError(
                 "Message already acknowledged with state: %s" % self._state)
         d = self.channel.basic_reject(self.delivery_tag, requeue=False)
+        if self._acks is not None:
+            self._acks.settle(self.delivery_tag)
         self._state = "REJECTED"
         return d
 
@@ -358,6 +510,8 @@ class Message(object):
             raise self.MessageStateError(
                 "Message already acknowledged with state: %s" % self._state)
         d = self.channel.basic_reject(self.delivery_tag, requeue=True)
+        if self._acks is not None:
+            self._acks.settle(self.delivery_tag)
         self._state = "REQUEUED"
         return d
 
@@ -365,6 +519,63 @@ class Message(object):
     def acknowledged(self):
         return self._state in ACKNOWLEDGED_STATES
 
+
+class AckSequencer(object):
+    """
+    Acknowledges the messages delivered on a channel in delivery order, when
+    messages are processed concurrently. The ack of a message is held until
+    every message delivered before it is settled, and then one ack with the
+    multiple flag set covers all of them.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        # [delivery_tag, state] in delivery order; state is None until settled
+        self._pending = deque()
+        self._entries = {}
+
+    def delivered(self, delivery_tag):
+        entry = [delivery_tag, None]
+        self._pending.append(entry)
+        self._entries[delivery_tag] = entry
+
+    def ack(self, delivery_tag):
+        """
+        @retval Deferred which fires when the acks that could be sent have been sent
+        """
+        return self._settle(delivery_tag, 'ACK')
+
+    def settle(self, delivery_tag):
+        """
+        Marks a message rejected or requeued - it was settled with the broker already and is not acked.
+        """
+        return self._settle(delivery_tag, 'SETTLED')
+
+    def _settle(self, delivery_tag, state):
+        entry = self._entries.pop(delivery_tag, None)
+        if entry is None:
+            # Not delivered through this sequencer
+            if state == 'ACK':
+                return self.channel.basic_ack(delivery_tag)
+            return defer.succeed(None)
+
+        entry[1] = state
+
+        last_ack = None
+        while self._pending and self._pending[0][1] is not None:
+            tag, settled = self._pending.popleft()
+            if settled == 'ACK':
+                last_ack = tag
+
+        if last_ack is None:
+            return defer.succeed(None)
+
+        # A rejected message is not outstanding any more, multiple only acks the outstanding ones
+        return self.channel.basic_ack(delivery_tag=last_ack, multiple=True)
+
+    def __len__(self):
+        return len(self._pending)
+
 ##
 ##############################################################
 
@@ -392,6 +603,7 @@ class Consumer(object):
                              auto_delete=True,
                              no_ack=True,
                              binding_key=None,
+                             prefetch_count=1,
                              **kwargs): # **kwargs is a sloppy hack
         self.channel = chan
         self.queue = queue
@@ -402,11 +614,17 @@ class Consumer(object):
         self.exclusive = exclusive
         self.auto_delete = auto_delete
         self.no_ack = no_ack
+        self.prefetch_count = int(prefetch_count)
         self.consumer_tag = uuid.uuid4().hex
         self.callback = None
         self._closed = False # Assuming we were given an open channel
         self._consuming = False
 
+        # With more than one unacked message at a time (0 is unlimited), ack them in delivery order
+        self.acks = None
+        if not self.no_ack and self.prefetch_count != 1:
+            self.acks = AckSequencer(chan)
+
     @classmethod
     def new(cls, client, **kwargs):
         """
@@ -457,7 +675,7 @@ class Consumer(object):
                                         routing_key=routing_key,
                                         arguments=arguments)
 
-        yield self.channel.basic_qos(prefetch_size=0, prefetch_count=1,
+        yield self.channel.basic_qos(prefetch_size=0, prefetch_count=self.prefetch_count,
                                                         global_=False)
 
         defer.returnValue(self)
@@ -482,7 +700,9 @@ class Consumer(object):
         return d
 
     def receive(self, amqp_message):
-        message = Message(self.channel, amqp_message)
+        message = Message(self.channel, amqp_message, acks=self.acks)
+        if self.acks is not None:
+            self.acks.delivered(message.delivery_tag)
         return self.callback(message)
 
     def consume(self, callback, limit=None):
@@ -552,9 +772,10 @@ class Publisher(object):
         defer.returnValue(self)
 
     @classmethod
-    def name(cls, ex_space, config):
+    def name(cls, ex_space, config, declare=True):
         """
         Factory to create new Publisher instance from given params
+        @param declare Declare the exchange - not needed if it was already declared on this connection
         """
         if not config:
             raise RuntimeError("Publisher.name(): No config given")
@@ -566,9 +787,10 @@ class Publisher(object):
         full_config.update(config)
         chan = client.channel()
         d = chan.channel_open()
-        # Are we doing an exchange declare on every send???
         def instantiate(result, chan, **kwargs):
             inst = cls(chan, **kwargs)
+            if not declare:
+                return inst
             return inst.declare()
         d.addCallback(instantiate, chan, **full_config)
         return d
@@ -8,9 +8,10 @@
 
 import os
 import types
+from collections import deque
 
 from zope.interface import implements, Interface
-from twisted.internet import defer, threads, reactor
+from twisted.internet import defer
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
@@ -21,13 +22,21 @@ from ion.core.intercept.interceptor import Invocation
 from ion.core.messaging import messaging
 from ion.util.state_object import BasicLifecycleObject
 import ion.util.procutils as pu
-from ion.core.object.codec import ION_R1_GPB
+from ion.core.object.codec import ION_R1_GPB_ENCODINGS
 
 from ion.core.exception import IonError
 
-# Static entry point for "thread local" context storage during request
-# processing, eg. to retaining user-id from request message
+CONF = ioninit.config(__name__)
+
+# Number of unacknowledged messages the broker delivers to a receiver at a time
+PREFETCH_COUNT = int(CONF.getValue('prefetch_count', 1))
+# Maximum number of request messages in processing at a time per receiver, 0 for no limit
+MAX_IN_FLIGHT = int(CONF.getValue('max_in_flight', 0))
+
+# Static entry point for context storage during request processing, eg. to
+# retaining user-id from request message
 from ion.core.ioninit import request
+from ion.util.context import RequestContext
 
 
 class ReceiverError(IonError):
@@ -63,7 +72,7 @@ class Receiver(BasicLifecycleObject):
     rec_messages = {}
     rec_shutoff = False
 
-    def __init__(self, name, scope='global', label=None, xspace=None, process=None, group=None, handler=None, error_handler=None, raw=False, consumer_config=None, publisher_config=None):
+    def __init__(self, name, scope='global', label=None, xspace=None, process=None, group=None, handler=None, error_handler=None, raw=False, consumer_config=None, publisher_config=None, prefetch_count=None, max_in_flight=None):
         """
         @param label descriptive label for the receiver
         @param name the actual exchange name. Used for routing
@@ -76,6 +85,10 @@ class Receiver(BasicLifecycleObject):
         @param consumer_config  Additional Consumer configuration params. Used by _init_receiver, these params take precedence over any
                                 other config.
         @param publisher_config Additional Publisher configuration params, used by send()
+        @param prefetch_count Number of unacknowledged messages the broker delivers at a time. If more than
+                              one, messages are acknowledged in delivery order
+        @param max_in_flight Maximum number of request messages processed at a time, 0 for no limit. Further
+                             requests wait in the receiver; other messages, eg. RPC replies, are never held
         """
         BasicLifecycleObject.__init__(self)
 
@@ -89,6 +102,8 @@ class Receiver(BasicLifecycleObject):
         self.raw = raw
         self.consumer_config  = consumer_config if consumer_config is not None else {}
         self.publisher_config = publisher_config if publisher_config is not None else {}
+        self.prefetch_count = PREFETCH_COUNT if prefetch_count is None else int(prefetch_count)
+        self.max_in_flight = MAX_IN_FLIGHT if max_in_flight is None else int(max_in_flight)
 
         self.handlers = []
         self.error_handlers = []
@@ -107,6 +122,10 @@ class Receiver(BasicLifecycleObject):
         # A Deferred to await processing completion after of deactivate
         self.completion_deferred = None
 
+        # Requests in processing, and (message, deferred) waiting for one to finish
+        self.in_flight = 0
+        self.waiting_messages = deque()
+
     @defer.inlineCallbacks
     def attach(self, *args, **kwargs):
         """
@@ -138,6 +157,7 @@ class Receiver(BasicLifecycleObject):
 
         # copy and update receiver_config with the stored consumer_config
         receiver_config = receiver_config.copy()
+        receiver_config['prefetch_count'] = self.prefetch_count
         receiver_config.update(self.consumer_config)
 
         if store_config:
@@ -199,7 +219,6 @@ class Receiver(BasicLifecycleObject):
     def add_error_handler(self, callback):
         self.error_handlers.append(callback)
 
-    @defer.inlineCallbacks
     def receive(self, msg):
         """
         @brief entry point for received messages; callback from Carrot. All
@@ -207,12 +226,50 @@ class Receiver(BasicLifecycleObject):
         @note is called from carrot as normal method; no return expected
         @param msg instance of carrot.backends.txamqp.Message
         """
+        is_request = self._is_request(msg)
+        if not is_request:
+            return self._dispatch(msg, False)
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            # Wait for a request in processing to finish
+            d = defer.Deferred()
+            self.waiting_messages.append((msg, d))
+            return d
+
+        return self._dispatch(msg, True)
+
+    def _is_request(self, msg):
+        payload = msg.payload
+        return not isinstance(payload, dict) or payload.get('performative', 'request') == 'request'
+
+    def _dispatch(self, msg, is_request):
+        """
+        @brief Processes a message in its own request context. Replies in an
+            ongoing conversation of the process continue in the context it was
+            started in.
+        """
+        context = None
+        conv_manager = getattr(self.process, 'conv_manager', None)
+        if conv_manager is not None and not is_request:
+            context = conv_manager.get_context(msg.payload.get('conv-id', None))
+
+        if context is None:
+            context = RequestContext()
+
+        if not is_request:
+            return request.call_in_context(context, self._do_receive, msg)
 
-        # Wrapping the handler in a thread to allow thread-local context during message processing.
-        def do_receive_and_wait():
-            threads.blockingCallFromThread(reactor, self._do_receive, msg)
+        self.in_flight += 1
+        d = request.call_in_context(context, self._do_receive, msg)
+        d.addBoth(self._request_done)
+        return d
 
-        yield threads.deferToThread(do_receive_and_wait)
+    def _request_done(self, result):
+        self.in_flight -= 1
+        if self.waiting_messages and (not self.max_in_flight or self.in_flight < self.max_in_flight):
+            msg, d = self.waiting_messages.popleft()
+            self._dispatch(msg, True).chainDeferred(d)
+        return result
 
     @defer.inlineCallbacks
     def _do_receive(self, msg):
@@ -246,7 +303,7 @@ class Receiver(BasicLifecycleObject):
                              content=data,
                              process=self.process,
                              )
-            inv1 = yield ioninit.container_instance.interceptor_system.process(inv)
+            inv1 = yield request.bind(ioninit.container_instance.interceptor_system.process(inv))
             msg = inv1.message
             data = inv1.content
 
@@ -255,7 +312,7 @@ class Receiver(BasicLifecycleObject):
                 log.info("Message error! to=%s op=%s" % (data.get('receiver',None), data.get('op',None)))
                 try:
                     for error_handler in self.error_handlers:
-                        yield defer.maybeDeferred(error_handler, data, msg, inv1.code)
+                        yield request.bind(defer.maybeDeferred(error_handler, data, msg, inv1.code))
                 finally:
                     del self.rec_messages[id(msg)]
             else:
@@ -309,7 +366,7 @@ class Receiver(BasicLifecycleObject):
 
                 # If this is a GPB message add it to the process workbench
                 encoding = data.get('encoding', None)
-                if encoding == ION_R1_GPB:
+                if encoding in ION_R1_GPB_ENCODINGS:
 
                     if workbench is None:
                         raise ReceiverError('Can not receive a GPB message in a process which does not have a workbench!')
@@ -324,7 +381,7 @@ class Receiver(BasicLifecycleObject):
                 # Make the calls into the application code (e.g. process receive)
                 try:
                     for handler in self.handlers:
-                        yield defer.maybeDeferred(handler, data, msg)
+                        yield request.bind(defer.maybeDeferred(handler, data, msg))
                 finally:
 
 
@@ -434,6 +491,8 @@ class Receiver(BasicLifecycleObject):
             else:
                 # call flow: Container.send -> ExchangeManager.send -> ProcessExchangeSpace.send
                 yield ioninit.container_instance.send(msg.get('receiver'), msg, publisher_config=self.publisher_config)
+                for callback in inv1.sent_callbacks:
+                    callback()
         except Exception, ex:
             log.exception("Send error")
         else:
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/messaging/test/benchmark_receiver.py
+@brief Receiver message throughput. Not part of the unit tests, run it with
+trial ion.core.messaging.test.benchmark_receiver
+"""
+
+import time
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task, threads
+
+from ion.core import ioninit
+from ion.core.messaging.receiver import Receiver
+from ion.core.ioninit import request
+from ion.core.messaging.test.test_receiver import FakeContainer, FakeMessage
+
+
+class ReceiverThroughputBenchmark(unittest.TestCase):
+    """
+    Messages per second through Receiver.receive, compared with handing each message to a thread
+    and back to the reactor as the receiver used to do to get a thread local request context.
+    """
+
+    nmessages = 2000
+
+    def setUp(self):
+        self.patch(ioninit, 'container_instance', FakeContainer())
+
+    def _receiver(self, delay):
+
+        @defer.inlineCallbacks
+        def handler(data, msg):
+            user_id = data['user-id']
+            request.user_id = user_id
+            if delay:
+                # waiting on I/O, eg. an RPC
+                yield request.bind(task.deferLater(reactor, delay, lambda: None))
+            if request.user_id != user_id:
+                self.mismatched += 1
+            yield msg.ack()
+
+        return Receiver('benchmark', handler=handler)
+
+    @defer.inlineCallbacks
+    def _run(self, receive):
+        self.mismatched = 0
+        t0 = time.time()
+        yield defer.DeferredList([receive(FakeMessage(str(i))) for i in range(self.nmessages)], fireOnOneErrback=True)
+        defer.returnValue(self.nmessages / (time.time() - t0))
+
+    @defer.inlineCallbacks
+    def _compare(self, delay):
+        receiver = self._receiver(delay)
+
+        def thread_receive(msg):
+            def do_receive_and_wait():
+                threads.blockingCallFromThread(reactor, receiver._do_receive, msg)
+            return threads.deferToThread(do_receive_and_wait)
+
+        before = yield self._run(thread_receive)
+        print '\n%d messages, handler waits %.3f seconds:' % (self.nmessages, delay)
+        print 'Thread per message: %.1f messages/second, %d handlers saw the wrong user-id' % (before, self.mismatched)
+
+        after = yield self._run(receiver.receive)
+        print 'Reactor context: %.1f messages/second, %d handlers saw the wrong user-id' % (after, self.mismatched)
+
+        defer.returnValue((before, after))
+
+    @defer.inlineCallbacks
+    def test_throughput(self):
+        before, after = yield self._compare(0)
+        self.assertEqual(self.mismatched, 0)
+
+    @defer.inlineCallbacks
+    def test_throughput_waiting_handler(self):
+        # a thread per message caps the messages in processing at the thread pool size
+        before, after = yield self._compare(0.01)
+        self.assertEqual(self.mismatched, 0)
+        self.assertTrue(after > before)
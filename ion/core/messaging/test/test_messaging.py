@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/messaging/test/test_messaging.py
+@brief Tests for publisher pooling and ordered acks in the messaging layer
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from txamqp.client import Closed
+
+from ion.core.messaging.messaging import ProcessExchangeSpace, AckSequencer
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.closed = False
+        self.declared = []
+        self.published = []
+        self.acked = []
+
+    def channel_open(self):
+        return defer.succeed(None)
+
+    def exchange_declare(self, **kwargs):
+        self.declared.append(kwargs['exchange'])
+        return defer.succeed(None)
+
+    def basic_publish(self, **kwargs):
+        if self.closed:
+            return defer.fail(Closed('channel closed'))
+        self.published.append(kwargs['routing_key'])
+        return defer.succeed(None)
+
+    def channel_close(self):
+        self.closed = True
+        return defer.succeed(None)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+        return defer.succeed(None)
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.channels = []
+
+    def channel(self):
+        chan = FakeChannel()
+        self.channels.append(chan)
+        return chan
+
+
+class FakeMessageSpace(object):
+
+    def __init__(self):
+        self.client = FakeClient()
+
+
+class PublisherPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message_space = FakeMessageSpace()
+        self.ex_space = ProcessExchangeSpace(self.message_space, 'magnet.topic')
+        self.pool = self.ex_space.publisher_pool
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        yield self.ex_space.send('a', 'hello')
+        yield self.ex_space.send('b', 'hello')
+        yield self.ex_space.send('a', 'hello')
+
+        channels = self.message_space.client.channels
+        self.assertEqual(len(channels), 1)
+        self.assertEqual(channels[0].declared, ['magnet.topic'])
+        self.assertEqual(channels[0].published, ['a', 'b', 'a'])
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['sent'], 3)
+
+    @defer.inlineCallbacks
+    def test_keyed_by_config(self):
+        yield self.ex_space.send('a', 'hello')
+        yield self.ex_space.send('a', 'hello', publisher_config={'exchange': 'other.topic'})
+        yield self.ex_space.send('a', 'hello', publisher_config={'exchange': 'other.topic', 'delivery_mode': 2})
+
+        channels = self.message_space.client.channels
+        self.assertEqual(len(channels), 3)
+        # the second publisher on other.topic does not declare it again
+        self.assertEqual([c.declared for c in channels], [['magnet.topic'], ['other.topic'], []])
+        self.assertEqual(self.pool.stats()['declared'], 2)
+
+    @defer.inlineCallbacks
+    def test_concurrent_open(self):
+        yield defer.DeferredList([self.ex_space.send(str(i), 'hello') for i in range(5)])
+
+        self.assertEqual(len(self.message_space.client.channels), 1)
+        self.assertEqual(len(self.message_space.client.channels[0].published), 5)
+
+    @defer.inlineCallbacks
+    def test_recover_closed_channel(self):
+        yield self.ex_space.send('a', 'hello')
+
+        # broker closed the channel between sends
+        self.message_space.client.channels[0].closed = True
+        yield self.ex_space.send('a', 'hello')
+
+        channels = self.message_space.client.channels
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(channels[1].declared, ['magnet.topic'])
+        self.assertEqual(channels[1].published, ['a'])
+        self.assertEqual(self.pool.stats()['recovered'], 1)
+
+    @defer.inlineCallbacks
+    def test_new_connection(self):
+        yield self.ex_space.send('a', 'hello')
+
+        self.ex_space.client = FakeClient()
+        yield self.ex_space.send('a', 'hello')
+
+        self.assertEqual(self.ex_space.client.channels[0].declared, ['magnet.topic'])
+        self.assertEqual(self.pool.stats()['opened'], 2)
+
+
+class AckSequencerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.acks = AckSequencer(self.channel)
+        for tag in range(1, 5):
+            self.acks.delivered(tag)
+
+    def test_in_order(self):
+        self.acks.ack(1)
+        self.acks.ack(2)
+        self.assertEqual(self.channel.acked, [(1, True), (2, True)])
+        self.assertEqual(len(self.acks), 2)
+
+    def test_out_of_order(self):
+        self.acks.ack(3)
+        self.acks.ack(2)
+        self.assertEqual(self.channel.acked, [])
+
+        # one ack covers the messages finished before
+        self.acks.ack(1)
+        self.assertEqual(self.channel.acked, [(3, True)])
+
+        self.acks.ack(4)
+        self.assertEqual(self.channel.acked, [(3, True), (4, True)])
+        self.assertEqual(len(self.acks), 0)
+
+    def test_settled(self):
+        self.acks.ack(2)
+        self.acks.settle(3)
+        self.acks.settle(1)
+        # the rejected message is not used as the multiple ack tag
+        self.assertEqual(self.channel.acked, [(2, True)])
+
+        self.acks.settle(4)
+        self.assertEqual(self.channel.acked, [(2, True)])
+        self.assertEqual(len(self.acks), 0)
+
+    def test_unknown_tag(self):
+        self.acks.ack(7)
+        self.assertEqual(self.channel.acked, [(7, False)])
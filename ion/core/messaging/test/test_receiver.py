@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+@file ion/core/messaging/test/test_receiver.py
+@brief Receiver message dispatch: the request context and the limit on requests in processing
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from ion.core import ioninit
+from ion.core.messaging.receiver import Receiver
+from ion.core.ioninit import request
+
+
+class FakeMessage(object):
+
+    def __init__(self, user_id):
+        self.payload = {'user-id': user_id, 'conv-id': 'conv-' + user_id, 'protocol': 'none', 'op': 'noop'}
+        self._state = 'RECEIVED'
+
+    def ack(self):
+        self._state = 'ACKED'
+        return defer.succeed(None)
+
+
+class PassInterceptorSystem(object):
+
+    def process(self, inv):
+        return defer.succeed(inv)
+
+
+class FakeContainer(object):
+
+    def __init__(self):
+        self.interceptor_system = PassInterceptorSystem()
+
+
+class ReceiverRequestContextTest(unittest.TestCase):
+    """
+    Each message is handled in its own request context, which follows the handler across the I/O it waits on.
+    @see benchmark_receiver for the throughput comparison
+    """
+
+    nmessages = 50
+
+    def setUp(self):
+        self.patch(ioninit, 'container_instance', FakeContainer())
+
+    @defer.inlineCallbacks
+    def test_request_context(self):
+        mismatched = []
+
+        @defer.inlineCallbacks
+        def handler(data, msg):
+            user_id = data['user-id']
+            request.user_id = user_id
+            # waiting on I/O, eg. an RPC
+            yield request.bind(task.deferLater(reactor, 0.001 * (int(user_id) % 5), lambda: None))
+            if request.user_id != user_id:
+                mismatched.append(user_id)
+            yield msg.ack()
+
+        receiver = Receiver('context', handler=handler)
+        msgs = [FakeMessage(str(i)) for i in range(self.nmessages)]
+        yield defer.DeferredList([receiver.receive(msg) for msg in msgs], fireOnOneErrback=True)
+
+        self.assertEqual(mismatched, [])
+        self.assertEqual([msg._state for msg in msgs], ['ACKED'] * self.nmessages)
+
+
+class ReceiverInFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(ioninit, 'container_instance', FakeContainer())
+
+        self.waiting = []
+        self.handled = []
+
+        def handler(data, msg):
+            self.handled.append(data['user-id'])
+            d = defer.Deferred()
+            d.addCallback(lambda _: msg.ack())
+            self.waiting.append(d)
+            return d
+
+        self.receiver = Receiver('in_flight', handler=handler, max_in_flight=2)
+
+    def test_max_in_flight(self):
+        msgs = [FakeMessage(str(i)) for i in range(4)]
+        ds = [self.receiver.receive(msg) for msg in msgs]
+
+        self.assertEqual(self.handled, ['0', '1'])
+        self.assertEqual(self.receiver.in_flight, 2)
+        self.assertEqual(len(self.receiver.waiting_messages), 2)
+
+        self.waiting[0].callback(None)
+        self.assertEqual(self.handled, ['0', '1', '2'])
+
+        # replies are never held back
+        reply = FakeMessage('reply')
+        reply.payload['performative'] = 'inform_result'
+        self.receiver.receive(reply)
+        self.assertEqual(self.handled, ['0', '1', '2', 'reply'])
+        self.assertEqual(self.receiver.in_flight, 2)
+
+        for d in self.waiting[1:]:
+            if not d.called:
+                d.callback(None)
+        self.waiting[-1].callback(None)
+
+        self.assertEqual(self.handled, ['0', '1', '2', 'reply', '3'])
+        self.assertEqual(self.receiver.in_flight, 0)
+        return defer.DeferredList(ds)
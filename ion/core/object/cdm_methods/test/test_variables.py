@@ -22,7 +22,30 @@ CDM_ARRAY_STRUC_TYPE = create_type_identifier(object_id=10025, version=1)
 CDM_BOUNDED_ARRAY_TYPE = create_type_identifier(object_id=10021, version=1)
 CDM_F64_ARRAY_TYPE = create_type_identifier(object_id=10014, version=1)
 
-from ion.core.object.cdm_methods.variables import _flatten_index
+from ion.core.object.cdm_methods import variables
+from ion.core.object.cdm_methods.variables import _flatten_index, BoundedArrayIndex
+
+
+class BoundedArrayIndexTest(unittest.TestCase):
+
+    def test_intersecting(self):
+        # Out of order and overlapping in the first dimension
+        index = BoundedArrayIndex([[(30, 30), (0, 10)],
+                                   [(0, 50), (0, 5)],
+                                   [(0, 30), (5, 5)],
+                                   [(60, 30), (0, 10)]])
+
+        self.assertEqual(index.intersecting([(0, 1), (0, 1)]), [1])
+        self.assertEqual(index.intersecting([(35, 1), (7, 1)]), [0])
+        self.assertEqual(index.intersecting([(40, 30), (0, 10)]), [0, 1, 3])
+        self.assertEqual(index.intersecting([(0, 90), (5, 5)]), [0, 2, 3])
+        self.assertEqual(index.intersecting([(90, 10), (0, 10)]), [])
+        self.assertEqual(index.intersecting([(10, 0), (0, 10)]), [])
+
+    def test_scalar(self):
+        index = BoundedArrayIndex([[]])
+        self.assertEqual(index.intersecting([]), [0])
+
 
 class CdmVariableTest(IonTestCase):
     """
@@ -255,6 +278,58 @@ class CdmVariableTest(IonTestCase):
                             count += 1
     
 
+    @defer.inlineCallbacks
+    def test_GetSlice_1D_multiple_BA(self):
+        yield self.setup_1D_multiple_BA()
+
+        values = self.var.GetSlice([0], [90])
+        self.assertEqual(list(values), range(90))
+
+        values = self.var.GetSlice([25], [40], [3])
+        self.assertEqual(list(values), range(25, 65, 3))
+
+    @defer.inlineCallbacks
+    def test_GetSlice_3D_multiple_BA(self):
+        num_arrs = 13
+        num_vals = 17
+        yield self.setup_nD_multiple_BA(3, num_arrs, num_vals)
+
+        values = self.var.GetSlice([2, 1, 0], [5, 10, 17], [2, 3, 4])
+        self.assertEqual(values.shape, (3, 4, 5))
+        for i, a in enumerate(range(2, 7, 2)):
+            for j, b in enumerate(range(1, 11, 3)):
+                for k, c in enumerate(range(0, 17, 4)):
+                    self.assertEqual(values[i, j, k], self.var.GetValue(a, b, c))
+
+    @defer.inlineCallbacks
+    def test_GetSlice_not_covered(self):
+        yield self.setup_1D_multiple_BA()
+
+        values = self.var.GetSlice([80], [20])
+        self.assertEqual(list(values.compressed()), range(80, 90))
+        self.assertEqual(values.mask.sum(), 10)
+
+        self.assertRaises(OOIObjectError, self.var.GetSlice, [0, 0], [1, 1])
+
+    @defer.inlineCallbacks
+    def test_GetIntersectingBoundedArrays(self):
+        yield self.setup_1D_multiple_BA()
+        bas = list(self.var.content.bounded_arrays)
+
+        coverage = yield self.var.Repository.create_object(CDM_BOUNDED_ARRAY_TYPE)
+        coverage.bounds.add()
+        coverage.bounds[0].origin = 20
+        coverage.bounds[0].size = 20
+
+        self.assertEqual(self.var.GetIntersectingBoundedArrays(coverage), [bas[0].MyId, bas[1].MyId])
+
+        coverage.bounds[0].origin = 90
+        self.assertEqual(self.var.GetIntersectingBoundedArrays(coverage), [])
+
+    if variables.numpy is None:
+        test_GetSlice_1D_multiple_BA.skip = test_GetSlice_3D_multiple_BA.skip = \
+            test_GetSlice_not_covered.skip = 'numpy is not installed'
+
     def test_fail_flatten_index(self):
         self.assertRaises(AssertionError, _flatten_index, None, [])
         self.assertRaises(AssertionError, _flatten_index, [], None)
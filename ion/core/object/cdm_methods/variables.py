@@ -4,19 +4,140 @@
 @brief Wrapper methods for the cdm variable object
 @author David Stuebe
 @author Tim LaRocque
-TODO: Implement get_intersecting...
 """
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Get the object decorator used on wrapper methods!
 from ion.core.object.object_utils import _gpb_source
 
 
 from ion.core.object.object_utils import OOIObjectError
+from ion.core.object.object_utils import CDM_ARRAY_INT32_TYPE, CDM_ARRAY_UINT32_TYPE, CDM_ARRAY_INT64_TYPE, CDM_ARRAY_UINT64_TYPE, CDM_ARRAY_FLOAT32_TYPE, CDM_ARRAY_FLOAT64_TYPE
+from ion.util.cache import LRUDict
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
 from ion.core.object.cdm_methods import group
 
+if numpy is not None:
+    NUMPY_DTYPES = {CDM_ARRAY_INT32_TYPE.object_id: numpy.int32,
+                    CDM_ARRAY_UINT32_TYPE.object_id: numpy.uint32,
+                    CDM_ARRAY_INT64_TYPE.object_id: numpy.int64,
+                    CDM_ARRAY_UINT64_TYPE.object_id: numpy.uint64,
+                    CDM_ARRAY_FLOAT32_TYPE.object_id: numpy.float32,
+                    CDM_ARRAY_FLOAT64_TYPE.object_id: numpy.float64}
+else:
+    NUMPY_DTYPES = {}
+
+
+class BoundedArrayIndex(object):
+    """
+    Interval index over the bounds of the bounded arrays in an array structure. The arrays are sorted by their
+    origin in the first dimension, with the running maximum of their ends, so the arrays which can intersect a
+    range are found by bisection and only those are compared in every dimension.
+    """
+
+    def __init__(self, bounds):
+        """
+        @param bounds a list with the bounds of each bounded array - a list of (origin, size) per dimension
+        """
+        self._positions = sorted(range(len(bounds)), key=lambda i: bounds[i][0][0] if bounds[i] else 0)
+        self._bounds = [bounds[i] for i in self._positions]
+        self._origins = [b[0][0] if b else 0 for b in self._bounds]
+
+        self._max_ends = []
+        max_end = 0
+        for b in self._bounds:
+            if b:
+                max_end = max(max_end, b[0][0] + b[0][1])
+            self._max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def intersecting(self, ranges):
+        """
+        @param ranges a list of (origin, size) per dimension
+        @retval the positions in the array structure of the bounded arrays which intersect ranges, in order
+        """
+        if not ranges:
+            # A scalar - every bounded array covers it
+            return range(len(self._bounds))
+
+        origin, size = ranges[0]
+        lo = bisect.bisect_right(self._max_ends, origin)
+        hi = bisect.bisect_left(self._origins, origin + size)
+
+        result = []
+        for i in xrange(lo, hi):
+            for (rorigin, rsize), (borigin, bsize) in zip(ranges, self._bounds[i]):
+                if rorigin >= borigin + bsize or borigin >= rorigin + rsize:
+                    break
+            else:
+                result.append(self._positions[i])
+
+        result.sort()
+        return result
+
+
+# Indexes of committed array structures, which can not change, keyed by their sha1
+_bounded_array_indexes = LRUDict(1000)
+
+def _get_bounded_array_index(content):
+    """
+    @retval the BoundedArrayIndex of an array structure
+    """
+    key = None
+    if not content.Modified:
+        key = content.MyId
+        index = _bounded_array_indexes.get(key)
+        if index is not None:
+            return index
+
+    index = BoundedArrayIndex([[(b.origin, b.size) for b in ba.bounds] for ba in content.bounded_arrays])
+    if key is not None:
+        _bounded_array_indexes[key] = index
+    return index
+
+
+def hyperslab_slices(request_bounds, array_bounds):
+    """
+    Maps a strided request onto a bounded array. Works per dimension on the intersection of the
+    requested range and the range covered by the bounded array, keeping only the request indices
+    which fall on the stride.
+
+    @param request_bounds   A list of (origin, size, stride) tuples, one per dimension.
+    @param array_bounds     A list of (origin, size) tuples for the bounded array, one per dimension.
+    @retval A tuple (target slices, source slices) of slice objects, one per dimension, into the
+            stridden target array and the bounded array. None if no requested value lies in the array.
+    """
+    target = []
+    source = []
+    for (rorigin, rsize, rstride), (borigin, bsize) in zip(request_bounds, array_bounds):
+
+        start = max(borigin, rorigin)
+        end = min(borigin + bsize, rorigin + rsize)
+
+        # first index relative to the request origin which is on the stride
+        first = start - rorigin
+        first += -first % rstride
+
+        if rorigin + first >= end:
+            return None
+
+        count = (end - rorigin - first + rstride - 1) // rstride
+        src_start = rorigin + first - borigin
+
+        target.append(slice(first // rstride, first // rstride + count))
+        source.append(slice(src_start, src_start + (count - 1) * rstride + 1, rstride))
+
+    return tuple(target), tuple(source)
+
 #--------------------------------------#
 # Wrapper_Variable Specialized Methods #
 #--------------------------------------#
@@ -77,39 +198,91 @@ def GetValue(self, *args):
     as.getValue(1,3,9)
     """
     
-    # @todo: Need tests for multidim arrays
-    # @todo: Check the rank outside the for loop
     # @todo: Check to make sure args are integers!
 
-    value = None
-    
-    for ba in self.content.bounded_arrays:
-    
+    content = self.content
+    positions = _get_bounded_array_index(content).intersecting([(index, 1) for index in args])
+    if not positions:
+        return None
+
+    # We now have the the ndarray of interest..  extract the value!
+    ba = content.bounded_arrays[positions[0]]
+
+    # Create a list of this bounded_array's sizes and use origin to determine
+    # the given indices position in the ndarray
+    indices = []
+    shape = []
+    for index, bounds in zip(args, ba.bounds):
+          indices.append(index - bounds.origin)
+          shape.append(bounds.size)
+
+    # Find the flattened index (make sure to apply the origin values as an offset!)
+    flattened_index = _flatten_index(indices, shape)
+
+    # Grab the value from the ndarray
+    return ba.ndarray.value[flattened_index]
+
+
+@_gpb_source
+def GetSlice(self, origin, size, stride=None):
+    """
+    @brief Get a hyperslab of the values of a variable as a numpy array
+    @param self - a cdm variable object
+    @param origin - a list of the first index in each dimension
+    @param size - a list of the number of indices in each dimension
+    @param stride - an optional list of the step in each dimension, 1 by default
+    @retval a numpy array with ceil(size / stride) values in each dimension. If bounded arrays do not cover all of the
+    requested indices it is a masked array with the missing values masked.
+
+    usage for the first 100 days of a time series:
+    flow.GetSlice([0], [100])
+    """
+    if numpy is None:
+        raise OOIObjectError('GetSlice requires numpy')
+
+    if stride is None:
+        stride = [1] * len(origin)
+
+    rank = len(self.shape)
+    if len(origin) != rank or len(size) != rank or len(stride) != rank:
+        raise OOIObjectError('GetSlice needs an origin, size and stride for each of the %d dimensions' % rank)
+
+    for sz, st in zip(size, stride):
+        if sz < 0 or st < 1:
+            raise OOIObjectError('Invalid size or stride passed to GetSlice: size %s, stride %s' % (size, stride))
 
-        for index, bounds in zip(args, ba.bounds):
-            if bounds.origin > index or index >= bounds.origin + bounds.size :
-                break
+    request = zip(origin, size, stride)
+    targetshape = tuple([(sz + st - 1) // st for o, sz, st in request])
 
-        else:
-            # We now have the the ndarray of interest..  extract the value!
+    content = self.content
+    positions = _get_bounded_array_index(content).intersecting([(o, sz) for o, sz, st in request])
 
-            # Create a list of this bounded_array's sizes and use origin to determine
-            # the given indices position in the ndarray
-            indices = []
-            shape = []
-            for index, bounds in zip(args, ba.bounds):
-                  indices.append(index - bounds.origin)  
-                  shape.append(bounds.size)  
-            
-            # Find the flattened index (make sure to apply the origin values as an offset!)
-            flattened_index = _flatten_index(indices, shape)
-            
-            # Grab the value from the ndarray
-            value = ba.ndarray.value[flattened_index]
-            break
+    target = None
+    filled = numpy.zeros(targetshape, dtype=bool)
+    for position in positions:
+        ba = content.bounded_arrays[position]
+        array_bounds = [(bounds.origin, bounds.size) for bounds in ba.bounds]
 
+        slices = hyperslab_slices(request, array_bounds)
+        if slices is None:
+            # All of the requested indices in this array are strided out
+            continue
+        target_slices, source_slices = slices
 
-    return value
+        ndarray = ba.ndarray
+        if target is None:
+            target = numpy.empty(targetshape, dtype=NUMPY_DTYPES.get(ndarray.ObjectType.object_id, object))
+
+        source = numpy.asarray(ndarray.value[:], dtype=target.dtype).reshape([sz for o, sz in array_bounds])
+        target[target_slices] = source[source_slices]
+        filled[target_slices] = True
+
+    if target is None:
+        target = numpy.empty(targetshape)
+
+    if not filled.all():
+        return numpy.ma.masked_array(target, mask=~filled)
+    return target
 
 
 @_gpb_source
@@ -118,15 +291,16 @@ def GetIntersectingBoundedArrays(self, bounded_array):
     @brief get the SHA1 id of the bounded arrays which intersect the give coverage.
     @param self - a cdm variable object
     @param bounded_array - a bounded array which specifies an index space coverage of interest
+    @retval a list of the MyId of the intersecting bounded arrays - the sha1 for committed content
 
     usage for a 3Dimensional variable:
-    as.getValue(1,3,9)
+    var.GetIntersectingBoundedArrays(ba)
     """
+    content = self.content
+    positions = _get_bounded_array_index(content).intersecting([(b.origin, b.size) for b in bounded_array.bounds])
 
     # Get the MyId attribute of the bounded arrays that intersect - that will be the sha1 name for that BA...
-
-    sha1_list = []
-    return sha1_list
+    return [content.bounded_arrays[position].MyId for position in positions]
 
 
 def _flatten_index(indices, shape):
@@ -6,6 +6,9 @@
 @brief Interceptor for encoding and decoding ION messages
 """
 
+import array
+import struct
+
 from twisted.internet import defer
 
 import ion.util.ionlog
@@ -13,25 +16,151 @@ log = ion.util.ionlog.getLogger(__name__)
 
 from ion.core.intercept.interceptor import EnvelopeInterceptor
 from google.protobuf.internal import decoder
+from google.protobuf.internal import encoder
 
 from ion.core.object import gpb_wrapper
 from ion.core.object import repository
+from ion.core.object import workbench
 from net.ooici.core.container import container_pb2
 from ion.core.object import object_utils
 from ion.core.messaging import message_client
+from ion.util.cache import LRUDict
+
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
 
 ION_MESSAGE_TYPE = object_utils.create_type_identifier(object_id=11, version=1)
 
 STRUCTURE_ELEMENT_TYPE = object_utils.create_type_identifier(object_id=1, version=1)
 STRUCTURE_TYPE = object_utils.create_type_identifier(object_id=2, version=1)
+BLOBS_MESSAGE_TYPE = object_utils.create_type_identifier(object_id=52, version=1)
 
 ION_R1_GPB = 'ION R1 GPB'
+ION_R1_GPB_STREAM = 'ION R1 GPB STREAM'
+
+# Both encodings carry a repository structure
+ION_R1_GPB_ENCODINGS = (ION_R1_GPB, ION_R1_GPB_STREAM)
+
+# The stream encoding is off by default - peers that only understand the single container can not read it
+STREAM_ENCODING = CONF.getValue('stream_encoding', False)
+
+# Target size in bytes for each frame of a streamed structure
+FRAME_SIZE = CONF.getValue('frame_size', 2**20)
+
+# Send key references for elements the receiver has recently been sent. Both ends must run a codec which
+# understands references, so this is off by default.
+DEDUP = CONF.getValue('dedup', False)
+
+# Elements smaller than this are always sent in full - the reference would not save much
+DEDUP_MIN_SIZE = CONF.getValue('dedup_min_size', 256)
+
+# Number of keys remembered per peer before the oldest generation of the filter is dropped
+DEDUP_FILTER_CAPACITY = CONF.getValue('dedup_filter_capacity', 100000)
+
+# Number of sender/receiver pairs to keep filters for
+DEDUP_PEERS = CONF.getValue('dedup_peers', 64)
+
+# A structure element with this object id carries only the key of an element the receiver should already hold
+REFERENCE_OBJECT_ID = 0
 
 class CodecError(Exception):
     """
     An error class for problems that occur in the codec
     """
 
+class UnresolvedReferenceError(CodecError):
+    """
+    Raised when the content refers to structure elements which can not be found locally
+    """
+    def __init__(self, msg, keys):
+        CodecError.__init__(self, msg)
+        self.keys = keys
+
+
+class KeyFilter(object):
+    """
+    Bloom filter of the sha1 keys recently sent to a peer. The keys are already uniformly distributed so the bit
+    positions are sliced out of the key rather than hashed again. Two generations are kept - when the current one
+    is full it becomes the previous one, so the filter forgets keys which have not been sent for a while.
+
+    A false positive only costs the receiver a fetch_blobs round trip. The receiver may also have dropped an element
+    the filter says it holds, so the sender pins every element it sends by key - see workbench.get_element_pins.
+    """
+
+    def __init__(self, capacity=DEDUP_FILTER_CAPACITY, bits_per_key=10, hashes=4):
+
+        assert 0 < hashes <= 5, 'A sha1 key only has enough bytes for five positions'
+        self.capacity = max(int(capacity), 1)
+        self.hashes = hashes
+        self.nbits = self.capacity * bits_per_key
+
+        self._current = self._new_bits()
+        self._previous = self._new_bits()
+        self._count = 0
+
+    def _new_bits(self):
+        # An array of bytes rather than a bytearray, which is not in Python 2.5
+        return array.array('B', [0]) * (self.nbits / 8 + 1)
+
+    def _positions(self, key):
+        nbits = self.nbits
+        return [struct.unpack_from('!I', key, 4*i)[0] % nbits for i in xrange(self.hashes)]
+
+    def _test(self, bits, positions):
+        for pos in positions:
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        if len(key) != 20:
+            return False
+        positions = self._positions(key)
+        return self._test(self._current, positions) or self._test(self._previous, positions)
+
+    def add(self, key):
+        if len(key) != 20:
+            return
+
+        positions = self._positions(key)
+        if self._test(self._current, positions):
+            return
+
+        if self._count >= self.capacity:
+            self._previous = self._current
+            self._current = self._new_bits()
+            self._count = 0
+
+        bits = self._current
+        for pos in positions:
+            bits[pos >> 3] |= (1 << (pos & 7))
+        self._count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def clear(self):
+        self._current = self._new_bits()
+        self._previous = self._new_bits()
+        self._count = 0
+
+
+# Key filters by (reply-to, receiver) - the reply-to address is where the receiver fetches any reference it can not
+# resolve, so the keys a filter records must have come from that process.
+_peer_filters = LRUDict(DEDUP_PEERS)
+
+def get_peer_filter(sender, receiver):
+    """
+    Get the key filter for messages from sender to receiver
+    """
+    pair = (sender, receiver)
+    key_filter = _peer_filters.get(pair)
+    if key_filter is None:
+        key_filter = KeyFilter()
+        _peer_filters[pair] = key_filter
+    return key_filter
+
 
 class ObjectCodecInterceptor(EnvelopeInterceptor):
     """
@@ -40,21 +169,58 @@ class ObjectCodecInterceptor(EnvelopeInterceptor):
     separate from the process until it finishes the interceptor stack!
     """
     def before(self, invocation):
-
+        """
+        Decode the content. Synchronous unless referenced elements must be resolved.
+        """
         # Only mess with ION_R1_GPB encoded objects...
-        if isinstance(invocation.content, dict) and ION_R1_GPB == invocation.content['encoding']:
+        if isinstance(invocation.content, dict) and invocation.content['encoding'] in ION_R1_GPB_ENCODINGS:
             raw_content = invocation.content['content']
-            unpacked_content = unpack_structure(raw_content)
-                
-            if hasattr(unpacked_content, 'ObjectType') and unpacked_content.ObjectType == ION_MESSAGE_TYPE:
-                # If this content should be returned in a Message Instance
-                unpacked_content = message_client.MessageInstance(unpacked_content.Repository)
 
-            
-            invocation.content['content'] = unpacked_content
+            repo, head, references = _decode(raw_content, invocation.content['encoding'])
+
+            if references:
+                d = self._resolve_references(invocation, repo, references)
+                d.addCallback(lambda _: self._unpack(invocation, repo, head))
+                return d
+
+            self._unpack(invocation, repo, head)
+
+        return invocation
+
+    def _unpack(self, invocation, repo, head):
+        unpacked_content = _load_structure(repo, head)
+
+        if hasattr(unpacked_content, 'ObjectType') and unpacked_content.ObjectType == ION_MESSAGE_TYPE:
+            # If this content should be returned in a Message Instance
+            unpacked_content = message_client.MessageInstance(unpacked_content.Repository)
 
+        invocation.content['content'] = unpacked_content
         return invocation
 
+    @defer.inlineCallbacks
+    def _resolve_references(self, invocation, repo, references):
+        """
+        Find the structure elements the sender only sent by key. Look in the workbench cache of the receiving
+        process first and fetch whatever is left from the sender.
+        """
+        workbench = getattr(invocation.process, 'workbench', None)
+        cache = getattr(workbench, '_workbench_cache', None)
+
+        missing = _resolve_references(repo, references, cache)
+        if not missing:
+            return
+
+        address = invocation.content.get('reply-to') or invocation.content.get('sender')
+        if workbench is None or not address:
+            raise UnresolvedReferenceError('Received key references which can not be resolved in this process!', missing)
+
+        log.info('Codec fetching %d referenced elements from "%s"' % (len(missing), address))
+        elements = yield workbench.fetch_keys(address, missing)
+
+        missing = _resolve_references(repo, missing, elements)
+        if missing:
+            raise UnresolvedReferenceError('The sender did not return all the referenced elements!', missing)
+
     def after(self, invocation):
         """
         Encode a Message Instance to a serialized form.
@@ -68,9 +234,23 @@ class ObjectCodecInterceptor(EnvelopeInterceptor):
             # Turn of access to shared process object Cache
             content.Repository.index_hash.has_cache = False
 
-            invocation.message['content'] = pack_structure(content)
-        
-            invocation.message['encoding'] = ION_R1_GPB
+            # Never send references in reply to a request for the elements themselves
+            key_filter = None
+            sent_keys = None
+            if DEDUP and getattr(content, 'MessageType', None) != BLOBS_MESSAGE_TYPE:
+                key_filter = get_peer_filter(invocation.message.get('reply-to'), invocation.message.get('receiver'))
+                sent_keys = []
+
+            if STREAM_ENCODING:
+                invocation.message['content'] = pack_stream(content, key_filter=key_filter, sent_keys=sent_keys)
+                invocation.message['encoding'] = ION_R1_GPB_STREAM
+            else:
+                invocation.message['content'] = pack_structure(content, key_filter=key_filter, sent_keys=sent_keys)
+                invocation.message['encoding'] = ION_R1_GPB
+
+            # The receiver only has the elements sent in full once the message is actually sent
+            if sent_keys:
+                invocation.sent_callbacks.append(lambda: key_filter.update(sent_keys))
 
             # Turn it back on.
             content.Repository.index_hash.has_cache = True
@@ -80,10 +260,89 @@ class ObjectCodecInterceptor(EnvelopeInterceptor):
 
 
 
-def pack_structure(content):
+def pack_structure(content, key_filter=None, sent_keys=None):
     """
     Pack all children of the content stucture into a message.
     Return the content as a serialized container object.
+    @param key_filter is an optional KeyFilter of the keys the receiver holds. Elements it contains are sent as key
+    references and pinned until the receiver can no longer ask for them. The keys of the elements sent in full are
+    added to it.
+    @param sent_keys is an optional list which collects the keys of the elements sent in full instead of adding them
+    to the key filter, for a caller which adds them once the message is sent.
+    """
+
+    elements = _iter_structure_elements(content)
+
+    root_obj_se = elements.next()
+
+    # only put StructureElements in this, please.
+    obj_set = set(elements)
+
+    container_structure = _pack_container(root_obj_se, obj_set, key_filter, sent_keys)
+    serialized = container_structure.SerializeToString()
+
+    log.debug('pack_structure: Packing Complete!')
+
+    return serialized
+
+def pack_stream(content, frame_size=None, key_filter=None, sent_keys=None):
+    """
+    Pack all children of the content structure as a stream of frames.
+    Return the frames joined as a single string for transport.
+    """
+    serialized = ''.join(iter_pack_stream(content, frame_size, key_filter, sent_keys))
+
+    log.debug('pack_stream: Packing Complete!')
+
+    return serialized
+
+def iter_pack_stream(content, frame_size=None, key_filter=None, sent_keys=None):
+    """
+    Generator which yields the content structure as a sequence of frames.
+
+    Each frame is a varint length prefix followed by a serialized container
+    structure. The first frame carries the head, the remaining frames carry
+    the items. A frame is closed once its items exceed frame_size bytes, so
+    the sender never holds more than one frame of copied element values.
+    @param content is a wrapper or message instance to pack
+    @param frame_size is the target size of a frame in bytes
+    @param key_filter is an optional KeyFilter - see pack_structure
+    @param sent_keys is an optional list - see pack_structure
+    @retval generator of serialized frames
+    """
+    if frame_size is None:
+        frame_size = FRAME_SIZE
+
+    elements = _iter_structure_elements(content)
+
+    cs = object_utils.get_gpb_class_from_type_id(STRUCTURE_TYPE)()
+    _copy_element(elements.next(), cs.head)
+    size = 0
+
+    for item in elements:
+        if _add_item(cs, item, key_filter, sent_keys):
+            size += len(item.value)
+
+        if size >= frame_size:
+            yield _frame(cs)
+            cs = object_utils.get_gpb_class_from_type_id(STRUCTURE_TYPE)()
+            size = 0
+
+    if len(cs.items) > 0 or cs.HasField('head'):
+        yield _frame(cs)
+
+def _frame(cs):
+    """
+    Helper to length delimit a serialized container structure
+    """
+    serialized = cs.SerializeToString()
+    return encoder._VarintBytes(len(serialized)) + serialized
+
+def _iter_structure_elements(content):
+    """
+    Helper for the sender which commits the content if needed and then yields
+    the structure element of the root object followed by each reachable
+    structure element exactly once.
     """
 
     repo = getattr(content, 'Repository', None)
@@ -94,12 +353,12 @@ def pack_structure(content):
         comment='Commiting to send message with wrapper object'
         repo.commit(comment=comment)
 
-    # only put StructureElements in this, please.
-    obj_set=set()
-
     # Get the serialized root object
     root_obj = repo.root_object
-    root_obj_se = repo.index_hash.get(root_obj.MyId)
+    yield repo.index_hash.get(root_obj.MyId)
+
+    # Keys of the elements already yielded
+    sent = set()
 
     items = set([root_obj])
 
@@ -109,43 +368,33 @@ def pack_structure(content):
         log.debug("Codec pack_structure has %d excluded_object_types" % len(content.excluded_object_types))
         excluded_object_types = [x.GPBMessage for x in content.excluded_object_types]
 
-    # Recurse through the DAG and add the keys to a set - obj_set.
+    # Recurse through the DAG and yield each structure element the first time it is found
     while len(items) > 0:
         child_items = set()
         for item in items:
 
-            # Add this item to the set we are sending
-            if item not in obj_set:
-
-                for link in item.ChildLinks:
+            for link in item.ChildLinks:
 
-                    # if this link's key is not in the index_hash, then its type must be in the excluded_type list we
-                    # pull out of the message above. if not, we have an error.
+                # if this link's key is not in the index_hash, then its type must be in the excluded_type list we
+                # pull out of the message above. if not, we have an error.
 
-                    hashobj = repo.index_hash.get(link.key, None)
-                    if hashobj is None:
-                        # link is a CASRef to a GPBType
-                        if link.GPBMessage.type not in excluded_object_types:
-                            raise CodecError("Hashed CREF not found (and not excluded)! Please call David")
-                    else:
-                        # store the object we just pulled out of the index_hash for passing to the _pack_container method
-                        obj_set.add(hashobj)
+                hashobj = repo.index_hash.get(link.key, None)
+                if hashobj is None:
+                    # link is a CASRef to a GPBType
+                    if link.GPBMessage.type not in excluded_object_types:
+                        raise CodecError("Hashed CREF not found (and not excluded)! Please call David")
+                elif hashobj.key not in sent:
+                    sent.add(hashobj.key)
+                    yield hashobj
 
-                        # load this object so we can examine its childlinks - should be simple extraction from
-                        # repo._workspace, but use the public method.
-                        subobj = repo.get_linked_object(link)
-                        child_items.add(subobj)
+                    # load this object so we can examine its childlinks - should be simple extraction from
+                    # repo._workspace, but use the public method.
+                    subobj = repo.get_linked_object(link)
+                    child_items.add(subobj)
 
         items = child_items
 
-    container_structure = _pack_container(root_obj_se, obj_set)
-    serialized = container_structure.SerializeToString()
-
-    log.debug('pack_structure: Packing Complete!')
-
-    return serialized
-
-def _pack_container(head, objects):
+def _pack_container(head, objects, key_filter=None, sent_keys=None):
     """
     Helper for the sender to pack message content into a container in order
     """
@@ -154,44 +403,237 @@ def _pack_container(head, objects):
     cs = object_utils.get_gpb_class_from_type_id(STRUCTURE_TYPE)()
 
 
-    cs.head.key = head.key
+    _copy_element(head, cs.head)
 
-    cs.head.type.object_id =  head.type.object_id
-    cs.head.type.version =  head.type.version
+    for item in objects:
 
-    cs.head.isleaf = head.isleaf
-    cs.head.value = head.value
+        _add_item(cs, item, key_filter, sent_keys)
 
-    for item in objects:
 
-        se = cs.items.add()
+    log.debug('_pack_container: Packed container!')
+    return cs
 
-        # Can not set the pointer directly... must set the components
+def _add_item(cs, item, key_filter, sent_keys=None):
+    """
+    Helper to add an item to a container - either in full or as a key reference if the key filter says the receiver
+    already holds it and the item can be pinned for the receiver to fetch. Returns True if the item was added in full.
+    """
+    if key_filter is None:
+        _copy_element(item, cs.items.add())
+        return True
+
+    size = len(item.value)
+    if size >= DEDUP_MIN_SIZE and item.key in key_filter and \
+            workbench.get_element_pins().pin(item.key, item, size):
+        se = cs.items.add()
         se.key = item.key
         se.isleaf = item.isleaf
-        se.type.object_id = item.type.object_id
-        se.type.version = item.type.version
-
-        # @TODO - How can we measure memory usage here to make sure this is the okay?
-        se.value = item.value # Let python's object manager keep track of the pointer to the big things!
-
+        se.type.object_id = REFERENCE_OBJECT_ID
+        se.type.version = 0
+        se.value = ''
+        return False
+
+    _copy_element(item, cs.items.add())
+    if sent_keys is None:
+        key_filter.add(item.key)
+    else:
+        sent_keys.append(item.key)
+    return True
+
+def _copy_element(item, se):
+    """
+    Helper to copy a wrapped structure element into an unwrapped one
+    """
+    # Can not set the pointer directly... must set the components
+    se.key = item.key
+    se.isleaf = item.isleaf
+    se.type.object_id = item.type.object_id
+    se.type.version = item.type.version
 
-    log.debug('_pack_container: Packed container!')
-    return cs
+    # @TODO - How can we measure memory usage here to make sure this is the okay?
+    se.value = item.value # Let python's object manager keep track of the pointer to the big things!
 
-def unpack_structure(serialized_container):
+def unpack_structure(serialized_container, cache=None):
     """
     Take a serialized container object and load a repository with its contents
+    @param cache is an optional dictionary of structure elements, such as a workbench cache, used to resolve any key
+    references in the container. Raises UnresolvedReferenceError if a reference is not found.
     """
     log.debug('unpack_structure: Unpacking Structure!')
-    head, obj_dict = _unpack_container(serialized_container)
+    repo, head, references = _decode(serialized_container, ION_R1_GPB)
+
+    missing = _resolve_references(repo, references, cache)
+    if missing:
+        raise UnresolvedReferenceError('Could not resolve %d key references in the container!' % len(missing), missing)
+
+    return _load_structure(repo, head)
+
+def _decode(serialized, encoding):
+    """
+    Helper for the receiver - decode either encoding into a new repository.
+    Returns the repository, the head and a list of the keys which were sent as references.
+    """
+    if encoding == ION_R1_GPB_STREAM:
+        stream = StreamDecoder()
+        stream.feed(serialized)
+        stream.check_complete()
+        return stream.repo, stream.head, stream.references
+
+    head, obj_dict = _unpack_container(serialized)
 
     assert len(obj_dict) > 0, 'There should be objects in the container!'
 
+    references = _pop_references(obj_dict)
+
     repo = repository.Repository()
 
     repo.index_hash.update(obj_dict)
 
+    return repo, head, references
+
+def _pop_references(obj_dict):
+    """
+    Helper to remove the key references from a dictionary of unpacked elements
+    """
+    references = [key for key, element in obj_dict.iteritems() if element.type.object_id == REFERENCE_OBJECT_ID]
+    for key in references:
+        del obj_dict[key]
+    return references
+
+def _resolve_references(repo, references, cache):
+    """
+    Helper to put the referenced elements found in cache in the index_hash of the repository.
+    Returns the list of keys which could not be found.
+    """
+    if cache is None:
+        return list(references)
+
+    missing = []
+    index_hash = repo.index_hash
+    for key in references:
+        element = cache.get(key)
+        if element is None:
+            missing.append(key)
+        else:
+            index_hash[key] = element
+
+    return missing
+
+def unpack_stream(frames, cache=None):
+    """
+    Take a streamed structure and load a repository with its contents.
+    @param frames is either the joined string produced by pack_stream or an
+    iterable of string chunks as they arrive. Chunks need not line up with
+    the frame boundaries.
+    @param cache is an optional dictionary used to resolve key references - see unpack_structure
+    """
+    log.debug('unpack_stream: Unpacking Stream!')
+    if isinstance(frames, str):
+        frames = [frames]
+
+    stream = StreamDecoder()
+    for chunk in frames:
+        stream.feed(chunk)
+
+    return stream.finish(cache)
+
+
+class StreamDecoder(object):
+    """
+    Incremental decoder for the stream encoding. Each complete frame is parsed
+    as soon as it has been fed and its structure elements are put straight into
+    the index_hash of a new repository, so only one frame is held as a parsed
+    container at a time.
+    """
+
+    def __init__(self):
+        self.repo = repository.Repository()
+        self.head = None
+        self.references = []
+        self._buffer = ''
+
+    def feed(self, data):
+        """
+        Add data to the stream and decode any complete frames
+        """
+        buf = self._buffer + data if self._buffer else data
+        pos = 0
+        length = len(buf)
+
+        while pos < length:
+            try:
+                frame_len, start = decoder._DecodeVarint(buf, pos)
+            except IndexError:
+                # The varint itself is incomplete
+                break
+            except decoder._DecodeError, de:
+                log.debug('Received invalid stream - decode error: "%s"' % str(de))
+                raise CodecError('Could not decode message content as a GPB structure stream!')
+
+            end = start + frame_len
+            if end > length:
+                break
+
+            self._load_frame(buf[start:end])
+            pos = end
+
+        self._buffer = buf[pos:]
+
+    def _load_frame(self, serialized):
+
+        cs = object_utils.get_gpb_class_from_type_id(STRUCTURE_TYPE)()
+
+        try:
+            cs.ParseFromString(serialized)
+        except decoder._DecodeError, de:
+            log.debug('Received invalid frame - decode error: "%s"' % str(de))
+            raise CodecError('Could not decode message content as a GPB structure frame!')
+
+        index_hash = self.repo.index_hash
+        if cs.HasField('head'):
+            if self.head is not None:
+                raise CodecError('Received a structure stream with more than one head!')
+            self.head = gpb_wrapper.StructureElement(cs.head)
+            index_hash[self.head.key] = self.head
+
+        for se in cs.items:
+            if se.type.object_id == REFERENCE_OBJECT_ID:
+                self.references.append(se.key)
+                continue
+            wse = gpb_wrapper.StructureElement(se)
+            index_hash[wse.key] = wse
+
+    def check_complete(self):
+        """
+        Raise a CodecError unless the stream fed so far ends on a frame boundary and had a head.
+        """
+        if self._buffer:
+            raise CodecError('Received a structure stream which ends in a partial frame!')
+
+        if self.head is None:
+            raise CodecError('Received a structure stream without a head!')
+
+    def finish(self, cache=None):
+        """
+        Called once the whole stream has been fed. Resolves any key references from the cache and loads the root
+        object.
+        """
+        self.check_complete()
+
+        missing = _resolve_references(self.repo, self.references, cache)
+        if missing:
+            raise UnresolvedReferenceError('Could not resolve %d key references in the stream!' % len(missing), missing)
+
+        log.debug('StreamDecoder: loaded %d objects' % len(self.repo.index_hash))
+
+        return _load_structure(self.repo, self.head)
+
+
+def _load_structure(repo, head):
+    """
+    Helper for the receiver - load the root object and all linked objects from
+    a repository whose index_hash holds the received structure elements.
+    """
     # Load the object and set it as the workspace root
     root_obj = repo._load_element(head)
     repo.root_object = root_obj
@@ -19,6 +19,7 @@ from ion.core.object.object_utils import CDM_GROUP_TYPE, CDM_DATASET_TYPE, CDM_A
 from ion.core.object.object_utils import _gpb_source, _gpb_source_root
 
 import struct
+import random
 
 from google.protobuf import message
 from google.protobuf.internal import containers
@@ -39,6 +40,17 @@ log = ion.util.ionlog.getLogger(__name__)
 STRUCTURE_ELEMENT_TYPE = create_type_identifier(object_id=1, version=1)
 LINK_TYPE = create_type_identifier(object_id=3, version=1)
 
+# Structure element integrity checks - compare the key with the sha1 of the content:
+# 'always' - check every element
+# 'sampled' - check a random fraction (SHA1_SAMPLE_RATE) of the elements
+# 'trusted' - check every element except those read from a trusted source such as our own data store or cache
+SHA1_VERIFY_ALWAYS = 'always'
+SHA1_VERIFY_SAMPLED = 'sampled'
+SHA1_VERIFY_TRUSTED = 'trusted'
+
+SHA1_VERIFY = CONF.getValue('SHA1_VERIFY', SHA1_VERIFY_ALWAYS)
+SHA1_SAMPLE_RATE = CONF.getValue('SHA1_SAMPLE_RATE', 0.05)
+
 class WrappedEnum(object):
     """ Data descriptor (like a property) for passing through GPB enums from the Wrapper. """
 
@@ -527,6 +539,8 @@ class WrapperType(type):
             clsDict['SetDimension'] = group._set_dimension
 
             clsDict['GetValue'] = variables.GetValue
+            clsDict['GetSlice'] = variables.GetSlice
+            clsDict['GetIntersectingBoundedArrays'] = variables.GetIntersectingBoundedArrays
 
             clsDict['MergeAttSrc'] = attribute_merge.MergeAttSrc
             clsDict['MergeAttDst'] = attribute_merge.MergeAttDst
@@ -997,6 +1011,7 @@ class Wrapper(object):
         se = StructureElement()
         repo = self.Repository
 
+        child_keys = []
         for link in  self.ChildLinks:
 
             if link.Invalid:
@@ -1030,7 +1045,9 @@ class Wrapper(object):
                     child.RecurseCommit(structure)
 
             # Save the link info as a convience for sending!
-            se.ChildLinks.add(link.key)
+            child_keys.append(link.key)
+
+        se.ChildLinks.update(child_keys)
 
         se.value = self.SerializeToString()
         #se.key = sha1hex(se.value)
@@ -1952,41 +1969,183 @@ class StructureElementError(Exception):
     """
 
 
+# Type identifiers are shared by the structure elements which hold them - the GPB object and its serialized bytes are
+# made once for each type. Do not modify the type of an element in place, set a new one.
+_type_objects = {}
+_type_bytes = {}
+
+def _get_type_object(type_tuple):
+    obj = _type_objects.get(type_tuple)
+    if obj is None:
+        obj = STRUCTURE_ELEMENT_TYPE.__class__()
+        if type_tuple is not None:
+            obj.object_id, obj.version = type_tuple
+        _type_objects[type_tuple] = obj
+    return obj
+
+def _get_type_bytes(type_tuple):
+    serialized = _type_bytes.get(type_tuple)
+    if serialized is None:
+        serialized = _type_bytes[type_tuple] = _get_type_object(type_tuple).SerializeToString()
+    return serialized
+
+def _varint_size(value):
+    """
+    The number of bytes in the GPB varint encoding of an int - a negative int32 takes ten
+    """
+    if value < 0:
+        return 10
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+
+class ChildKeys(object):
+    """
+    Set like view of the keys of the children of a structure element. The keys are held by the element in a tuple,
+    which costs far less memory than a set for the few children most elements have.
+    """
+    __slots__ = ('_se',)
+
+    def __init__(self, se):
+        self._se = se
+
+    def __len__(self):
+        return len(self._se._child_keys)
+
+    def __iter__(self):
+        return iter(self._se._child_keys)
+
+    def __contains__(self, key):
+        return key in self._se._child_keys
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add(self, key):
+        keys = self._se._child_keys
+        if key not in keys:
+            self._se._child_keys = keys + (key,)
+
+    def update(self, keys):
+        current = self._se._child_keys
+        existing = set(current)
+        new = []
+        for key in keys:
+            if key not in existing:
+                existing.add(key)
+                new.append(key)
+        if new:
+            self._se._child_keys = current + tuple(new)
+
+    def discard(self, key):
+        if key in self._se._child_keys:
+            self._se._child_keys = tuple(k for k in self._se._child_keys if k != key)
+
+    def clear(self):
+        self._se._child_keys = ()
+
+    def __repr__(self):
+        return 'ChildKeys(%s)' % ', '.join(sha1_to_hex(k) for k in self._se._child_keys)
+
+
 class StructureElement(object):
     """
     @brief Wrapper for the container structure element. These are the objects
     stored in the hashed elements table. Mostly convience methods are provided
-    here. A set provides references to the child objects so that the content
-    need not be decoded to find them.
+    here. The keys of the child objects are kept so that the content need not
+    be decoded to find them.
+
+    Repositories hold very many of these, so the fields are kept in slots rather
+    than in a GPB message. The GPB message is only built when it is asked for.
     """
 
+    __slots__ = ('_key', '_type', '_value', '_isleaf', '_child_keys', '_sha1', '_verified', '_size', '__weakref__')
+
     def __init__(self, se=None):
-        if se:
-            self._element = se
-        else:
-            self._element = get_gpb_class_from_type_id(STRUCTURE_ELEMENT_TYPE)()
-        self.ChildLinks = set()
+
+        self._key = None
+        # (object_id, version) tuple
+        self._type = None
+        self._value = None
+        self._isleaf = None
+        self._child_keys = ()
+
+        # The memoized sha1 of the content, whether the key has been checked against it and the serialized size
+        self._sha1 = None
+        self._verified = False
+        self._size = None
+
+        if se is not None:
+            if se.HasField('key'):
+                self._key = se.key
+            if se.HasField('type'):
+                self._type = (se.type.object_id, se.type.version)
+            if se.HasField('value'):
+                self._value = se.value
+            if se.HasField('isleaf'):
+                self._isleaf = se.isleaf
 
     @classmethod
-    def parse_structure_element(cls, blob):
+    def parse_structure_element(cls, blob, trusted=False):
+        """
+        Parse a serialized structure element and check its key according to the verification policy.
+        @param blob is the serialized element
+        @param trusted should be True if the blob came from a source which checked it when it was stored
+        """
         se = get_gpb_class_from_type_id(STRUCTURE_ELEMENT_TYPE)()
         se.ParseFromString(blob)
 
         instance = cls(se)
+        instance._size = len(blob)
 
-        if instance.key != instance.sha1:
+        if not instance.verify(trusted):
             log.error('The sha1 key does not match the value. The data is corrupted! \n' +\
                       'Element key %s, Calculated key %s' % (sha1_to_hex(instance.key), sha1_to_hex(instance.sha1)))
             raise StructureElementError('Error reading serialized structure element. Sha1 value does not match.')
 
         return instance
 
+    def verify(self, trusted=False):
+        """
+        Check that the key matches the content, subject to the SHA1_VERIFY policy. An element is only checked once -
+        an element the policy lets through unchecked is not checked again either.
+        @param trusted is True if the element came from a trusted source
+        @retval False if the check was made and failed
+        """
+        if self._verified:
+            return True
+
+        if SHA1_VERIFY == SHA1_VERIFY_TRUSTED and trusted:
+            check = False
+        elif SHA1_VERIFY == SHA1_VERIFY_SAMPLED:
+            check = random.random() < SHA1_SAMPLE_RATE
+        else:
+            check = True
+
+        if check and self.key != self.sha1:
+            return False
+
+        self._verified = True
+        return True
+
     @property
     def sha1(self):
         """
         Make the sha1 safe for empty contents but also type safe.
         Take use the sha twice so that we don't need to concatinate long strings!
+        The result is memoized until the value or type is set.
         """
+        if self._sha1 is None:
+            self._sha1 = self._calculate_sha1()
+        return self._sha1
+
+    def _calculate_sha1(self):
         #################
         ## This is the method that you can compare in Java
         #################
@@ -2016,61 +2175,125 @@ class StructureElement(object):
         #################
         # This does the same thing much faster and shorter!
         #################
-        return sha1bin(sha1bin(self.value) + self.type.SerializeToString())
+        return sha1bin(sha1bin(self.value) + _get_type_bytes(self._type))
+
+    def _changed(self):
+        self._sha1 = None
+        self._verified = False
+        self._size = None
 
     #@property
     def _get_type(self):
-        return self._element.type
+        return _get_type_object(self._type)
 
     #@type.setter
     def _set_type(self, obj_type):
-        self._element.type.object_id = obj_type.object_id
-        self._element.type.version = obj_type.version
+        self._type = (obj_type.object_id, obj_type.version)
+        self._changed()
 
     type = property(_get_type, _set_type)
 
     #@property
     def _get_value(self):
-        return self._element.value
+        if self._value is None:
+            return ''
+        return self._value
 
     #@value.setter
     def _set_value(self, value):
-        self._element.value = value
+        self._value = value
+        self._changed()
 
     value = property(_get_value, _set_value)
 
     #@property
     def _get_key(self):
-        #return sha1_to_hex(self._element.key)
-        return self._element.key
+        #return sha1_to_hex(self._key)
+        if self._key is None:
+            return ''
+        return self._key
 
     #@key.setter
     def _set_key(self, value):
-        self._element.key = value
+        self._key = value
+        # The sha1 does not depend on the key
+        self._verified = False
+        self._size = None
 
     key = property(_get_key, _set_key)
 
     def _set_isleaf(self, value):
-        self._element.isleaf = value
+        self._isleaf = value
+        self._size = None
 
     def _get_isleaf(self):
-        return self._element.isleaf
+        return bool(self._isleaf)
 
     isleaf = property(_get_isleaf, _set_isleaf)
 
+    def _get_child_links(self):
+        return ChildKeys(self)
+
+    def _set_child_links(self, keys):
+        self._child_keys = ()
+        ChildKeys(self).update(keys)
+
+    ChildLinks = property(_get_child_links, _set_child_links)
+
+    @property
+    def _element(self):
+        """
+        A new GPB structure element message with the content of this element
+        """
+        se = get_gpb_class_from_type_id(STRUCTURE_ELEMENT_TYPE)()
+        if self._type is not None:
+            se.type.object_id, se.type.version = self._type
+        if self._value is not None:
+            se.value = self._value
+        if self._key is not None:
+            se.key = self._key
+        if self._isleaf is not None:
+            se.isleaf = self._isleaf
+        return se
+
     def __str__(self):
         msg = ''
-        if len(self._element.key) == 20:
-            msg = 'Hexkey: "' + sha1_to_hex(self._element.key) + '"\n'
+        if len(self.key) == 20:
+            msg = 'Hexkey: "' + sha1_to_hex(self.key) + '"\n'
         return msg + self._element.__str__()
 
     def serialize(self):
-        return self._element.SerializeToString()
+        serialized = self._element.SerializeToString()
+        self._size = len(serialized)
+        return serialized
 
 
     def __sizeof__(self):
-        #size = len(self._element.value) + 34
-        #print 'Esimtate: ', size
-        #print 'GPB Size: ', self._element.ByteSize()
+        # The size of the serialized element - as the GPB ByteSize would report
+        if self._size is None:
+            self._size = self._encoded_size()
+
+        return self._size
+
+    def _encoded_size(self):
+        """
+        Work out the length of the serialized element from its fields instead of serializing it. The fields of the
+        element and of its type are all numbered below 16, so each tag is one byte. The child keys are not part of
+        the encoding.
+        """
+        size = 0
+        if self._type is not None:
+            object_id, version = self._type
+            type_size = 2 + _varint_size(object_id) + _varint_size(version)
+            size += 1 + _varint_size(type_size) + type_size
+
+        for field in (self._value, self._key):
+            if field is not None:
+                length = len(field)
+                size += 1 + _varint_size(length) + length
+
+        if self._isleaf is not None:
+            # tag and a one byte bool
+            size += 2
 
-        return self._element.ByteSize()
+        return size
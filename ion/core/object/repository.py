@@ -103,6 +103,10 @@ class IndexHash(dict):
 
 
     def __setitem__(self, key, val):
+        old = dict.get(self, key)
+        if old is not None:
+            self._size -= old.__sizeof__()
+
         dict.__setitem__(self, key, val)
         if self.has_cache:
             self.cache[key]=val
@@ -152,14 +156,20 @@ class IndexHash(dict):
         D.update(E, **F) -> None.  Update D from E and F: for k in E: D[k] = E[k]
         (if E has keys else: for (k, v) in E: D[k] = v) then: for k in F: D[k] = F[k]
         """
-        dict.update(self, *args, **kwargs)
+        items = dict(*args, **kwargs)
+
+        # Account for the change in size without counting the whole index again
+        size = self._size
+        for key, val in items.iteritems():
+            old = dict.get(self, key)
+            if old is not None:
+                size -= old.__sizeof__()
+            size += val.__sizeof__()
+
+        dict.update(self, items)
         if self.has_cache:
-            self.cache.update(*args, **kwargs)
+            self.cache.update(items)
 
-        # For now - don't bother parsing args just recount
-        size = 0
-        for item in self.itervalues():
-            size += item.__sizeof__()
         self._size = size
 
     def clear(self):
@@ -170,7 +180,7 @@ class IndexHash(dict):
     def __delitem__(self, key):
 
         item = self.get(key)
-        if key is not None:
+        if item is not None:
             self._size -= item.__sizeof__()
 
         dict.__delitem__(self,key)
@@ -223,6 +233,11 @@ class ObjectContainer(object):
         The upstream source of this repository.
         """
 
+        self.upstream_head=None
+        """
+        The key of the upstream head state last merged by a pull.
+        """
+
         self.excluded_types = self.DefaultExcludedTypes[:]
         """
         The list of currently excluded object types
@@ -270,6 +285,7 @@ class ObjectContainer(object):
 
         self._process = None
         self.upstream = None
+        self.upstream_head = None
 
 
     def _create_wrapped_object(self, rootclass, obj_id=None, addtoworkspace=True):
@@ -475,9 +491,9 @@ class ObjectContainer(object):
 
     def _load_element(self, element):
 
-        # check that the calculated value in element.sha1 matches the stored value
-        if not element.key == element.sha1:
-            #@TODO Consider removing this somewhat costly check - it is already done when an object is read from a message
+        # check that the calculated value in element.sha1 matches the stored value - each element is checked at most
+        # once and the SHA1_VERIFY policy may skip it
+        if not element.verify():
             raise RepositoryError('The sha1 key does not match the value. The data is corrupted! \n' +\
             'Element key %s, Calculated key %s' % (object_utils.sha1_to_hex(element.key), object_utils.sha1_to_hex(element.sha1)))
 
@@ -500,8 +516,7 @@ class ObjectContainer(object):
         obj.Modified = False
 
         # Make a note in the element of the child links as well!
-        for child in obj.ChildLinks:
-            element.ChildLinks.add(child.key)
+        element.ChildLinks.update(child.key for child in obj.ChildLinks)
 
         return obj
 
@@ -582,6 +597,17 @@ class Repository(ObjectContainer):
         to level 2 LRU caching in the workbench.
         """
 
+        self.workspace_bytes = 0
+        """
+        The workspace_size measured at the last commit or checkout.
+        """
+
+        self.memory_counter = None
+        """
+        Called with the repository after a commit or checkout by the workbench which holds it, to keep a running count
+        of the bytes it holds.
+        """
+
 
 
         ### Structures for managing associations to a repository:
@@ -724,6 +750,32 @@ class Repository(ObjectContainer):
 
         return self.index_hash.__sizeof__()
 
+    def workspace_size(self):
+        """
+        Estimate the bytes held by the decoded objects in the workspace as their serialized size. Objects which are
+        not decoded yet share the serialized value of their element and are not counted.
+        """
+        size = 0
+        for key, obj in self._workspace.iteritems():
+            if obj._bytes is not None:
+                continue
+
+            element = dict.get(self.index_hash, key)
+            if element is not None:
+                size += element.__sizeof__()
+            else:
+                # A new or modified object
+                size += obj.ByteSize()
+        return size
+
+    def _count_memory(self):
+        """
+        Measure the workspace and report it to the workbench holding the repository
+        """
+        self.workspace_bytes = self.workspace_size()
+        if self.memory_counter is not None:
+            self.memory_counter(self)
+
 
     def clear(self):
         """
@@ -749,7 +801,10 @@ class Repository(ObjectContainer):
         self.branchnicknames.clear()
         self._stash.clear()
         self.upstream = None
+        self.upstream_head = None
         self._process = None
+        self.workspace_bytes = 0
+        self.memory_counter = None
 
         if self.merge is not None:
             for mr in self.merge:
@@ -1066,6 +1121,8 @@ class Repository(ObjectContainer):
             
             rootobj.SetStructureReadOnly()
 
+        self._count_memory()
+
         log.debug('Checkout Complete!')
         defer.returnValue(rootobj)
 
@@ -1159,6 +1216,7 @@ class Repository(ObjectContainer):
 
         self._workspace.clear()
         self._workspace_root = None
+        self.workspace_bytes = 0
 
 
     def purge_associations(self):
@@ -1203,6 +1261,8 @@ class Repository(ObjectContainer):
         else:
             raise RepositoryError('Repository in invalid state to commit')
         
+        self._count_memory()
+
         # Like git, return the commit id
         branch = self._current_branch
         return branch.commitrefs.GetLink(0).key
@@ -16,6 +16,7 @@ from twisted.trial import unittest
 from ion.core.object import codec
 from ion.core.object import workbench
 from ion.core.object import object_utils
+from ion.util.cache import TimedPins
 
 
 from ion.core import ioninit
@@ -128,3 +129,120 @@ class CodecTest(unittest.TestCase):
 
 
 
+    def test_pack_eq_unpack_stream(self):
+
+        serialized = codec.pack_stream(self.ab)
+
+        res = codec.unpack_stream(serialized)
+
+        self.assertEqual(res,self.ab)
+        self.assertEqual(res.person[0],self.ab.person[0])
+        self.assertEqual(res.person[1],self.ab.person[1])
+
+
+    def test_stream_frames(self):
+
+        # A tiny frame size closes a frame after every item - the head rides with the first person
+        frames = list(codec.iter_pack_stream(self.ab, frame_size=1))
+        self.assertEqual(len(frames), 2)
+
+        # Feed the stream a few bytes at a time - frame boundaries do not matter
+        serialized = ''.join(frames)
+        chunks = [serialized[i:i+7] for i in xrange(0, len(serialized), 7)]
+
+        res = codec.unpack_stream(chunks)
+
+        self.assertEqual(res,self.ab)
+        self.assertEqual(res.owner,self.ab.owner)
+
+
+    def test_unpack_stream_error(self):
+
+        serialized = codec.pack_stream(self.ab)
+
+        # A truncated stream is an error
+        self.assertRaises(codec.CodecError,codec.unpack_stream,serialized[:-3])
+
+        self.assertRaises(codec.CodecError,codec.unpack_stream,'junk that is not a serialized stream!')
+
+    def test_key_filter(self):
+
+        key_filter = codec.KeyFilter(capacity=2)
+
+        keys = [object_utils.sha1bin(str(i)) for i in range(5)]
+
+        key_filter.add(keys[0])
+        key_filter.add(keys[1])
+        self.assertIn(keys[0], key_filter)
+        self.assertIn(keys[1], key_filter)
+        self.assertNotIn(keys[2], key_filter)
+
+        # Filling the next generation forgets the oldest keys
+        for key in keys[2:]:
+            key_filter.add(key)
+
+        self.assertNotIn(keys[0], key_filter)
+        self.assertIn(keys[4], key_filter)
+
+
+    def test_pack_references(self):
+
+        # Make every element big enough to be sent as a reference
+        self.patch(codec, 'DEDUP_MIN_SIZE', 0)
+
+        key_filter = codec.KeyFilter()
+
+        first = codec.pack_structure(self.ab, key_filter=key_filter)
+        second = codec.pack_structure(self.ab, key_filter=key_filter)
+
+        # The second message only carries references to the people
+        self.assertEqual(codec.unpack_structure(first), self.ab)
+        self.assertTrue(len(second) < len(first))
+
+        self.assertRaises(codec.UnresolvedReferenceError, codec.unpack_structure, second)
+
+        res = codec.unpack_structure(second, cache=self.repo.index_hash)
+        self.assertEqual(res, self.ab)
+        self.assertEqual(res.person[1], self.ab.person[1])
+
+        # The same goes for the stream encoding
+        serialized = codec.pack_stream(self.ab, key_filter=key_filter)
+        res = codec.unpack_stream(serialized, cache=self.repo.index_hash)
+        self.assertEqual(res.owner, self.ab.owner)
+
+    def test_references_pinned(self):
+
+        self.patch(codec, 'DEDUP_MIN_SIZE', 0)
+        pins = workbench.get_element_pins()
+        pins.clear()
+        self.addCleanup(pins.clear)
+
+        # Keys collected in sent_keys are only in the filter once the caller adds them
+        key_filter = codec.KeyFilter()
+        sent_keys = []
+        codec.pack_structure(self.ab, key_filter=key_filter, sent_keys=sent_keys)
+        self.assertTrue(len(sent_keys) > 0)
+        self.assertEqual(len(pins), 0)
+        for key in sent_keys:
+            self.assertNotIn(key, key_filter)
+
+        key_filter.update(sent_keys)
+        second = codec.pack_structure(self.ab, key_filter=key_filter, sent_keys=[])
+
+        # Every element sent by key can be fetched from the pins, even once the workbench has dropped it
+        res = codec.unpack_structure(second, cache=pins)
+        self.assertEqual(res, self.ab)
+
+    def test_unpinned_sent_in_full(self):
+
+        self.patch(codec, 'DEDUP_MIN_SIZE', 0)
+        self.patch(workbench, '_element_pins', TimedPins(0, 60))
+
+        key_filter = codec.KeyFilter()
+        first = codec.pack_structure(self.ab, key_filter=key_filter)
+        second = codec.pack_structure(self.ab, key_filter=key_filter)
+
+        # There is no room to pin anything, so nothing is sent by key
+        self.assertEqual(len(second), len(first))
+        self.assertEqual(codec.unpack_structure(second), self.ab)
+
@@ -20,6 +20,7 @@ from net.ooici.play import addressbook_pb2
 from ion.core.object import gpb_wrapper
 from ion.core.object import workbench
 from ion.core.object import object_utils
+from ion.util.cache import BlobCache
 
 # For testing the message based ops of the workbench
 from ion.core.process.process import ProcessFactory, Process
@@ -268,6 +269,116 @@ class WorkBenchTest(unittest.TestCase):
         self.assertNotIn(key, self.wb._repo_cache)
 
 
+    def _commit_chain(self, n):
+        keys = []
+        for i in range(n):
+            self.ab.title = 'version %d' % i
+            keys.append(self.repo.commit(comment='commit %d' % i))
+        return keys
+
+    def test_list_repository_heads(self):
+        keys = self._commit_chain(10)
+
+        heads = self.wb.list_repository_heads(self.repo)
+
+        # The head, 1, 2, 4 and 8 commits back and the root commit
+        self.assertEqual(heads, [keys[9], keys[8], keys[7], keys[5], keys[1], keys[0]])
+
+    def test_list_commits_needed(self):
+        keys = self._commit_chain(6)
+
+        # A puller advertising every commit or the compact list needs nothing
+        self.assertEqual(self.wb.list_commits_needed(self.repo, self.wb.list_repository_commits(self.repo)), [])
+        self.assertEqual(self.wb.list_commits_needed(self.repo, self.wb.list_repository_heads(self.repo)), [])
+
+        # Having a commit implies having its ancestors
+        self.assertEqual(set(self.wb.list_commits_needed(self.repo, [keys[3]])), set(keys[4:]))
+
+        # Keys it does not know are ignored
+        self.assertEqual(set(self.wb.list_commits_needed(self.repo, ['not a commit', keys[0]])), set(keys[1:]))
+        self.assertEqual(set(self.wb.list_commits_needed(self.repo, [])), set(keys))
+
+
+    def test_memory_stats(self):
+        self.repo.commit('junk')
+
+        stats = self.wb.memory_stats()
+        self.assertEqual(stats['repositories'], 1)
+        self.assertEqual(stats['index_bytes'], self.repo.__sizeof__())
+        self.assertTrue(stats['workspace_bytes'] > 0)
+        self.assertEqual(stats['total_bytes'], stats['index_bytes'] + stats['workspace_bytes'])
+        self.assertEqual(stats['total_bytes'], self.wb.memory_size())
+        self.assertTrue(stats['container_bytes'] >= stats['total_bytes'])
+
+        # Cached repositories keep only their elements
+        self.repo.cached = True
+        self.wb.manage_workbench_cache(self.repo.convid_context)
+
+        stats = self.wb.memory_stats()
+        self.assertEqual(stats['repositories'], 0)
+        self.assertEqual(stats['cached_repositories'], 1)
+        self.assertEqual(stats['total_bytes'], stats['cached_bytes'])
+
+    @defer.inlineCallbacks
+    def test_memory_counted(self):
+        self.repo.commit('junk')
+        key = self.repo.repository_key
+
+        self.assertEqual(self.wb.memory_size(), self.repo.__sizeof__() + self.repo.workspace_size())
+
+        # Cached repositories are counted by the cache
+        self.repo.cached = True
+        self.wb.manage_workbench_cache(self.repo.convid_context)
+        self.assertEqual(self.wb.memory_size(), self.wb._repo_cache.total_size)
+
+        # Taken out of the cache and checked out again
+        repo = self.wb.get_repository(key)
+        yield repo.checkout('master')
+        self.assertEqual(self.wb.memory_size(), repo.__sizeof__() + repo.workspace_size())
+
+        self.wb.clear_repository(repo)
+        self.assertEqual(self.wb.memory_size(), 0)
+
+    def test_memory_budget_evict(self):
+        self.repo.commit('junk')
+        self.repo.cached = True
+        key = self.repo.repository_key
+
+        self.patch(workbench, 'MEMORY_BUDGET', 1)
+        self.wb.manage_workbench_cache(self.repo.convid_context)
+
+        self.assertNotIn(key, self.wb._repo_cache)
+        self.assertEqual(self.wb.memory_stats()['evictions'], 1)
+
+    def test_memory_budget_spill(self):
+        self.patch(workbench, 'MEMORY_POLICY', workbench.MEMORY_SPILL)
+        blob_cache = BlobCache(10**6)
+        wb = workbench.WorkBench('No Process Test', blob_cache=blob_cache)
+
+        repo = wb.create_repository(ADDRESSLINK_TYPE)
+        repo.root_object.title = 'spilled'
+        repo.commit('junk')
+        repo.cached = True
+        keys = dict.keys(repo.index_hash)
+
+        self.patch(workbench, 'MEMORY_BUDGET', 1)
+        wb.manage_workbench_cache(repo.convid_context)
+
+        self.assertEqual(len(wb._repo_cache), 0)
+        for key in keys:
+            self.assertIn(key, blob_cache)
+
+    def test_memory_budget_refuse(self):
+        self.repo.commit('junk')
+
+        self.patch(workbench, 'MEMORY_BUDGET', 1)
+        self.patch(workbench, 'MEMORY_POLICY', workbench.MEMORY_REFUSE)
+
+        d = self.wb.pull('datastore', 'some repository')
+        self.failUnlessFailure(d, workbench.WorkBenchError)
+        self.assertEqual(self.wb.memory_stats()['refusals'], 1)
+        return d
+
 
 class WorkBenchProcess(Process):
     """
@@ -6,6 +6,8 @@
 @test Service the protobuffers wrapper class
 """
 
+import weakref
+
 import ion.util.ionlog
 from twisted.trial.unittest import SkipTest
 log = ion.util.ionlog.getLogger(__name__)
@@ -418,6 +420,110 @@ class TestStructureElementWrapper(unittest.TestCase):
         se = repo.index_hash.get(commit_key)
         self.assertEqual(se.__sizeof__(), 127)
 
+    def test_sizeof_without_serializing(self):
+
+        se = gpb_wrapper.StructureElement()
+        self.assertEqual(se.__sizeof__(), 0)
+
+        for value in ['', 'x', 'x' * 200, 'x' * 20000]:
+            se = gpb_wrapper.StructureElement()
+            se.type = PERSON_TYPE
+            se.value = value
+            se.key = se.sha1
+            se.isleaf = False
+            self.assertEqual(se.__sizeof__(), len(se._element.SerializeToString()))
+
+        # The size follows changes to the fields
+        se.value = 'y'
+        se.type = object_utils.create_type_identifier(object_id=-1, version=300)
+        self.assertEqual(se.__sizeof__(), len(se._element.SerializeToString()))
+
+    def _make_blob(self, value):
+        se = gpb_wrapper.StructureElement()
+        se.type = PERSON_TYPE
+        se.value = value
+        se.key = se.sha1
+        se.isleaf = True
+        return se.serialize()
+
+    def test_sha1_memoized(self):
+
+        se = gpb_wrapper.StructureElement.parse_structure_element(self._make_blob('some bytes'))
+
+        sha1 = se.sha1
+        self.assertEqual(sha1, se.key)
+        self.assertIdentical(se.sha1, sha1)
+
+        # Setting the value forgets the memoized sha1
+        se.value = 'other bytes'
+        self.assertNotEqual(se.sha1, sha1)
+        self.assertEqual(se.verify(), False)
+
+    def test_verify_policy(self):
+
+        # Corrupt the value without changing the key
+        se = gpb_wrapper.StructureElement.parse_structure_element(self._make_blob('some bytes'))
+        se.value = 'corrupted'
+        blob = se.serialize()
+
+        self.assertRaises(gpb_wrapper.StructureElementError, gpb_wrapper.StructureElement.parse_structure_element, blob)
+        self.assertRaises(gpb_wrapper.StructureElementError, gpb_wrapper.StructureElement.parse_structure_element, blob, True)
+
+        self.patch(gpb_wrapper, 'SHA1_VERIFY', gpb_wrapper.SHA1_VERIFY_TRUSTED)
+        self.assertRaises(gpb_wrapper.StructureElementError, gpb_wrapper.StructureElement.parse_structure_element, blob)
+        se = gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
+        self.assertEqual(se.value, 'corrupted')
+
+        self.patch(gpb_wrapper, 'SHA1_VERIFY', gpb_wrapper.SHA1_VERIFY_SAMPLED)
+        self.patch(gpb_wrapper, 'SHA1_SAMPLE_RATE', 0.0)
+        se = gpb_wrapper.StructureElement.parse_structure_element(blob)
+        self.assertEqual(se.value, 'corrupted')
+
+        self.patch(gpb_wrapper, 'SHA1_SAMPLE_RATE', 1.0)
+        self.assertRaises(gpb_wrapper.StructureElementError, gpb_wrapper.StructureElement.parse_structure_element, blob)
+
+
+    def test_compact_element(self):
+
+        blob = self._make_blob('some bytes')
+        se = gpb_wrapper.StructureElement.parse_structure_element(blob)
+
+        self.assertEqual(se.value, 'some bytes')
+        self.assertEqual(se.type, PERSON_TYPE)
+        self.assertEqual(se.isleaf, True)
+        self.assertEqual(se.serialize(), blob)
+        self.assertEqual(se.__sizeof__(), len(blob))
+
+        # The GPB message is built on demand
+        self.assertEqual(se._element.value, 'some bytes')
+        self.assertEqual(gpb_wrapper.StructureElement(se._element).key, se.key)
+
+        # Elements can be held in the weak valued workbench cache
+        cache = weakref.WeakValueDictionary()
+        cache[se.key] = se
+        self.assertIdentical(cache[se.key], se)
+
+        self.assertRaises(AttributeError, setattr, se, 'something_else', 1)
+
+    def test_child_keys(self):
+
+        se = gpb_wrapper.StructureElement()
+        keys = [object_utils.sha1bin(str(i)) for i in range(3)]
+
+        self.assertEqual(len(se.ChildLinks), 0)
+
+        se.ChildLinks.add(keys[0])
+        se.ChildLinks.update([keys[1], keys[0], keys[2], keys[1]])
+
+        self.assertEqual(len(se.ChildLinks), 3)
+        self.assertIn(keys[2], se.ChildLinks)
+        self.assertEqual(se.ChildLinks, set(keys))
+        self.assertEqual(list(se.ChildLinks), keys)
+
+        se.ChildLinks.discard(keys[1])
+        self.assertNotIn(keys[1], se.ChildLinks)
+        self.assertEqual(len(se.ChildLinks), 2)
+
 
 class TestSpecializedCdmMethods(unittest.TestCase):
     """
@@ -35,10 +35,103 @@ from ion.core.ioninit import request
 from net.ooici.core.container import container_pb2
 
 
-from ion.util.cache import LRUDict
+from ion.util.cache import LRUDict, BlobCache, TimedPins
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
 
+from ion.core import ioninit
+CONF = ioninit.config(__name__)
+
+# Byte budget of the blob cache shared by the workbenches in a container - zero to disable it
+BLOB_CACHE_SIZE = CONF.getValue('blob_cache_size', 5 * 10**7)
+# Eviction policy of the blob cache - 'lru' or 'arc'
+BLOB_CACHE_POLICY = CONF.getValue('blob_cache_policy', BlobCache.ARC)
+# Optional memory mapped file which evicted blobs spill to and its size in bytes
+BLOB_CACHE_SPILL_FILE = CONF.getValue('blob_cache_spill_file', None)
+BLOB_CACHE_SPILL_SIZE = CONF.getValue('blob_cache_spill_size', 2 * 10**8)
+
+# Elements a process sent to a peer by key only are pinned so the peer can still fetch them. A pin lasts this many
+# seconds after the last message which referred to the element, and at most this many bytes are pinned.
+REFERENCE_PIN_TIME = CONF.getValue('reference_pin_time', 60.0)
+REFERENCE_PIN_SIZE = CONF.getValue('reference_pin_size', 5 * 10**7)
+
+# Eviction policy of the cache of repositories held between op message calls - 'lru', '2q' or 'arc'
+REPO_CACHE_POLICY = CONF.getValue('repo_cache_policy', LRUDict.TWO_Q)
+
+# Advertise only the branch heads and a skip list of their ancestors in a pull instead of every commit
+COMPACT_PULL = CONF.getValue('compact_pull', True)
+
+# What a workbench does when the workbenches in the container hold more than the memory budget. Cached repositories
+# are always evicted first. 'spill' leaves the elements of evicted repositories in the blob cache, which writes them to
+# its spill file when one is configured. 'refuse' fails new pulls while the held repositories exceed the budget.
+MEMORY_EVICT = 'evict'
+MEMORY_SPILL = 'spill'
+MEMORY_REFUSE = 'refuse'
+
+# Bytes of repository content the workbenches in a container may hold between them - zero for no budget
+MEMORY_BUDGET = CONF.getValue('memory_budget', 0)
+MEMORY_POLICY = CONF.getValue('memory_policy', MEMORY_EVICT)
+
+_blob_cache = None
+_element_pins = None
+
+# The workbenches in this container by id, which share the memory budget
+_workbenches = weakref.WeakValueDictionary()
+
+def get_blob_cache():
+    """
+    Returns the serialized structure element cache shared by all workbenches in this container, or None if the
+    cache is disabled. Elements are immutable and keyed by their sha1 so sharing them is safe.
+    """
+    global _blob_cache
+    if _blob_cache is None and BLOB_CACHE_SIZE > 0:
+        _blob_cache = BlobCache(BLOB_CACHE_SIZE, policy=BLOB_CACHE_POLICY,
+                                spill_file=BLOB_CACHE_SPILL_FILE, spill_size=BLOB_CACHE_SPILL_SIZE)
+    return _blob_cache
+
+
+def get_element_pins():
+    """
+    Returns the pins of the structure elements which processes in this container have sent by key only. op_fetch_blobs
+    serves pinned elements after they are gone from the workbench cache and the blob cache.
+    """
+    global _element_pins
+    if _element_pins is None:
+        _element_pins = TimedPins(REFERENCE_PIN_SIZE, REFERENCE_PIN_TIME)
+    return _element_pins
+
+
+def container_memory_size():
+    """
+    Returns the bytes of repository content held by all the workbenches in this container
+    """
+    return sum(wb.memory_size() for wb in _workbenches.values())
+
+
+class RepositoryCache(LRUDict):
+    """
+    Byte bounded cache of the repositories a workbench holds between op message calls. If a blob cache is given the
+    structure elements of evicted repositories are left in it, so they can be checked out again without a fetch.
+    """
+
+    def __init__(self, limit, policy=LRUDict.LRU, blob_cache=None):
+        LRUDict.__init__(self, limit, use_size=True, policy=policy)
+        self.blob_cache = blob_cache
+        self.spilled = 0
+
+    def _evicted(self, key, repo):
+        if self.blob_cache is not None:
+            for element in dict.itervalues(repo.index_hash):
+                self.blob_cache.put(element.key, element.serialize())
+                self.spilled += 1
+
+        LRUDict._evicted(self, key, repo)
+
+    def stats(self):
+        stats = LRUDict.stats(self)
+        stats['spilled_elements'] = self.spilled
+        return stats
+
 
 STRUCTURE_ELEMENT_TYPE = object_utils.create_type_identifier(object_id=1, version=1)
 STRUCTURE_TYPE = object_utils.create_type_identifier(object_id=2, version=1)
@@ -83,7 +176,7 @@ class WorkBenchError(ApplicationError):
 
 class WorkBench(object):
     
-    def __init__(self, process, cache_size=10**7):
+    def __init__(self, process, cache_size=10**7, blob_cache=None):
     
         self._process = process
 
@@ -93,15 +186,33 @@ class WorkBench(object):
         self._repository_nicknames = {}
 
 
-        # A Cache of repositories that holds upto a certain size between op message calls.
-        self._repo_cache = LRUDict(cache_size, use_size=True)
-
-
         """
         A cache - shared between repositories for hashed objects
         """  
         self._workbench_cache = weakref.WeakValueDictionary()
 
+        """
+        A byte bounded cache of serialized structure elements which outlives the repositories - shared by default
+        """
+        if blob_cache is None:
+            blob_cache = get_blob_cache()
+        self._blob_cache = blob_cache
+
+        # A Cache of repositories that holds upto a certain size between op message calls.
+        self._repo_cache = RepositoryCache(cache_size, policy=REPO_CACHE_POLICY,
+                                           blob_cache=blob_cache if MEMORY_POLICY == MEMORY_SPILL else None)
+
+        # Repositories evicted and pulls refused to keep within the memory budget
+        self.memory_evictions = 0
+        self.memory_refusals = 0
+
+        # Running count of the bytes held by the repositories in use, updated as they are put, pulled, committed,
+        # checked out, cached and cleared
+        self._held_bytes = 0
+        self._repo_bytes = {}
+
+        _workbenches[id(self)] = self
+
         #@TODO Consider using an index store in the Workbench to keep a cache of associations and keep track of objects
 
     def __str__(self):
@@ -110,6 +221,8 @@ class WorkBench(object):
         '''
         retstr = "/ ==== Workbench info (id:%s) ==========\n" % id(self)
         retstr += "++ Workbench Blob Cache, (len:%d)\n" % len(self._workbench_cache)
+        if self._blob_cache is not None:
+            retstr += "++ Shared Blob Cache, %s\n" % self._blob_cache.stats()
         #for k,v in self._workbench_cache.iteritems():
         #    retstr += "\t%s: %s\n" % (base64.encodestring(k)[0:-1], '')
 
@@ -117,7 +230,7 @@ class WorkBench(object):
         for k, v in self._repos.iteritems():
             retstr += "\t%s: ih %d, cached %s, persistent %s, conv %s\n" %(k, len(v.index_hash), v.cached, v.persistent, v.convid_context)
 
-        retstr += "++ LRU RepoCache, (len:%d)\n" % len(self._repo_cache.keys())
+        retstr += "++ LRU RepoCache, (len:%d) %s\n" % (len(self._repo_cache), self._repo_cache.stats())
         for k, v in self._repo_cache.iteritems():
             retstr += "\t%s: ih %d, cached %s, persistent %s,conv %s\n" %(k, len(v.index_hash), v.cached, v.persistent, v.convid_context)
 
@@ -262,6 +375,7 @@ class WorkBench(object):
         repo.clear()
 
         del self._repos[key]
+        self._held_bytes -= self._repo_bytes.pop(key, 0)
 
         # Remove the nickname too - this is dumb - nicknames may be removed anyway. Don't worry about it.
         for k,v in self._repository_nicknames.items():
@@ -282,6 +396,8 @@ class WorkBench(object):
 
         # Delete it from the deterministically held repo dictionary
         del self._repos[key]
+        self._held_bytes -= self._repo_bytes.pop(key, 0)
+        repo.memory_counter = None
 
         repo.purge_workspace()
 
@@ -314,6 +430,93 @@ class WorkBench(object):
                 else:
                     self.cache_repository(repo)
 
+        self.enforce_memory_budget()
+
+    def memory_size(self):
+        """
+        @retval the bytes of serialized elements and decoded workspace objects held by this workbench
+        """
+        return self._repo_cache.total_size + self._held_bytes
+
+    def _count_repository(self, repo):
+        """
+        Update the running count of the bytes held by a repository in use - its index hash and its workspace as
+        measured at the last commit or checkout
+        """
+        key = repo.repository_key
+        if key not in self._repos:
+            return
+
+        size = repo.index_hash.__sizeof__() + repo.workspace_bytes
+        self._held_bytes += size - self._repo_bytes.get(key, 0)
+        self._repo_bytes[key] = size
+
+    def memory_stats(self):
+        """
+        Returns a dictionary of the memory held by this workbench and the container memory budget
+        """
+        index_bytes = 0
+        workspace_bytes = 0
+        for repo in self._repos.itervalues():
+            index_bytes += repo.index_hash.__sizeof__()
+            workspace_bytes += repo.workspace_bytes
+
+        cached_bytes = self._repo_cache.total_size
+
+        return {'repositories':len(self._repos),
+                'index_bytes':index_bytes,
+                'workspace_bytes':workspace_bytes,
+                'cached_repositories':len(self._repo_cache),
+                'cached_bytes':cached_bytes,
+                'total_bytes':index_bytes + workspace_bytes + cached_bytes,
+                'container_bytes':container_memory_size(),
+                'budget':MEMORY_BUDGET,
+                'policy':MEMORY_POLICY,
+                'evictions':self.memory_evictions,
+                'refusals':self.memory_refusals,
+                'repo_cache':self._repo_cache.stats(),
+                }
+
+    def enforce_memory_budget(self):
+        """
+        Evict cached repositories, from this workbench first and then from the workbenches caching the most, until the
+        container is within the memory budget. Repositories in use are never evicted.
+        @retval the bytes still held over the budget
+        """
+        if MEMORY_BUDGET <= 0:
+            return 0
+
+        over = container_memory_size() - MEMORY_BUDGET
+        if over <= 0:
+            return 0
+
+        others = sorted([wb for wb in _workbenches.values() if wb is not self],
+                        key=lambda wb: wb._repo_cache.total_size, reverse=True)
+
+        for wb in [self] + others:
+            if over <= 0:
+                break
+
+            cache = wb._repo_cache
+            before_size, before_len = cache.total_size, len(cache)
+            cache.shrink(before_size - over)
+
+            wb.memory_evictions += before_len - len(cache)
+            over -= before_size - cache.total_size
+
+        if over > 0:
+            log.warn('Workbench memory budget exceeded by %d bytes held in repositories in use' % over)
+
+        return max(over, 0)
+
+    def _check_memory_budget(self):
+        """
+        Raise a WorkBenchError if the refuse policy is set and the budget is exceeded after evicting what can be
+        """
+        if MEMORY_POLICY == MEMORY_REFUSE and self.enforce_memory_budget() > 0:
+            self.memory_refusals += 1
+            raise WorkBenchError('The workbench memory budget of %d bytes is exceeded' % MEMORY_BUDGET)
+
 
     def clear(self):
         """
@@ -326,6 +529,8 @@ class WorkBench(object):
             repo.clear()
 
         self._repos.clear()
+        self._repo_bytes.clear()
+        self._held_bytes = 0
 
         #The cache knows to clear its content objects
         self._repo_cache.clear()
@@ -346,6 +551,8 @@ class WorkBench(object):
         self._repos[repo.repository_key] = repo
         repo.index_hash.cache = self._workbench_cache
         repo._process = self._process
+        repo.memory_counter = self._count_repository
+        self._count_repository(repo)
 
         wc = request.get('workbench_context',[])
 
@@ -405,6 +612,11 @@ class WorkBench(object):
                 # Short cut if we have already got it!
                 wse = repo.index_hash.get(key)
 
+                if wse is None:
+                    wse = self._get_cached_blob(key)
+                    if wse is not None:
+                        repo.index_hash[key] = wse
+
                 if wse:
                     blobs[wse.key]=wse
                     # get the object
@@ -464,6 +676,8 @@ class WorkBench(object):
         if excluded_types is not None and not hasattr(excluded_types, '__iter__'):
             raise WorkBenchError('Invalid excluded_types argument passed to checkout')
 
+        self._check_memory_budget()
+
         # Get the scoped name for the process to pull from
         targetname = self._process.get_scoped_name('system', origin)
 
@@ -483,7 +697,10 @@ class WorkBench(object):
         else:
             cloning = False
             # If we have a current version - get the list of commits
-            commit_list = self.list_repository_commits(repo)
+            if COMPACT_PULL:
+                commit_list = self.list_repository_heads(repo)
+            else:
+                commit_list = self.list_repository_commits(repo)
 
         # set excluded types on this repository
         if excluded_types is not None:
@@ -534,6 +751,18 @@ class WorkBench(object):
             raise WorkBenchError('Unexpected response to pull request: included blobs but I did not ask for them.')
 
 
+        # Not modified - the datastore answers without a head when the puller advertised every head it has stored
+        if not cloning and not result.IsFieldSet('repo_head_element') and len(result.commit_elements) == 0:
+            log.info('pull - complete, not modified')
+            defer.returnValue(result)
+
+        # Not modified - nothing new since the last pull from there and the head state is the one already merged
+        head_key = result.repo_head_element.key
+        if not cloning and len(result.commit_elements) == 0 and len(result.blob_elements) == 0 and \
+                repo.upstream == targetname and repo.upstream_head == head_key:
+            log.info('pull - complete, not modified')
+            defer.returnValue(result)
+
         # Add any new content to the repository:
         for se in result.commit_elements:
 
@@ -559,11 +788,50 @@ class WorkBench(object):
 
         # Where to get objects not yet transfered.
         repo.upstream = targetname
+        repo.upstream_head = head_key
+
+        self._count_repository(repo)
 
         log.info('pull - complete')
 
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def pull_many(self, origin, repo_names, get_head_content=True, excluded_types=None, skip_failed=False):
+        """
+        Pull the current state of several repositories. The pull requests are all sent before any reply is
+        awaited, so the time taken is that of the slowest pull rather than the sum of them.
+        @param origin the name of the process to pull from
+        @param repo_names an iterable of repository keys
+        @param skip_failed if True, repositories which could not be pulled are logged and left out of the result.
+        Otherwise the first WorkBenchError is raised once every pull has finished.
+        @retval a dictionary of repository key -> pull response
+        """
+        if excluded_types is not None and not hasattr(excluded_types, '__iter__'):
+            raise WorkBenchError('Invalid excluded_types argument passed to pull_many')
+
+        names = []
+        for name in repo_names:
+            if not isinstance(name, (str, unicode)):
+                raise TypeError('Invalid argument (repo_names) type to workbench pull_many. Should be strings, received: "%s"' % type(name))
+            if name not in names:
+                names.append(name)
+
+        # Wait for every pull to finish - a repository must not be pulled again while its pull is in flight
+        results = yield defer.DeferredList([self.pull(origin, name, get_head_content, excluded_types) for name in names],
+                                           consumeErrors=True)
+
+        responses = {}
+        for name, (success, result) in zip(names, results):
+            if success:
+                responses[name] = result
+            elif skip_failed and result.check(WorkBenchError):
+                log.warn('pull_many - could not pull repository "%s": %s' % (name, result.getErrorMessage()))
+            else:
+                result.raiseException()
+
+        defer.returnValue(responses)
+
 
 
     @defer.inlineCallbacks
@@ -590,11 +858,7 @@ class WorkBench(object):
         if repo.status != repo.UPTODATE:
             raise WorkBenchError('Invalid pull request. Requested Repository is in an invalid state.', request.ResponseCodes.BAD_REQUEST)
 
-        my_commits = self.list_repository_commits(repo)
-
-        puller_has = request.commit_keys
-
-        puller_needs = set(my_commits).difference(puller_has)
+        puller_needs = self.list_commits_needed(repo, request.commit_keys)
 
         response = yield self._process.message_client.create_instance(PULL_RESPONSE_MESSAGE_TYPE)
 
@@ -620,7 +884,8 @@ class WorkBench(object):
 
 
 
-        if request.get_head_content:
+        # If the puller has every commit it has the head content already - any it lacks is fetched on checkout
+        if request.get_head_content and puller_needs:
 
             keys = [x.GetLink('objectroot').key for x in repo.current_heads()]
 
@@ -653,6 +918,7 @@ class WorkBench(object):
         # Create the Structure Element in which the binary blob will be stored
         se = gpb_wrapper.StructureElement()
         repo = mutable.Repository
+        child_keys = []
         for link in  mutable.ChildLinks:
 
             if  repo.index_hash.has_key(link.key):
@@ -663,7 +929,9 @@ class WorkBench(object):
 
 
             # Save the link info as a convience for sending!
-            se.ChildLinks.add(link.key)
+            child_keys.append(link.key)
+
+        se.ChildLinks.update(child_keys)
 
         se.value = mutable.SerializeToString()
         #se.key = sha1hex(se.value)
@@ -856,6 +1124,7 @@ class WorkBench(object):
 
             # Now merge the state!
             self._update_repo_to_head(repo,new_head)
+            self._count_repository(repo)
             
 
 
@@ -867,30 +1136,76 @@ class WorkBench(object):
         log.info('op_push: Complete!')
 
 
-    @defer.inlineCallbacks
     def fetch_links(self, address, links):
         """
         Fetch the linked objects from another service
         Similar to the client pattern but must specify address!
 
         """
-        blobs_request = yield self._process.message_client.create_instance(BLOBS_REQUSET_MESSAGE_TYPE)
-
+        keys = []
         for link in links:
             assert link.ObjectType == LINK_TYPE, 'Invalid link in list passed to Fetch Links!'
-            blobs_request.blob_keys.append(link.key)
+            keys.append(link.key)
+
+        return self.fetch_keys(address, keys)
+
+    @defer.inlineCallbacks
+    def fetch_keys(self, address, keys):
+        """
+        Fetch the structure elements by key from another service
+        @param address is the name of the process or service which holds the elements
+        @param keys is an iterable of sha1 keys
+        @retval a dictionary of wrapped structure elements by key
+        """
+        elements = {}
+        missing_keys = []
+        for key in keys:
+            element = self._get_cached_blob(key)
+            if element is None:
+                missing_keys.append(key)
+            else:
+                elements[key] = element
+
+        if not missing_keys:
+            defer.returnValue(elements)
+
+        blobs_request = yield self._process.message_client.create_instance(BLOBS_REQUSET_MESSAGE_TYPE)
 
+        blobs_request.blob_keys.extend(missing_keys)
 
         blobs_msg, headers, msg = yield self._process.rpc_send(address,'fetch_blobs', blobs_request)
 
-        elements = {}
         for se in blobs_msg.blob_elements:
             # Put the new objects in the repository
             element = gpb_wrapper.StructureElement(se.GPBMessage)
             elements[element.key] = element
 
+            if self._blob_cache is not None:
+                self._blob_cache.put(element.key, element.serialize())
+
         defer.returnValue(elements)
 
+    def _get_cached_blob(self, key):
+        """
+        Get a structure element from the blob cache, None if it is not there
+        """
+        if self._blob_cache is None:
+            return None
+
+        blob = self._blob_cache.get(key)
+        if blob is None:
+            return None
+
+        return gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
+
+    def blob_cache_stats(self):
+        """
+        Returns the hit and miss counters of the blob cache used by this workbench
+        """
+        if self._blob_cache is None:
+            return {}
+        return self._blob_cache.stats()
+
     @defer.inlineCallbacks
     def fetch_blobs(self, address, request):
         """
@@ -919,6 +1234,10 @@ class WorkBench(object):
 
         for key in request.blob_keys:
             element = self._workbench_cache.get(key)
+            if element is None:
+                element = self._get_cached_blob(key)
+            if element is None:
+                element = get_element_pins().get(key)
             if element is None:
                 raise WorkBenchError('Invalid fetch objects request. Key Not Found!', request.ResponseCodes.NOT_FOUND)
 
@@ -972,6 +1291,71 @@ class WorkBench(object):
         key_list.extend(key_set)
         return key_list
 
+    def list_repository_heads(self, repo):
+        """
+        This method creates a compact list of the commits in a repository to advertise in a pull: the branch heads
+        and a skip list of the commits 1, 2, 4, 8... back along the first parent of each. A process which has a
+        commit has all of its ancestors, so the receiver of the list can work out the rest - see list_commits_needed.
+        The return value is a list of binary SHA1 keys
+        """
+        key_list = []
+        walked = set()
+        for branch in repo.branches:
+
+            for cref in branch.commitrefs:
+
+                distance = 0
+                while cref is not None and cref.MyId not in walked:
+                    walked.add(cref.MyId)
+
+                    # Advertise the head, each power of two back and the root commit
+                    if distance & (distance - 1) == 0 or len(cref.parentrefs) == 0:
+                        key_list.append(cref.MyId)
+
+                    if len(cref.parentrefs) == 0:
+                        cref = None
+                    else:
+                        cref = cref.parentrefs[0].commitref
+                    distance += 1
+
+        return key_list
+
+    def list_commits_needed(self, repo, puller_has):
+        """
+        This method finds the commits in a repository which a puller does not have.
+        @param puller_has the commit keys the puller advertised - all of its commits or a compact list from
+        list_repository_heads. Having a commit implies having its ancestors. Keys unknown here are ignored.
+        The return value is a list of binary SHA1 keys
+        """
+        # Map the commits in the repository
+        commits = {}
+        cref_set = set()
+        for branch in repo.branches:
+            for cref in branch.commitrefs:
+                cref_set.add(cref)
+
+        while len(cref_set) > 0:
+            new_set = set()
+            for cref in cref_set:
+                if cref.MyId not in commits:
+                    commits[cref.MyId] = cref
+                    for prefs in cref.parentrefs:
+                        new_set.add(prefs.commitref)
+            cref_set = new_set
+
+        # Everything reachable from what the puller advertised, it has
+        has = set()
+        stack = [commits[key] for key in puller_has if key in commits]
+        while len(stack) > 0:
+            cref = stack.pop()
+            if cref.MyId in has:
+                continue
+            has.add(cref.MyId)
+            for prefs in cref.parentrefs:
+                stack.append(prefs.commitref)
+
+        return [key for key in commits if key not in has]
+
     def list_repository_blobs(self, repo):
         """
         This method creates a list of all the blobs that exist in a repository
@@ -75,6 +75,8 @@ class Invocation(object):
         self.workbench = kwargs.get('workbench',None)
         self.note = None
         self.code = None
+        # Callables called once an outgoing message has been sent
+        self.sent_callbacks = []
 
     def drop(self, note=None, code=None):
         self.note = note
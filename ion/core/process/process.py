@@ -450,6 +450,13 @@ class Process(BasicLifecycleObject):
         """
         yield self.reply_ok(msg, {'pong':'pong'}, {'quiet':True})
 
+    @defer.inlineCallbacks
+    def op_workbench_stats(self, content, headers, msg):
+        """
+        Service operation: reply with the memory held by the workbench of this process
+        """
+        yield self.reply_ok(msg, self.workbench.memory_stats(), {'quiet':True})
+
     #    @defer.inlineCallbacks
     def op_sys_procexit(self, content, headers, msg):
         """
@@ -861,7 +868,7 @@ class Process(BasicLifecycleObject):
 
             # Remove RPC. Delayed result will go to catch operation
             conv.timeout = str(pu.currenttime_ms())
-            conv.blocking_deferred.errback(defer.TimeoutError())
+            conv.resume(failure.Failure(defer.TimeoutError()))
         if timeout:
             callto = reactor.callLater(timeout, _timeoutf)
             conv.blocking_deferred.rpc_call = callto
@@ -55,6 +55,8 @@ class ServiceProcess(Process):
         assert self.svc_name, "Service must have a declare with a valid name"
 
         # Create a receiver (inbound queue consumer) for service name
+        # The prefetch count and number of requests processed at a time can be
+        # set per service in the spawn args, otherwise the receiver defaults apply
         self.svc_receiver = ServiceWorkerReceiver(
                 label=self.svc_name+'.'+self.receiver.label,
                 name=self.svc_name,
@@ -62,7 +64,9 @@ class ServiceProcess(Process):
                 group=self.receiver.group,
                 process=self, # David added this - is it a good idea?
                 handler=self.receive,
-                error_handler=self.receive_error)
+                error_handler=self.receive_error,
+                prefetch_count=self.spawn_args.get('prefetch_count', None),
+                max_in_flight=self.spawn_args.get('max_in_flight', None))
         self.add_receiver(self.svc_receiver)
 
     @defer.inlineCallbacks
@@ -7,6 +7,7 @@
 """
 
 import ion.core.ioninit
+from ion.core.ioninit import request
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
@@ -15,7 +16,7 @@ import os
 import hashlib
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 
 from ion.core.process import service_process
@@ -228,6 +229,24 @@ class ProcessTest(IonTestCase):
         yield self.failUnlessFailure(self.test_sup.rpc_send(pid1,'echo_apperror','content123'), ReceivedApplicationError)
 
 
+    @defer.inlineCallbacks
+    def test_request_context_after_store_call(self):
+        """
+        A handler which sends an RPC after waiting on a store call still sends the user-id of its
+        request and keeps the conv-id of the request as its workbench context.
+        """
+        child1 = ProcessDesc(name='echo1', module='ion.core.process.test.test_process')
+        pid1 = yield self.test_sup.spawn_child(child1)
+        child2 = ProcessDesc(name='echo2', module='ion.core.process.test.test_process')
+        pid2 = yield self.test_sup.spawn_child(child2)
+
+        results = yield defer.DeferredList([
+            self.test_sup.rpc_send(pid1, 'echo_user_after_store', pid2, headers={'user-id':user_id})
+            for user_id in ('alice', 'bob')], fireOnOneErrback=True)
+
+        for user_id, (success, (content, hdrs, msg)) in zip(('alice', 'bob'), results):
+            self.assertEqual(content, '%s %s' % (user_id, hdrs['conv-id']))
+
     @defer.inlineCallbacks
     def test_send_byte_string(self):
         """
@@ -462,6 +481,18 @@ class EchoProcess(Process):
         # This is never reached!
         yield self.reply_ok(msg, content=content)
 
+    @defer.inlineCallbacks
+    def op_echo_user(self, content, headers, msg):
+        yield self.reply_ok(msg, content=headers.get('user-id'))
+
+    @defer.inlineCallbacks
+    def op_echo_user_after_store(self, content, headers, msg):
+        # Resume after a Deferred fired from another thread, as a store call does
+        yield threads.deferToThread(lambda: None)
+        (user_id, hdrs, rmsg) = yield self.rpc_send(content, 'echo_user', None)
+        workbench_context = request.get('workbench_context', [None])[-1]
+        yield self.reply_ok(msg, content='%s %s' % (user_id, workbench_context))
+
 # Spawn of the process using the module name
 factory = ProcessFactory(EchoProcess)
 
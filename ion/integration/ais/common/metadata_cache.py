@@ -117,11 +117,16 @@ class MetadataCache(object):
         log.debug('Found ' + str(numDSets) + ' datasets.')
 
         yield self.__lockCache()
-        
-        i = 0
-        while (i < numDSets):
-            yield self.__putDSetMetadata(dSetResults.idrefs[i].key)
-            i = i + 1
+
+        dSetIDs = [idref.key for idref in dSetResults.idrefs]
+        # A data set which could not be got with the rest is None - try it again on its own
+        dSets = yield self.rc.get_instances(dSetIDs, skip_failed=True)
+        for dSetID, dSet in zip(dSetIDs, dSets):
+            if dSet is None:
+                log.error('Error getting data set ' + dSetID + ' with the rest - loading it on its own.')
+                yield self.__putDSetMetadata(dSetID)
+            else:
+                yield self.__loadDSetMetadata(dSet)
 
         self.__unlockCache()
             
@@ -149,11 +154,16 @@ class MetadataCache(object):
         log.debug('Found ' + str(numDSources) + ' datasources.')
 
         yield self.__lockCache()
-        
-        i = 0
-        while (i < numDSources):
-            yield self.__putDSourceMetadata(dSourceResults.idrefs[i].key)
-            i = i + 1
+
+        dSourceIDs = [idref.key for idref in dSourceResults.idrefs]
+        # A data source which could not be got with the rest is None - try it again on its own
+        dSources = yield self.rc.get_instances(dSourceIDs, skip_failed=True)
+        for dSourceID, dSource in zip(dSourceIDs, dSources):
+            if dSource is None:
+                log.error('Error getting data source ' + dSourceID + ' with the rest - loading it on its own.')
+                yield self.__putDSourceMetadata(dSourceID)
+            else:
+                self.__loadDSourceMetadata(dSource)
 
         self.__unlockCache()
             
@@ -20,7 +20,6 @@ import ion.util.procutils as pu
 
 
 import string
-import smtplib
 import time
 from datetime import datetime
 
@@ -32,6 +31,7 @@ from ion.core.process.process import ProcessFactory
 
 from ion.core.exception import ReceivedApplicationError, ApplicationError
 from ion.core.data.store import Query
+from ion.integration.ais.notification_delivery import AlertDelivery, SMTPConnectionPool, UserEmailCache
 from ion.services.dm.distribution.events import DatasetSupplementAddedEventSubscriber, DatasourceUnavailableEventSubscriber
 
 
@@ -44,6 +44,8 @@ from ion.integration.ais.ais_object_identifiers import AIS_REQUEST_MSG_TYPE, \
 RESOURCE_CFG_REQUEST_TYPE = object_utils.create_type_identifier(object_id=10, version=1)
 USER_OOIID_TYPE = object_utils.create_type_identifier(object_id=1403, version=1)
 
+ALERT_FROM = 'OOI@ucsd.edu'
+
 
 class NotificationAlertError(ApplicationError):
     """
@@ -83,10 +85,51 @@ class NotificationAlertService(ServiceProcess):
         self.index_store_class = pu.get_class(index_store_class_name)
         self.index_store = self.index_store_class(self, indices=SUBSCRIPTION_INDEXED_COLUMNS )
 
+        # Alert emails are queued and sent in the background over a pool of SMTP connections
+        smtp_pool = SMTPConnectionPool(self.spawn_args.get('smtp_host', CONF.getValue('smtp_host', 'mail.oceanobservatories.org')),
+                                       self.spawn_args.get('smtp_port', CONF.getValue('smtp_port', 25)),
+                                       size=CONF.getValue('smtp_pool_size', 4))
+        self.delivery = AlertDelivery(smtp_pool, ALERT_FROM,
+                                      batch_window=CONF.getValue('alert_batch_window', 1.0),
+                                      max_retries=CONF.getValue('alert_max_retries', 5),
+                                      retry_delay=CONF.getValue('alert_retry_delay', 10.0))
+        self.user_emails = UserEmailCache(self.GetUserEmail, ttl=CONF.getValue('user_email_ttl', 300))
+
 
     def slc_init(self):
         pass
 
+    @defer.inlineCallbacks
+    def slc_terminate(self):
+        # Send the alerts still waiting in the batch window, but don't hold up the shutdown for retries
+        yield self.delivery.drain(timeout=CONF.getValue('alert_drain_timeout', 5.0))
+        log.info('NotificationAlertService alert delivery: %s', self.delivery.stats())
+        self.delivery.stop()
+
+    @defer.inlineCallbacks
+    def queue_alerts(self, rows, subscriptionInfo, alerts_filters, SUBJECT, BODY):
+        """
+        Queue the alert email for each of the subscriptions which want email alerts of this kind. The email
+        addresses of the users are looked up together, the emails are sent in the background.
+        @param rows the subscriptions to the data source
+        @param subscriptionInfo a SUBSCRIPTION_INFO_TYPE object, for its enums
+        @param alerts_filters the email_alerts_filter values which select this alert
+        """
+        email_types = (subscriptionInfo.SubscriptionType.EMAIL, subscriptionInfo.SubscriptionType.EMAILANDDISPATCHER)
+
+        user_ids = [row['user_ooi_id'] for row in rows.itervalues()
+                    if row['subscription_type'] in email_types and row['email_alerts_filter'] in alerts_filters]
+
+        emails = yield self.user_emails.get_many(user_ids)
+        for user_id in user_ids:
+            TO = emails[user_id]
+            if not TO:
+                log.warning('NotificationAlertService.queue_alerts no email address for user %s', user_id)
+                continue
+            self.delivery.queue(TO, SUBJECT, BODY)
+
+        log.info('NotificationAlertService.queue_alerts queued %d alerts, delivery: %s', len(user_ids), self.delivery.stats())
+
 
     @defer.inlineCallbacks
     def handle_offline_event(self, content):
@@ -109,43 +152,11 @@ class NotificationAlertService(ServiceProcess):
                             "",
                             "You received this notification form ION because you asked to be notified about changes to this data resource. ",
                             "To modify or remove notifications about this data resource, please access My Notifications Settings in the ION Web UI."  ), "\r\n")
-        #add each result row into the response message
-        for key, row in rows.iteritems ( ) :
-            log.info("NotificationAlertService.handle_offline_event  First row data set id %s", rows[key]['data_src_id'] )
-
-            tempTbl = {}
-            # get the user information from the Identity Registry
-            yield self.GetUserInformation(rows[key]['user_ooi_id'], tempTbl)
-            log.info('NotificationAlertService.handle_offline_event user email: %s', tempTbl['user_email'] )
-
-            #rows[key]['subscription_type'] == SUBSCRIPTION_INFO_TYPE.subscription_type.EMAIL
-            if (rows[key]['subscription_type'] == subscriptionInfo.SubscriptionType.EMAIL  or rows[key]['subscription_type'] == subscriptionInfo.SubscriptionType.EMAILANDDISPATCHER ) \
-                and (rows[key]['email_alerts_filter'] == subscriptionInfo.AlertsFilter.DATASOURCEOFFLINE  or  rows[key]['email_alerts_filter'] == subscriptionInfo.AlertsFilter.UPDATESANDDATASOURCEOFFLINE ) :
-                # Send the message via our own SMTP server, but don't include the envelope header.
-                # Create the container (outer) email message.
-                log.info('NotificationAlertService.handle_offline_event CREATE EMAIL')
-                FROM = 'OOI@ucsd.edu'
-                TO = tempTbl['user_email']
-
-                body = string.join((
-
-
-                    "From: %s" % FROM,
-                    "To: %s" % TO,
-                    "Subject: %s" % SUBJECT,
-                    "",
-                    BODY), "\r\n")
-
-
-                try:
-                   smtpObj = smtplib.SMTP('mail.oceanobservatories.org', 25, 'localhost')
-                   smtpObj.sendmail(FROM, [TO], body)
-                   log.info('NotificationAlertService.handle_offline_event Successfully sent email' )
-                except smtplib.SMTPException:
-                    log.info('NotificationAlertService.handle_offline_event Error: unable to send email')
-                except Exception, ex:
-                    log.warning('NotificationAlertService.handle_offline_event Error: %s' %str(ex))
-                log.info('NotificationAlertService.handle_offline_event completed ')
+
+        yield self.queue_alerts(rows, subscriptionInfo,
+                                (subscriptionInfo.AlertsFilter.DATASOURCEOFFLINE, subscriptionInfo.AlertsFilter.UPDATESANDDATASOURCEOFFLINE),
+                                SUBJECT, BODY)
+        log.info('NotificationAlertService.handle_offline_event completed ')
 
     @defer.inlineCallbacks
     def handle_update_event(self, content):
@@ -180,41 +191,10 @@ class NotificationAlertService(ServiceProcess):
                             "You received this notification form ION because you asked to be notified about changes to this data resource. ",
                             "To modify or remove notifications about this data resource, please access My Notifications Settings in the ION Web UI."  ), "\r\n")
 
-            #add each result row into the response message
-            for key, row in rows.iteritems ( ) :
-                log.info("NotificationAlertService.handle_update_event  First row data set id %s", rows[key]['data_src_id'] )
-
-                tempTbl = {}
-                # get the user information from the Identity Registry
-                yield self.GetUserInformation(rows[key]['user_ooi_id'], tempTbl)
-                log.info('NotificationAlertService.handle_update_event user email: %s', tempTbl['user_email'] )
-
-                if (rows[key]['subscription_type'] == subscriptionInfo.SubscriptionType.EMAIL  or rows[key]['subscription_type'] == subscriptionInfo.SubscriptionType.EMAILANDDISPATCHER ) \
-                    and (rows[key]['email_alerts_filter'] == subscriptionInfo.AlertsFilter.UPDATES  or  rows[key]['email_alerts_filter'] == subscriptionInfo.AlertsFilter.UPDATESANDDATASOURCEOFFLINE ) :
-                    # Send the message via our own SMTP server, but don't include the envelope header.
-                    # Create the container (outer) email message.
-                    log.info('NotificationAlertService.handle_update_event CREATE EMAIL')
-                    FROM = 'OOI@ucsd.edu'
-                    TO = tempTbl['user_email']
-
-                    body = string.join((
-
-                        "From: %s" % FROM,
-                        "To: %s" % TO,
-                        "Subject: %s" % SUBJECT,
-                        "",
-                        BODY), "\r\n")
-
-
-                    try:
-                       smtpObj = smtplib.SMTP('mail.oceanobservatories.org', 25, 'localhost')
-                       smtpObj.sendmail(FROM, [TO], body)
-                       log.info('NotificationAlertService.handle_update_event Successfully sent email' )
-                    except smtplib.SMTPException:
-                        log.info('NotificationAlertService.handle_update_event Error: unable to send email')
-                    except Exception, ex:
-                        log.warning('NotificationAlertService.handle_offline_event Error: %s'% str(ex))
-                    log.info('NotificationAlertService.handle_update_event completed ')
+            yield self.queue_alerts(rows, subscriptionInfo,
+                                    (subscriptionInfo.AlertsFilter.UPDATES, subscriptionInfo.AlertsFilter.UPDATESANDDATASOURCEOFFLINE),
+                                    SUBJECT, BODY)
+            log.info('NotificationAlertService.handle_update_event completed ')
 
 
     @defer.inlineCallbacks
@@ -613,6 +593,18 @@ class NotificationAlertService(ServiceProcess):
 
         defer.returnValue(None)
 
+    @defer.inlineCallbacks
+    def GetUserEmail(self, user_ooi_id):
+        """
+        Look up the email address of a user in the Identity Registry, for the user email cache.
+        """
+        Request = yield self.mc.create_instance(RESOURCE_CFG_REQUEST_TYPE)
+        Request.configuration = Request.CreateObject(USER_OOIID_TYPE)
+        Request.configuration.ooi_id = user_ooi_id
+
+        user_info = yield self.irc.get_user(Request)
+        defer.returnValue(user_info.resource_reference.email)
+
     """
 
     @defer.inlineCallbacks
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+"""
+@file ion/integration/ais/notification_delivery.py
+@brief Asynchronous delivery of notification alert emails: a pool of SMTP client connections, a delivery queue
+which batches the alerts for each recipient and retries failed sends with back-off, a cache of user email
+addresses and a local SMTP server to deliver to in tests.
+"""
+
+from cStringIO import StringIO
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol, reactor
+from twisted.mail import smtp
+from twisted.python import failure
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+
+class _SMTPJob(object):
+    """
+    One email waiting for, or being sent over, a pool connection.
+    """
+    __slots__ = ('from_addr', 'to_addrs', 'msg', 'deferred')
+
+    def __init__(self, from_addr, to_addrs, msg):
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.msg = msg
+        self.deferred = defer.Deferred()
+
+
+class _PooledSMTPClient(smtp.SMTPClient):
+    """
+    SMTP client connection which sends the emails queued in its pool one after the other until the queue is
+    empty, then quits.
+    """
+    debug = False
+
+    def __init__(self, pool):
+        smtp.SMTPClient.__init__(self, pool.identity)
+        self.pool = pool
+        self.timeout = pool.timeout
+        self.job = None
+        # False until the server accepted the greeting and the connection asked for an email to send
+        self.ready = False
+        self.error = None
+
+    def getMailFrom(self):
+        self.ready = True
+        self.job = self.pool._next_job()
+        if self.job is None:
+            return None
+        return self.job.from_addr
+
+    def getMailTo(self):
+        return self.job.to_addrs
+
+    def getMailData(self):
+        return StringIO(self.job.msg)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        job, self.job = self.job, None
+        if numOk > 0 and code in smtp.SUCCESS:
+            job.deferred.callback(numOk)
+        else:
+            job.deferred.errback(smtp.SMTPDeliveryError(code, resp, log.str(), addresses))
+
+    def sendError(self, exc):
+        self.error = exc
+        self._fail_job(exc)
+        smtp.SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.SMTPClient.connectionLost(self, reason)
+        self._fail_job(reason.value)
+        if self.ready:
+            self.pool._connection_closed()
+        else:
+            # Refused at the greeting or HELO - the connection never took an email
+            self.pool._connection_failed(failure.Failure(self.error or reason.value))
+
+    def _fail_job(self, exc):
+        job, self.job = self.job, None
+        if job is not None:
+            job.deferred.errback(exc)
+
+
+class _PooledSMTPClientFactory(protocol.ClientFactory):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        return _PooledSMTPClient(self.pool)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool._connection_failed(reason)
+
+
+class SMTPConnectionPool(object):
+    """
+    Sends emails over at most size concurrent SMTP connections. A connection sends queued emails one after the
+    other for as long as there are any, so a burst of emails does not open a connection for each.
+    """
+
+    def __init__(self, host, port=25, size=4, identity='localhost', timeout=60, connector=None):
+        """
+        @param host the SMTP server
+        @param size the maximum number of open connections
+        @param identity the name the client gives in HELO
+        @param timeout seconds to wait for a response from the server
+        @param connector an IReactorTCP provider, the reactor by default
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.identity = identity
+        self.timeout = timeout
+        self.connector = connector or reactor
+
+        self.connections = 0
+        self._jobs = []
+        self._idle_waiters = []
+
+    def send(self, from_addr, to_addrs, msg):
+        """
+        @param msg the message text including headers
+        @retval Deferred, fires with the number of recipients accepted or fails with the SMTP error
+        """
+        job = _SMTPJob(from_addr, to_addrs, msg)
+        self._jobs.append(job)
+        if self.connections < self.size and len(self._jobs) > self.connections:
+            self._connect()
+        return job.deferred
+
+    def _connect(self):
+        self.connections += 1
+        self.connector.connectTCP(self.host, self.port, _PooledSMTPClientFactory(self), timeout=self.timeout)
+
+    def wait_idle(self):
+        """
+        @retval Deferred, fires once all of the connections are closed
+        """
+        if self.connections == 0:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle_waiters.append(d)
+        return d
+
+    def _next_job(self):
+        if self._jobs:
+            return self._jobs.pop(0)
+        return None
+
+    def _connection_closed(self):
+        self.connections -= 1
+        if self._jobs and self.connections < self.size:
+            self._connect()
+        self._check_idle()
+
+    def _connection_failed(self, reason):
+        """
+        A connection could not be made or was closed before it took any email.
+        """
+        self.connections -= 1
+        if self.connections == 0:
+            # No connection will take the queued emails - fail them so that they are retried later
+            jobs, self._jobs = self._jobs, []
+            for job in jobs:
+                job.deferred.errback(reason)
+        self._check_idle()
+
+    def _check_idle(self):
+        if self.connections == 0:
+            waiters, self._idle_waiters = self._idle_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+
+def is_permanent_failure(reason):
+    """
+    SMTP 5xx replies are permanent, anything else may succeed when retried.
+    """
+    code = getattr(reason.value, 'code', None)
+    return isinstance(code, int) and 500 <= code < 600
+
+
+class AlertDelivery(object):
+    """
+    Queue of alert emails. Alerts are collected for batch_window seconds and all of the alerts for a recipient
+    are sent in one email. Failed sends are retried after retry_delay seconds, doubling each time, at most
+    max_retries times.
+    """
+
+    def __init__(self, sender, from_addr, batch_window=1.0, max_retries=5, retry_delay=10.0, clock=None):
+        """
+        @param sender an object with a send(from_addr, to_addrs, msg) method returning a Deferred, eg. an
+        SMTPConnectionPool
+        @param clock an IReactorTime provider, the reactor by default
+        """
+        self.sender = sender
+        self.from_addr = from_addr
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.clock = clock or reactor
+
+        # recipient -> list of (subject, body, time queued)
+        self._pending = {}
+        self._flush_call = None
+        self._retry_calls = set()
+        self._in_flight = 0
+        self._drain_waiters = []
+
+        self.queued = 0
+        self.sent_alerts = 0
+        self.sent_emails = 0
+        self.retries = 0
+        self.failed_alerts = 0
+        self.total_delay = 0.0
+        self.first_queued = None
+        self.last_sent = None
+
+    def queue(self, to_addr, subject, body):
+        """
+        Queue an alert email. Returns at once, the email is sent in the background.
+        """
+        now = self.clock.seconds()
+        if self.first_queued is None:
+            self.first_queued = now
+
+        self._pending.setdefault(to_addr, []).append((subject, body, now))
+        self.queued += 1
+
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.batch_window, self.flush)
+
+    def flush(self):
+        """
+        Send the queued alerts now, one email per recipient.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        pending, self._pending = self._pending, {}
+        for to_addr, alerts in pending.iteritems():
+            self._deliver(to_addr, alerts, 0)
+
+    def drain(self, timeout=None):
+        """
+        @param timeout seconds to wait at most, None to wait for as long as it takes
+        @retval Deferred, fires once all of the alerts queued so far have been sent or have failed, or once
+        timeout seconds have passed
+        """
+        self.flush()
+        if self._idle():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+
+        if timeout is not None:
+            def expired():
+                if d in self._drain_waiters:
+                    self._drain_waiters.remove(d)
+                    d.callback(None)
+            call = self.clock.callLater(timeout, expired)
+            def done(result):
+                if call.active():
+                    call.cancel()
+                return result
+            d.addBoth(done)
+        return d
+
+    def stop(self):
+        """
+        Cancel the pending flush and retries. Alerts which have not been sent are dropped.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        for call in self._retry_calls:
+            if call.active():
+                call.cancel()
+        self._retry_calls.clear()
+
+    def stats(self):
+        """
+        @retval a dictionary of delivery counters and throughput
+        """
+        rate = 0.0
+        if self.sent_alerts and self.last_sent > self.first_queued:
+            rate = self.sent_alerts / (self.last_sent - self.first_queued)
+
+        mean_delay = 0.0
+        if self.sent_alerts:
+            mean_delay = self.total_delay / self.sent_alerts
+
+        return {'queued': self.queued,
+                'sent_alerts': self.sent_alerts,
+                'sent_emails': self.sent_emails,
+                'retries': self.retries,
+                'failed_alerts': self.failed_alerts,
+                'pending_alerts': sum(len(alerts) for alerts in self._pending.itervalues()),
+                'in_flight': self._in_flight,
+                'alerts_per_second': rate,
+                'mean_delay': mean_delay}
+
+    def format_email(self, to_addr, alerts):
+        """
+        @param alerts a list of (subject, body, time queued) for the recipient
+        @retval the text of one email holding all of the alerts
+        """
+        if len(alerts) == 1:
+            subject, body = alerts[0][:2]
+        else:
+            subjects = set(alert[0] for alert in alerts)
+            if len(subjects) == 1:
+                subject = subjects.pop()
+            else:
+                subject = "%d ION Data Alerts" % len(alerts)
+            body = "\r\n\r\n----------\r\n\r\n".join(
+                "%s\r\n\r\n%s" % (alert_subject, alert_body) for alert_subject, alert_body, queued in alerts)
+
+        return "\r\n".join(("From: %s" % self.from_addr,
+                            "To: %s" % to_addr,
+                            "Subject: %s" % subject,
+                            "",
+                            body))
+
+    def _deliver(self, to_addr, alerts, attempt):
+        self._in_flight += 1
+        d = self.sender.send(self.from_addr, [to_addr], self.format_email(to_addr, alerts))
+        d.addCallbacks(self._sent, self._send_failed, callbackArgs=(to_addr, alerts), errbackArgs=(to_addr, alerts, attempt))
+        d.addBoth(self._delivered)
+
+    def _sent(self, result, to_addr, alerts):
+        now = self.clock.seconds()
+        self.sent_emails += 1
+        self.sent_alerts += len(alerts)
+        self.total_delay += sum(now - queued for subject, body, queued in alerts)
+        self.last_sent = now
+        log.debug('Sent %d alerts to %s' % (len(alerts), to_addr))
+
+    def _send_failed(self, reason, to_addr, alerts, attempt):
+        if attempt >= self.max_retries or is_permanent_failure(reason):
+            self.failed_alerts += len(alerts)
+            log.warn('Failed to send %d alerts to %s after %d attempts: %s' % (len(alerts), to_addr, attempt + 1, reason.getErrorMessage()))
+            return
+
+        delay = self.retry_delay * (2 ** attempt)
+        log.info('Failed to send alerts to %s, retrying in %.1f seconds: %s' % (to_addr, delay, reason.getErrorMessage()))
+        self.retries += 1
+
+        # The retry counts as in flight until it is sent
+        self._in_flight += 1
+        def retry():
+            self._retry_calls.discard(call)
+            self._in_flight -= 1
+            self._deliver(to_addr, alerts, attempt + 1)
+        call = self.clock.callLater(delay, retry)
+        self._retry_calls.add(call)
+
+    def _delivered(self, result):
+        self._in_flight -= 1
+        if self._idle():
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _idle(self):
+        return self._in_flight == 0 and not self._pending
+
+
+class UserEmailCache(object):
+    """
+    Caches the email address of users for ttl seconds. Addresses which are not cached are looked up
+    concurrently, and a user which is already being looked up is not looked up again.
+    """
+
+    def __init__(self, lookup, ttl=300, clock=None):
+        """
+        @param lookup a callable taking a user id and returning a Deferred for the user's email address
+        """
+        self.lookup = lookup
+        self.ttl = ttl
+        self.clock = clock or reactor
+
+        # user id -> (email, time looked up)
+        self.emails = {}
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, user_ids):
+        """
+        @retval Deferred, for a dictionary of user id to email address. The address is None for users which
+        could not be looked up.
+        """
+        now = self.clock.seconds()
+        result = {}
+        lookups = {}
+        for user_id in set(user_ids):
+            cached = self.emails.get(user_id)
+            if cached is not None and now - cached[1] < self.ttl:
+                self.hits += 1
+                result[user_id] = cached[0]
+            else:
+                self.misses += 1
+                lookups[user_id] = self._get(user_id)
+
+        if not lookups:
+            return defer.succeed(result)
+
+        ids = lookups.keys()
+        d = defer.DeferredList([lookups[user_id] for user_id in ids], consumeErrors=True)
+        def got_emails(results):
+            for user_id, (success, email) in zip(ids, results):
+                if success:
+                    result[user_id] = email
+                else:
+                    log.warn('Could not get the email address of user %s: %s' % (user_id, email.getErrorMessage()))
+                    result[user_id] = None
+            return result
+        d.addCallback(got_emails)
+        return d
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self.emails.clear()
+        else:
+            self.emails.pop(user_id, None)
+
+    def _get(self, user_id):
+        waiters = self._in_flight.get(user_id)
+        if waiters is None:
+            waiters = self._in_flight[user_id] = []
+            d = defer.maybeDeferred(self.lookup, user_id)
+            d.addBoth(self._got, user_id)
+
+        waiter = defer.Deferred()
+        waiters.append(waiter)
+        return waiter
+
+    def _got(self, result, user_id):
+        waiters = self._in_flight.pop(user_id)
+        if not isinstance(result, failure.Failure):
+            self.emails[user_id] = (result, self.clock.seconds())
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+
+class _LocalMessage(object):
+    implements(smtp.IMessage)
+
+    def __init__(self, server, origin, recipient):
+        self.server = server
+        self.origin = origin
+        self.recipient = recipient
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        self.server.messages.append((self.origin, self.recipient, '\n'.join(self.lines)))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        self.lines = None
+
+
+class _LocalDelivery(object):
+    implements(smtp.IMessageDelivery)
+
+    def __init__(self, server):
+        self.server = server
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        recipient = str(user.dest)
+        if recipient in self.server.rejected:
+            raise smtp.SMTPBadRcpt(user)
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            raise smtp.SMTPServerError(451, 'Local SMTP server asked to fail')
+        origin = str(user.orig)
+        return lambda: _LocalMessage(self.server, origin, recipient)
+
+
+class _LocalSMTP(smtp.SMTP):
+
+    def connectionMade(self):
+        if self.factory.server.refuse:
+            self.sendCode(421, 'Local SMTP server asked to refuse connections')
+            self.transport.loseConnection()
+            return
+        smtp.SMTP.connectionMade(self)
+
+    def connectionLost(self, reason):
+        smtp.SMTP.connectionLost(self, reason)
+        self.factory.server._connection_lost(self)
+
+
+class _LocalSMTPFactory(smtp.SMTPFactory):
+    protocol = _LocalSMTP
+
+    def __init__(self, server):
+        smtp.SMTPFactory.__init__(self)
+        self.server = server
+
+    def buildProtocol(self, addr):
+        p = smtp.SMTPFactory.buildProtocol(self, addr)
+        p.delivery = _LocalDelivery(self.server)
+        self.server.connections += 1
+        self.server._protocols.add(p)
+        return p
+
+
+class LocalSMTPServer(object):
+    """
+    An SMTP server on localhost which keeps the messages it receives in memory, to deliver alerts to in tests
+    and development. Configure the notification alert service with its port as smtp_port and localhost as
+    smtp_host.
+
+    @var messages a list of (from address, recipient, message text) tuples
+    @var rejected recipient addresses which are refused with a permanent error
+    @var failures the number of recipients to refuse with a temporary error, eg. to exercise retries
+    @var refuse if True, connections are refused with a 421 greeting
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.rejected = set()
+        self.failures = 0
+        self.refuse = False
+        self.connections = 0
+        self.port = None
+        self._protocols = set()
+        self._closed_waiters = []
+
+    def start(self, port=0):
+        """
+        @retval the port the server listens on
+        """
+        self.port = reactor.listenTCP(port, _LocalSMTPFactory(self), interface='127.0.0.1')
+        return self.port.getHost().port
+
+    def stop(self):
+        """
+        Stop listening and close the open connections.
+        @retval Deferred, fires once the server is stopped
+        """
+        ds = []
+        port, self.port = self.port, None
+        if port is not None:
+            ds.append(defer.maybeDeferred(port.stopListening))
+
+        if self._protocols:
+            d = defer.Deferred()
+            self._closed_waiters.append(d)
+            ds.append(d)
+            for p in list(self._protocols):
+                p.transport.loseConnection()
+
+        return defer.DeferredList(ds)
+
+    def _connection_lost(self, p):
+        self._protocols.discard(p)
+        if not self._protocols:
+            waiters, self._closed_waiters = self._closed_waiters, []
+            for d in waiters:
+                d.callback(None)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+@file ion/integration/ais/test/test_notification_delivery.py
+@test ion.integration.ais.notification_delivery Alert batching, SMTP connection pool, retries and user lookups
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from ion.integration.ais.notification_delivery import AlertDelivery, SMTPConnectionPool, UserEmailCache, \
+                                                      LocalSMTPServer
+
+
+class AlertDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalSMTPServer()
+        port = self.server.start()
+        self.pool = SMTPConnectionPool('127.0.0.1', port, size=2)
+        self.delivery = AlertDelivery(self.pool, 'OOI@ucsd.edu', batch_window=0.01, max_retries=2, retry_delay=0.01)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.delivery.stop()
+        yield self.pool.wait_idle()
+        yield self.server.stop()
+
+    @defer.inlineCallbacks
+    def test_batch_per_recipient(self):
+        recipients = ['user%d@example.com' % i for i in range(5)]
+        for i in range(20):
+            self.delivery.queue(recipients[i % 5], 'ION Data Alert for data resource %d' % (i % 2), 'Alert %d' % i)
+
+        yield self.delivery.drain()
+
+        self.assertEqual(sorted(to for origin, to, text in self.server.messages), recipients)
+        self.assertTrue(self.server.connections <= 2)
+
+        text = dict((to, text) for origin, to, text in self.server.messages)['user0@example.com']
+        self.assertIn('To: user0@example.com', text)
+        self.assertIn('Subject: 4 ION Data Alerts', text)
+        for i in (0, 5, 10, 15):
+            self.assertIn('Alert %d' % i, text)
+
+        stats = self.delivery.stats()
+        self.assertEqual(stats['queued'], 20)
+        self.assertEqual(stats['sent_alerts'], 20)
+        self.assertEqual(stats['sent_emails'], 5)
+        self.assertEqual(stats['pending_alerts'], 0)
+        self.assertEqual(stats['in_flight'], 0)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        self.server.failures = 2
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+
+        yield self.delivery.drain()
+
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(self.delivery.retries, 2)
+        self.assertEqual(self.delivery.sent_alerts, 1)
+
+    @defer.inlineCallbacks
+    def test_retries_exhausted(self):
+        self.server.failures = 10
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+
+        yield self.delivery.drain()
+
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(self.delivery.retries, 2)
+        self.assertEqual(self.delivery.failed_alerts, 1)
+
+    @defer.inlineCallbacks
+    def test_permanent_failure(self):
+        self.server.rejected.add('nobody@example.com')
+        self.delivery.queue('nobody@example.com', 'Subject', 'Body')
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+
+        yield self.delivery.drain()
+
+        self.assertEqual([to for origin, to, text in self.server.messages], ['user@example.com'])
+        self.assertEqual(self.delivery.retries, 0)
+        self.assertEqual(self.delivery.failed_alerts, 1)
+
+    @defer.inlineCallbacks
+    def test_server_down(self):
+        yield self.server.stop()
+
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+        yield self.delivery.drain()
+
+        self.assertEqual(self.delivery.failed_alerts, 1)
+        self.assertEqual(self.pool.connections, 0)
+
+    @defer.inlineCallbacks
+    def test_greeting_refused(self):
+        self.server.refuse = True
+
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+        yield self.delivery.drain()
+
+        # Each attempt fails once the connection is refused instead of reconnecting
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.delivery.retries, 2)
+        self.assertEqual(self.delivery.failed_alerts, 1)
+        self.assertEqual(self.pool.connections, 0)
+
+    @defer.inlineCallbacks
+    def test_drain_timeout(self):
+        self.server.failures = 10
+        self.delivery.retry_delay = 60
+
+        self.delivery.queue('user@example.com', 'Subject', 'Body')
+        yield self.delivery.drain(timeout=0.1)
+
+        # The retry is still waiting - tearDown stops it
+        self.assertEqual(self.delivery.retries, 1)
+        self.assertEqual(self.delivery.stats()['in_flight'], 1)
+
+
+class UserEmailCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lookups = []
+
+        def lookup(user_id):
+            d = defer.Deferred()
+            self.lookups.append((user_id, d))
+            return d
+
+        self.cache = UserEmailCache(lookup, ttl=60, clock=self.clock)
+
+    def _answer(self):
+        lookups, self.lookups = self.lookups, []
+        for user_id, d in lookups:
+            if user_id == 'unknown':
+                d.errback(KeyError(user_id))
+            else:
+                d.callback(user_id + '@example.com')
+
+    def test_concurrent_lookups(self):
+        d1 = self.cache.get_many(['a', 'b', 'unknown'])
+        d2 = self.cache.get_many(['b', 'c'])
+
+        # all of the lookups are made at once, and b only once
+        self.assertEqual(sorted(user_id for user_id, d in self.lookups), ['a', 'b', 'c', 'unknown'])
+        self._answer()
+
+        self.assertEqual(self.successResultOf(d1), {'a': 'a@example.com', 'b': 'b@example.com', 'unknown': None})
+        self.assertEqual(self.successResultOf(d2), {'b': 'b@example.com', 'c': 'c@example.com'})
+
+    def test_ttl(self):
+        self.cache.get_many(['a'])
+        self._answer()
+
+        self.clock.advance(30)
+        d = self.cache.get_many(['a'])
+        self.assertEqual(self.lookups, [])
+        self.assertEqual(self.successResultOf(d), {'a': 'a@example.com'})
+
+        self.clock.advance(31)
+        self.cache.get_many(['a'])
+        self.assertEqual(len(self.lookups), 1)
+
+    def successResultOf(self, d):
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
@@ -90,6 +90,23 @@ class Conversation(object):
         # Marks a timeout in the conversation processing
         self.timeout = None
         self.conv_log = []
+        # The request context the conversation was started in
+        self.context = None
+
+    def resume(self, result):
+        """
+        @brief Fires the blocking deferred with the result of a blocking send,
+            errback if result is a Failure, with the request context the
+            conversation was started in active.
+        """
+        if isinstance(result, failure.Failure):
+            fire = self.blocking_deferred.errback
+        else:
+            fire = self.blocking_deferred.callback
+
+        if self.context is None:
+            return fire(result)
+        return ioninit.request.call_in_context(self.context, fire, result)
 
     def bind_role_local(self, role_id, process):
         self.bind_role(role_id, process.id)
@@ -308,12 +325,24 @@ class ProcessConversationManager(object):
     def new_conversation(self, conv_type_id, conv_id=None):
         conv_id = conv_id or self.create_conversation_id()
         conv_inst = self.conv_mgr.new_conversation(conv_type_id, conv_id)
+        conv_inst.context = ioninit.request.current
         self.conversations[conv_inst.conv_id] = conv_inst
         return conv_inst
 
     def get_conversation(self, conv_id):
         return self.conversations.get(conv_id, None)
 
+    def get_context(self, conv_id):
+        """
+        @brief The request context of an ongoing conversation, eg. to process an
+            RPC reply in the context of the request that is waiting for it
+        @retval RequestContext or None if there is no such conversation
+        """
+        conv = self.conversations.get(conv_id, None)
+        if conv is None:
+            return None
+        return conv.context
+
     def get_or_create_conversation(self, conv_id, message, initiator=False):
         """
         @brief Gets cached Conversation instance by conv-id header or creates
@@ -127,7 +127,7 @@ class RpcInitiator(ConversationRole):
         if status == process.ION_OK:
             if rpc_deferred:
                 #Cannot do the callback right away, because the message is not yet handled
-                reactor.callLater(0, lambda: rpc_deferred.callback(res))
+                reactor.callLater(0, conv.resume, res)
             else:
                 log.error("ERROR. Do not support non-blocking RPC yet")
 
@@ -146,7 +146,7 @@ class RpcInitiator(ConversationRole):
 
             if rpc_deferred:
                 # Cannot do the callback right away, because the message is not yet handled
-                reactor.callLater(0, lambda: rpc_deferred.errback(err))
+                reactor.callLater(0, conv.resume, err)
             else:
                 log.error("ERROR. Do not support non-blocking RPC yet")
 
@@ -154,7 +154,7 @@ class RpcInitiator(ConversationRole):
             log.error('RPC reply is not well formed. Header "status" must be set!')
             if rpc_deferred:
                 #Cannot do the callback right away, because the message is not yet handled
-                reactor.callLater(0, lambda: rpc_deferred.callback(res))
+                reactor.callLater(0, conv.resume, res)
             else:
                 log.error("ERROR. Do not support non-blocking RPC yet")
 
@@ -10,12 +10,17 @@ there but resource types are not...
 
 """
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ion.core.object.object_utils import CDM_ARRAY_INT32_TYPE, CDM_ARRAY_INT64_TYPE, CDM_ARRAY_UINT64_TYPE, CDM_ARRAY_FLOAT32_TYPE, CDM_ARRAY_FLOAT64_TYPE, CDM_ARRAY_STRING_TYPE, CDM_ARRAY_OPAQUE_TYPE, CDM_ARRAY_UINT32_TYPE, ARRAY_STRUCTURE_TYPE
 from ion.util.cache import LRUDict
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 import ion.util.procutils as pu
 from ion.core.process.process import ProcessFactory
@@ -28,6 +33,7 @@ from types import FunctionType
 
 from ion.core.object import object_utils
 from ion.core.object import gpb_wrapper, repository
+from ion.core.object.cdm_methods.variables import hyperslab_slices, NUMPY_DTYPES
 from ion.core.object.workbench import WorkBench, WorkBenchError, PUSH_MESSAGE_TYPE, PULL_MESSAGE_TYPE, PULL_RESPONSE_MESSAGE_TYPE, BLOBS_REQUSET_MESSAGE_TYPE, REQUEST_COMMIT_BLOBS_MESSAGE_TYPE, BLOBS_MESSAGE_TYPE, GET_OBJECT_REQUEST_MESSAGE_TYPE, GET_OBJECT_REPLY_MESSAGE_TYPE, GPBTYPE_TYPE, DATA_REQUEST_MESSAGE_TYPE, DATA_REPLY_MESSAGE_TYPE, DATA_CHUNK_MESSAGE_TYPE
 from ion.core.data import store
 from ion.core.data import cassandra
@@ -55,6 +61,13 @@ from ion.services.coi.datastore_bootstrap.ion_preload_config import TypeMap, ANO
 from ion.core import ioninit
 CONF = ioninit.config(__name__)
 
+# Use numpy (when available) to extract hyperslabs in op_extract_data
+EXTRACT_VECTORIZED = CONF.getValue('extract_vectorized', True)
+# Maximum number of bounded arrays decoded concurrently in the reactor thread pool
+EXTRACT_THREADS = max(int(CONF.getValue('extract_threads', 4)), 1)
+# Maximum number of blob store multi gets in progress at once
+BLOB_FETCH_PARALLEL = max(int(CONF.getValue('blob_fetch_parallel', 4)), 1)
+
 
 LINK_TYPE = object_utils.create_type_identifier(object_id=3, version=1)
 COMMIT_TYPE = object_utils.create_type_identifier(object_id=8, version=1)
@@ -69,6 +82,18 @@ RESOURCE_TYPE = object_utils.create_type_identifier(object_id=1102, version=1)
 
 CDM_BOUNDED_ARRAY_TYPE = object_utils.create_type_identifier(object_id=10021, version=1)
 
+
+def _copy_hyperslab(blob, ndarray_class, shape, target, target_slices, source_slices):
+    """
+    Decodes the serialized ndarray of a bounded array and copies the selected hyperslab into the target.
+    Runs in the reactor thread pool - the ndarray is parsed into a message of its own, which nothing else uses.
+    """
+    ndarray = ndarray_class()
+    ndarray.ParseFromString(blob)
+    source = numpy.asarray(ndarray.value, dtype=target.dtype).reshape(shape)
+    target[target_slices] = source[source_slices]
+
+
 class NDArrayWrap(object):
     """
     Helper object which wraps an ndarray GPB object.
@@ -109,6 +134,20 @@ class NDArrayWrap(object):
         if self._repo.index_hash.has_key(self._key):
             del self._repo.index_hash[self._key]
 
+    @defer.inlineCallbacks
+    def _get_element(self):
+        """
+        Loads/retrieves the structure element of an ndarray without decoding it. Lazy-loads the
+        element from the datastore. Access this via the element property.
+        """
+        if not self._repo.index_hash.has_key(self._key):
+            ndblobs = yield self._getblobs(self._repo, [self._key], lambda x: True)
+            self._repo.index_hash.update(ndblobs)
+
+        defer.returnValue(self._repo.index_hash[self._key])
+
+    element = property(_get_element)
+
     @defer.inlineCallbacks
     def _get_value(self):
         """
@@ -116,10 +155,9 @@ class NDArrayWrap(object):
         the value property.
         """
         if self._ndarray is None:
-            ndblobs = yield self._getblobs(self._repo, [self._key], lambda x: True)
-            self._repo.index_hash.update(ndblobs)
+            element = yield self._get_element()
 
-            self._ndarray = self._repo._load_element(self._repo.index_hash[self._key])
+            self._ndarray = self._repo._load_element(element)
 
         defer.returnValue(self._ndarray.value)
 
@@ -141,23 +179,34 @@ class NDArrayLRUDict(LRUDict):
 
         LRUDict.__init__(self, limit, use_size=True)
 
-    @defer.inlineCallbacks
-    def get_ndarray_value(self, key, bounds, itembytes, getblobs):
-        """
-        Gets an ndarray's value, whether that ndarray is loaded, in the cache, or what have you.
-        Even if the ndarray is actually too large to store in the cache, it will still give you
-        back the ndarray object to work with this one time.
-        """
+    def _get_wrap(self, key, bounds, itembytes, getblobs):
         if not self.has_key(key):
             ndarray = NDArrayWrap(key, self._repo, bounds, itembytes, getblobs)
             self[key] = ndarray
             log.debug("LRUDict loading, item size %d, lru now %d items %d bytes total" % (ndarray._size, len(self.keys()), self.total_size))
         else:
             ndarray = self.get(key)
+        return ndarray
 
-        value = yield ndarray.value
+    @defer.inlineCallbacks
+    def get_ndarray_value(self, key, bounds, itembytes, getblobs):
+        """
+        Gets an ndarray's value, whether that ndarray is loaded, in the cache, or what have you.
+        Even if the ndarray is actually too large to store in the cache, it will still give you
+        back the ndarray object to work with this one time.
+        """
+        value = yield self._get_wrap(key, bounds, itembytes, getblobs).value
         defer.returnValue(value)
 
+    @defer.inlineCallbacks
+    def get_ndarray_element(self, key, bounds, itembytes, getblobs):
+        """
+        Gets the structure element of an ndarray the same way as get_ndarray_value, but leaves
+        decoding it to the caller.
+        """
+        element = yield self._get_wrap(key, bounds, itembytes, getblobs).element
+        defer.returnValue(element)
+
 class DataStoreWorkBenchError(WorkBenchError):
     """
     An Exception class for errors in the data store workbench
@@ -166,13 +215,22 @@ class DataStoreWorkBenchError(WorkBenchError):
 class DataStoreWorkbench(WorkBench):
 
 
-    def __init__(self, process, blob_store, commit_store, cache_size=10**8):
+    def __init__(self, process, blob_store, commit_store, cache_size=10**8, blob_batch_size=500, blob_cache=None):
 
-        WorkBench.__init__(self, process, cache_size)
+        WorkBench.__init__(self, process, cache_size, blob_cache)
 
         self._blob_store = blob_store
         self._commit_store = commit_store
 
+        # The maximum number of keys requested from the blob store in a single multi get
+        self._blob_batch_size = max(int(blob_batch_size), 1)
+
+        # The multi gets in progress at once, shared by all requests
+        self._blob_fetch_limit = defer.DeferredSemaphore(BLOB_FETCH_PARALLEL)
+
+        # key -> list of deferreds waiting on the multi get in progress for that key
+        self._blobs_in_flight = {}
+
 
     def pull(self, *args, **kwargs):
 
@@ -182,6 +240,78 @@ class DataStoreWorkbench(WorkBench):
 
         raise NotImplementedError("The Datastore Service can not Push")
 
+    @defer.inlineCallbacks
+    def _get_many_blobs(self, keys):
+        """
+        Get serialized blobs from the blob store in bounded size batches. The batches are fetched in parallel and
+        keys already being fetched for another request are not fetched again.
+
+        @param  keys    An iterable of blob keys to get.
+        @returns        A dictionary of keys => serialized blobs, None if the key was not found.
+        """
+        if self._blob_cache is not None:
+            result, keys = self._blob_cache.get_many(keys)
+        else:
+            result, keys = {}, list(keys)
+
+        wanted = set()
+        fetch = []
+        waiting = {}
+        for key in keys:
+            if key in wanted:
+                continue
+            wanted.add(key)
+
+            waiters = self._blobs_in_flight.get(key)
+            if waiters is None:
+                fetch.append(key)
+            elif id(waiters) not in waiting:
+                d = defer.Deferred()
+                waiters.append(d)
+                waiting[id(waiters)] = d
+
+        deferreds = [self._fetch_blob_batch(fetch[start:start + self._blob_batch_size])
+                     for start in xrange(0, len(fetch), self._blob_batch_size)]
+        deferreds.extend(waiting.values())
+
+        if deferreds:
+            d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+            d.addErrback(lambda reason: reason.value.subFailure)
+            batches = yield d
+
+            for success, batch in batches:
+                for key, blob in batch.iteritems():
+                    if key in wanted:
+                        result[key] = blob
+
+        defer.returnValue(result)
+
+    def _fetch_blob_batch(self, keys):
+        """
+        Get one batch of blobs from the blob store, letting other requests for the same keys wait on it.
+        """
+        waiters = []
+        for key in keys:
+            self._blobs_in_flight[key] = waiters
+
+        def done(batch):
+            for key in keys:
+                if self._blobs_in_flight.get(key) is waiters:
+                    del self._blobs_in_flight[key]
+
+            if self._blob_cache is not None and isinstance(batch, dict):
+                for key, blob in batch.iteritems():
+                    if blob is not None:
+                        self._blob_cache.put(key, blob)
+
+            for d in waiters:
+                d.callback(batch)
+            return batch
+
+        d = self._blob_fetch_limit.run(self._blob_store.get_many, keys)
+        d.addBoth(done)
+        return d
+
     @defer.inlineCallbacks
     def _get_blobs(self, repo, startkeys, filtermethod=None):
         """
@@ -204,7 +334,7 @@ class DataStoreWorkbench(WorkBench):
         while len(keys_to_get) > 0:
             new_links_to_get = set()
 
-            def_list = []
+            missing_keys = []
             #@TODO - put some error checking here so that we don't overflow due to a stupid request!
             for key in keys_to_get:
                 # Short cut if we have already got it!
@@ -218,16 +348,16 @@ class DataStoreWorkbench(WorkBench):
                     # only add new items to get if they meet our criteria, meaning they are not in the excluded type list
                     new_links_to_get.update(obj.ChildLinks)
                 else:
-                    def_list.append(self._blob_store.get(key))
-
+                    missing_keys.append(key)
 
-            result_list = []
-            if def_list:
-                result_list = yield defer.DeferredList(def_list)
+            # Get this level of the DAG from the blob store in batches
+            result_dict = {}
+            if missing_keys:
+                result_dict = yield self._get_many_blobs(missing_keys)
 
-            for result, blob in result_list:
-                assert result==True, 'Error getting link from blob store!'
-                wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
+            for key, blob in result_dict.iteritems():
+                assert blob is not None, 'Error getting link from blob store!'
+                wse = gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
                 blobs[wse.key]=wse
 
                 # Add it to the repository index
@@ -284,7 +414,7 @@ class DataStoreWorkbench(WorkBench):
 
             if key not in repo.index_hash:
                 blob = columns[VALUE]
-                wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
+                wse = gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
                 repo.index_hash[key] = wse
             else:
                 wse = repo.index_hash.get(key)
@@ -326,6 +456,7 @@ class DataStoreWorkbench(WorkBench):
 
         # Do the update!
         self._update_repo_to_head(repo, new_head)
+        self._count_repository(repo)
 
 
         log.info('_resolve_repo_state: complete')
@@ -333,6 +464,23 @@ class DataStoreWorkbench(WorkBench):
         # return repository
         defer.returnValue(repo)
 
+    @defer.inlineCallbacks
+    def _heads_advertised(self, repository_key, commit_keys):
+        """
+        Compare the commits a puller advertised with the branch head rows in the commit store.
+        @param repository_key the repository to check
+        @param commit_keys the commit keys advertised in the pull request
+        @retval True if the repository exists and the puller advertised every head commit
+        """
+        q = Query()
+        q.add_predicate_eq(REPOSITORY_KEY, repository_key)
+        q.add_predicate_gt(BRANCH_NAME, '')
+
+        rows = yield self._commit_store.query(q)
+
+        advertised = set(commit_keys)
+        defer.returnValue(len(rows) > 0 and advertised.issuperset(rows.keys()))
+
     @defer.inlineCallbacks
     def op_pull(self,request, headers, msg):
         """
@@ -348,6 +496,15 @@ class DataStoreWorkbench(WorkBench):
         if not hasattr(request, 'MessageType') or request.MessageType != PULL_MESSAGE_TYPE:
             raise DataStoreWorkBenchError('Invalid pull request. Bad Message Type!', request.ResponseCodes.BAD_REQUEST)
 
+        # Not modified - the puller advertised every stored branch head. Answer before reconstituting the repository.
+        if len(request.commit_keys) > 0:
+            not_modified = yield self._heads_advertised(request.repository_key, request.commit_keys)
+            if not_modified:
+                response = yield self._process.message_client.create_instance(PULL_RESPONSE_MESSAGE_TYPE)
+                yield self._process.reply_ok(msg, content=response)
+                log.info('op_pull: Complete, not modified!')
+                return
+
         repo = yield self._resolve_repo_state(request.repository_key)
         repo.cached = True
 
@@ -355,11 +512,7 @@ class DataStoreWorkbench(WorkBench):
         # Back to boiler plate op_pull
         ####
 
-        my_commits = self.list_repository_commits(repo)
-
-        puller_has = request.commit_keys
-
-        puller_needs = set(my_commits).difference(puller_has)
+        puller_needs = self.list_commits_needed(repo, request.commit_keys)
 
         response = yield self._process.message_client.create_instance(PULL_RESPONSE_MESSAGE_TYPE)
 
@@ -378,7 +531,8 @@ class DataStoreWorkbench(WorkBench):
             obj = response.Repository._wrap_message_object(commit_element._element)
             link.SetLink(obj)
 
-        if request.get_head_content:
+        # Not modified - the puller has every commit and so the head content. Skip walking the blob store.
+        if request.get_head_content and puller_needs:
 
             keys = [x.GetLink('objectroot').key for x in repo.current_heads()]
 
@@ -450,7 +604,7 @@ class DataStoreWorkbench(WorkBench):
             for key, columns in rows.items():
 
                 blob = columns[VALUE]
-                wse = gpb_wrapper.StructureElement.parse_structure_element(blob)
+                wse = gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
                 if wse.key in repo._commit_index.keys():
                     # No thanks, he's already got one!
                     continue
@@ -560,18 +714,17 @@ class DataStoreWorkbench(WorkBench):
             self._update_repo_to_head(repo,new_head)
 
         # Put any new blobs
-        def_list = []
+        blob_items = []
         for key in new_blob_keys:
 
             element = self._workbench_cache.get(key)
 
-            def_list.append(self._blob_store.put(key, element.serialize()))
-        yield defer.DeferredList(def_list)
-        # @TODO - check the results - for what?
+            blob_items.append((key, element.serialize()))
+        yield self._blob_store.put_many(blob_items)
 
 
         # now put any new commits that are not at the head
-        def_list = []
+        commit_rows = []
 
         # list of the keys which are no longer heads
         clear_head_list=[]
@@ -643,10 +796,7 @@ class DataStoreWorkbench(WorkBench):
 
                 if key not in head_keys:
 
-                    defd = self._commit_store.put(key = key,
-                                       value = wse.serialize(),
-                                       index_attributes = attributes)
-                    def_list.append(defd)
+                    commit_rows.append((key, wse.serialize(), attributes))
 
                 else:
 
@@ -662,7 +812,7 @@ class DataStoreWorkbench(WorkBench):
 
 
 
-                    new_head_list.append({'key':key, 'value':wse.serialize(), 'index_attributes':attributes})
+                    new_head_list.append((key, wse.serialize(), attributes))
 
             # Get the current head list
             q = Query()
@@ -678,16 +828,10 @@ class DataStoreWorkbench(WorkBench):
                     # Any commit which is currently a head will have the correct branch names set.
                     # Just delete the branch names for the ones that are no longer heads.
 
-        yield defer.DeferredList(def_list)
-        #@TODO - check the return vals?
+        yield self._commit_store.put_many(commit_rows)
 
-        def_list = []
-        for new_head in new_head_list:
-
-            def_list.append(self._commit_store.put(**new_head))
-
-        yield defer.DeferredList(def_list)
-        #@TODO - check the return vals?
+        # Put the new heads after the rest of the commits
+        yield self._commit_store.put_many(new_head_list)
 
         def_list = []
         for key in clear_head_list:
@@ -714,11 +858,9 @@ class DataStoreWorkbench(WorkBench):
         if not hasattr(request, 'MessageType') or request.MessageType != BLOBS_MESSAGE_TYPE:
             raise DataStoreWorkBenchError('Invalid put blobs request. Bad Message Type!', request.ResponseCodes.BAD_REQUEST)
 
-        def_list = []
-        for blob in request.blob_elements:
-            def_list.append(self._blob_store.put(blob.key, blob.SerializeToString() ))
+        blob_items = [(blob.key, blob.SerializeToString()) for blob in request.blob_elements]
 
-        yield defer.DeferredList(def_list)
+        yield self._blob_store.put_many(blob_items)
 
         yield self._process.reply_ok(message)
         log.info("op_put_blobs: Complete!")
@@ -737,7 +879,7 @@ class DataStoreWorkbench(WorkBench):
 
         response = yield self._process.message_client.create_instance(BLOBS_MESSAGE_TYPE)
 
-        def_list = []
+        missing_keys = []
         for key in request.blob_keys:
             element = self._workbench_cache.get(key)
 
@@ -749,16 +891,17 @@ class DataStoreWorkbench(WorkBench):
 
                 continue
 
-            def_list.append(self._blob_store.get(key))
+            missing_keys.append(key)
 
-        res_list = yield defer.DeferredList(def_list)
+        res_dict = yield self._get_many_blobs(missing_keys)
 
-        for result, blob in res_list:
+        for key in missing_keys:
+            blob = res_dict.get(key)
 
             if blob is None:
                 raise DataStoreWorkBenchError('Invalid fetch objects request. Key Not Found!', request.ResponseCodes.NOT_FOUND)
 
-            element = gpb_wrapper.StructureElement.parse_structure_element(blob)
+            element = gpb_wrapper.StructureElement.parse_structure_element(blob, trusted=True)
             link = response.blob_elements.add()
             obj = response.Repository._wrap_message_object(element._element)
 
@@ -780,7 +923,9 @@ class DataStoreWorkbench(WorkBench):
 
             def_list.append(self.flush_repo_to_backend(repo))
 
-        yield defer.DeferredList(def_list)
+        d = defer.DeferredList(def_list, fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda reason: reason.value.subFailure)
+        yield d
 
         #import pprint
         #print 'After update to heads'
@@ -802,10 +947,7 @@ class DataStoreWorkbench(WorkBench):
         """
 
         # This is simpler than a push - all of these are guaranteed to be new objects!
-        def_list = []
-        for key, element in repo.index_hash.items():
-
-            def_list.append(self._blob_store.put(key, element.serialize()))
+        blob_items = [(key, element.serialize()) for key, element in repo.index_hash.items()]
 
 
         # any objects in the data structure that were transmitted have already
@@ -823,6 +965,7 @@ class DataStoreWorkbench(WorkBench):
         for cref in repo.current_heads():
             head_keys.append( cref.MyId )
 
+        commit_rows = []
         for key in commit_keys:
 
             # Set the repository name for the commit
@@ -861,14 +1004,7 @@ class DataStoreWorkbench(WorkBench):
             wse = self._workbench_cache.get(key)
 
 
-            if key not in head_keys:
-
-                defd = self._commit_store.put(key = key,
-                                   value = wse.serialize(),
-                                   index_attributes = attributes)
-                def_list.append(defd)
-
-            else:
+            if key in head_keys:
 
                 # We know it is a head - but we need to get the branch name again
                 for branch in  repo.branches:
@@ -880,13 +1016,14 @@ class DataStoreWorkbench(WorkBench):
                         else:
                             attributes[BRANCH_NAME] = ','.join([attributes[BRANCH_NAME],branch.branchkey])
 
+            commit_rows.append((key, wse.serialize(), attributes))
 
-                # Now commit it!
-                defd = self._commit_store.put(key = key,
-                                   value = wse.serialize(),
-                                   index_attributes = attributes)
-                def_list.append(defd)
-        return defer.DeferredList(def_list)
+        # Now commit it all!
+        def_list = [self._blob_store.put_many(blob_items),
+                    self._commit_store.put_many(commit_rows)]
+        d = defer.DeferredList(def_list, fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda reason: reason.value.subFailure)
+        return d
 
 
 
@@ -1039,6 +1176,14 @@ class DataStoreWorkbench(WorkBench):
         CHUNK_FACTOR = 15000 #LRU_DICT_LIMIT / ITEM_SIZE       # chunk factor is expressed in # of items, not bytes
         log.debug("LRU Cache Limit set at %d bytes, CHUNK_FACTOR is %d elements" % (LRU_DICT_LIMIT, CHUNK_FACTOR))
 
+        # numeric arrays are extracted with numpy when it is available - strings and opaques go through the strips
+        if EXTRACT_VECTORIZED and len(bounded_includes_list) > 0 and ndarray_type.object_id in NUMPY_DTYPES:
+            yield self._extract_hyperslab(request, [x[0] for x in bounded_includes_list], ndarray_type, ITEM_SIZE, CHUNK_FACTOR, NDArrayLRUDict(LRU_DICT_LIMIT, repo))
+
+            self._process.reply_ok(message, response)
+            log.info("/op_extract_data")
+            return
+
         # ===================================================================
         # STEP 2: Compress/Optimize bounded_includes_list for overlap
         # ===================================================================
@@ -1222,6 +1367,86 @@ class DataStoreWorkbench(WorkBench):
         log.debug("_send_data_chunk to %s" % data_routing_key)
         yield self._process.send(data_routing_key, 'noop', chunkmsg)
 
+    @defer.inlineCallbacks
+    def _extract_hyperslab(self, request, bounded_arrays, ndarray_type, itembytes, chunk_size, ndarray_cache):
+        """
+        Vectorized version of the strip extraction in op_extract_data. The serialized ndarray of each bounded
+        array is parsed and decoded into a numpy array in the reactor thread pool and the requested origin/size/stride
+        is applied as slices into a single target array, which is then sent out in chunks.
+
+        @param request          The DataRequestMessage.
+        @param bounded_arrays   The bounded arrays which intersect the requested bounds.
+        @param ndarray_type     The type of the ndarrays held by the bounded arrays.
+        @param itembytes        Number of bytes per item.
+        @param chunk_size       Maximum number of elements in a data chunk message.
+        @param ndarray_cache    An NDArrayLRUDict to load ndarray values through.
+        """
+        reqbounds = [(x.origin, x.size, x.stride or 1) for x in request.request_bounds]
+        targetshape = tuple([(size + stride - 1) // stride for origin, size, stride in reqbounds])
+
+        target = numpy.empty(targetshape, dtype=NUMPY_DTYPES[ndarray_type.object_id])
+        ndarray_class = object_utils.get_gpb_class_from_type_id(ndarray_type)
+        filled = numpy.zeros(targetshape, dtype=bool)
+
+        semaphore = defer.DeferredSemaphore(EXTRACT_THREADS)
+        copies = []
+
+        for ba in bounded_arrays:
+            slices = hyperslab_slices(reqbounds, [(x.origin, x.size) for x in ba.bounds])
+            if slices is None:
+                # the array intersects the request but all of the indices in it are strided out - don't load it
+                continue
+
+            target_slices, source_slices = slices
+            shape = tuple([x.size for x in ba.bounds])
+
+            # bound the number of arrays held in memory while waiting on the thread pool
+            yield semaphore.acquire()
+
+            try:
+                element = yield ndarray_cache.get_ndarray_element(ba.GetLink('ndarray').key, ba.bounds, itembytes, self._get_blobs)
+                if not element.verify():
+                    raise DataStoreWorkBenchError('The sha1 key does not match the value of ndarray %s. The data is corrupted!'
+                                                  % object_utils.sha1_to_hex(element.key))
+            except:
+                semaphore.release()
+                raise
+
+            # only the serialized bytes go to the thread - the repository and its wrappers are not thread safe
+            d = threads.deferToThread(_copy_hyperslab, element.value, ndarray_class, shape, target, target_slices, source_slices)
+            d.addBoth(lambda result: semaphore.release() or result)
+            copies.append(d)
+
+            filled[target_slices] = True
+
+        results = yield defer.DeferredList(copies, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+
+        if not filled.all():
+            raise DataStoreWorkBenchError("Data extraction did not properly fill in all members of response ndarray!")
+
+        log.debug("Extracted %d elements from %d bounded arrays" % (target.size, len(copies)))
+
+        flat = target.ravel()
+        starts = range(0, flat.size, chunk_size)
+
+        for seq, start in enumerate(starts):
+            chunk = flat[start:start + chunk_size]
+
+            chunkmsg = yield self._process.message_client.create_instance(DATA_CHUNK_MESSAGE_TYPE)
+            chunkmsg.seq_number = seq
+            chunkmsg.seq_max = len(starts)
+            chunkmsg.start_index = start
+            chunkmsg.done = seq == len(starts) - 1
+
+            chunkndarray = chunkmsg.CreateObject(ndarray_type)
+            chunkndarray.value[0:len(chunk)] = chunk.tolist()
+            chunkmsg.ndarray = chunkndarray
+
+            yield self._send_data_chunk(request.data_routing_key, chunkmsg)
+
 
     def _double_xrange(self, start1, end1, start2, end2):
         """
@@ -1422,6 +1647,7 @@ class DataStoreService(ServiceProcess):
         self._backend_cls_names[BLOB_CACHE] = self.spawn_args.get(BLOB_CACHE, CONF.getValue(BLOB_CACHE, default='ion.core.data.store.Store'))
 
         self._cache_size = self.spawn_args.get('cache_size', CONF.getValue('cache_size', default=10**8))
+        self._blob_batch_size = self.spawn_args.get('blob_batch_size', CONF.getValue('blob_batch_size', default=500))
 
         self._backend_classes={}
 
@@ -1516,7 +1742,7 @@ class DataStoreService(ServiceProcess):
 
         
         log.info("Created stores")
-        self.workbench = DataStoreWorkbench(self, self.b_store, self.c_store, cache_size=self._cache_size)
+        self.workbench = DataStoreWorkbench(self, self.b_store, self.c_store, cache_size=self._cache_size, blob_batch_size=self._blob_batch_size)
 
         yield self.initialize_datastore()
 
@@ -17,7 +17,7 @@ CONF = ioninit.config(__name__)
 from ion.core.messaging.receiver import Receiver, FanoutReceiver
 from ion.core.process.process import Process, ProcessClient, ProcessDesc, ProcessFactory
 from ion.core.process.service_process import ServiceProcess, ServiceClient
-from ion.core.exception import ApplicationError
+from ion.core.exception import ApplicationError, IonError
 from ion.core.security.authentication import Authentication
 from ion.services.coi.resource_registry.resource_client import ResourceClient, ResourceInstance, ResourceClientError, ResourceInstanceError
 from ion.services.dm.inventory.association_service import AssociationServiceClient
@@ -25,6 +25,10 @@ from ion.services.coi.resource_registry.association_client import AssociationCli
 from ion.core.exception import ApplicationError
 
 from ion.core.object import object_utils
+from ion.core.data import cassandra, store
+from ion.core.data.storage_configuration_utility import get_cassandra_configuration, STORAGE_PROVIDER, \
+    PERSISTENT_ARCHIVE, IDENTITY_CACHE, IDENTITY, IDENTITY_INDEXED_COLUMNS
+import ion.util.procutils as pu
 
 from ion.core.intercept.policy import subject_has_admin_role, \
                                       map_ooi_id_to_subject_admin_role, \
@@ -45,6 +49,9 @@ from ion.services.dm.inventory.association_service import PREDICATE_OBJECT_QUERY
 
 PREDICATE_REFERENCE_TYPE = object_utils.create_type_identifier(object_id=25, version=1)
 
+# Number of identity resources pulled together when the subject index is rebuilt from the resource registry
+IDENTITY_INDEX_BATCH = CONF.getValue('identity_index_batch', 50)
+
 IDENTITY_TYPE = object_utils.create_type_identifier(object_id=1401, version=1)
 """
 from ion-object-definitions/net/ooici/services/coi/identity/identity_management.proto
@@ -203,20 +210,127 @@ class IdentityRegistryException(ApplicationError):
     IdentityRegistryService exception class
     """
 
+class SubjectIndex(object):
+    """
+    The ooi_id of each user identity by its certificate subject. The index is held in memory for lookups and
+    written through to an index store, so that it can be reloaded without pulling every identity resource.
+    """
+
+    # A constant index attribute, used to query for all of the rows
+    IDENTITY_ATTR = IDENTITY
+
+    def __init__(self, index_store):
+        self.index_store = index_store
+        self.ooi_ids = {}
+        self.subjects = {}
+
+    def __len__(self):
+        return len(self.ooi_ids)
+
+    def get(self, subject):
+        """
+        @retval the ooi_id of the identity with this subject or None
+        """
+        return self.ooi_ids.get(subject)
+
+    def has_ooi_id(self, ooi_id):
+        return ooi_id in self.subjects
+
+    @defer.inlineCallbacks
+    def load(self):
+        """
+        Load the index from the index store.
+        """
+        query = store.Query()
+        query.add_predicate_eq(self.IDENTITY_ATTR, '1')
+        for d in self.index_store.query_cursor(query, columns=['value']):
+            rows = yield d
+            for subject, row in rows.iteritems():
+                self._set(subject, row['value'])
+
+    def add(self, subject, ooi_id):
+        return self.add_many([(subject, ooi_id)])
+
+    def add_many(self, items):
+        """
+        @param items an iterable of (subject, ooi_id) tuples
+        """
+        rows = []
+        for subject, ooi_id in items:
+            self._set(subject, ooi_id)
+            rows.append((subject, ooi_id, {self.IDENTITY_ATTR: '1'}))
+        return self.index_store.put_many(rows)
+
+    def discard(self, subject):
+        ooi_id = self.ooi_ids.pop(subject, None)
+        if ooi_id is not None and self.subjects.get(ooi_id) == subject:
+            del self.subjects[ooi_id]
+        return self.index_store.remove(subject)
+
+    def _set(self, subject, ooi_id):
+        old_subject = self.subjects.get(ooi_id)
+        if old_subject is not None and old_subject != subject:
+            self.ooi_ids.pop(old_subject, None)
+        self.ooi_ids[subject] = ooi_id
+        self.subjects[ooi_id] = subject
+
+
 class IdentityRegistryService(ServiceProcess):
 
     # Declaration of service
     declare = ServiceProcess.service_declare(name='identity_service', version='0.1.0', dependencies=[])
 
+    class SubjectIndexStore(store.IndexStore):
+        """
+        IndexStore with storage of its own rather than the class variables shared by every IndexStore.
+        """
+        def __init__(self, *args, **kwargs):
+            self.kvs = {}
+            self.indices = {}
+
+            store.IndexStore.__init__(self, *args, **kwargs)
+
     def __init__(self, *args, **kwargs):
         super(IdentityRegistryService, self).__init__(*args, **kwargs)
 
         self.broadcast_count = 0
 
+        index_store_class_name = self.spawn_args.get('index_store_class', CONF.getValue('index_store_class', default=None))
+        if index_store_class_name is not None:
+            self.index_store_class = pu.get_class(index_store_class_name)
+        else:
+            self.index_store_class = self.SubjectIndexStore
+
+        assert store.IIndexStore.implementedBy(self.index_store_class), \
+            'The back end class for the subject index passed to the identity registry does not implement the required IIndexStore interface.'
+
+        self._username = self.spawn_args.get("username", CONF.getValue("username", None))
+        self._password = self.spawn_args.get("password", CONF.getValue("password", None))
+
+        # Get the configuration for cassandra - may or may not be used depending on the backend class
+        self._storage_conf = get_cassandra_configuration()
+
+        self.subject_index = None
+
+    @defer.inlineCallbacks
     def slc_init(self):
         """
         """
         # Service life cycle state. Initialize service here. Can use yields.
+        if issubclass(self.index_store_class, cassandra.CassandraIndexedStore):
+            log.info("Instantiating Cassandra Index Store")
+
+            storage_provider = self._storage_conf[STORAGE_PROVIDER]
+            keyspace = self._storage_conf[PERSISTENT_ARCHIVE]['name']
+
+            index_store = self.index_store_class(self._username, self._password, storage_provider, keyspace, IDENTITY_CACHE)
+
+            yield self.register_life_cycle_object(index_store)
+        else:
+            index_store = self.index_store_class(self, indices=IDENTITY_INDEXED_COLUMNS)
+
+        self.subject_index = SubjectIndex(index_store)
+        log.info('SLC_INIT Identity Registry: subject index store class - %s' % self.index_store_class)
 
         # Can be called in __init__ or in slc_init... no yield required
         self.rc = ResourceClient(proc=self)
@@ -239,6 +353,15 @@ class IdentityRegistryService(ServiceProcess):
         for user_id, role_id in role_map.iteritems():
             map_ooi_id_to_role(user_id, ROLE_NAMES_BY_ID[role_id])
 
+        # Warm the subject index, adding any identities registered since it was stored. Users which are not
+        # indexed now are indexed when they are first looked up.
+        try:
+            yield self.subject_index.load()
+            yield self._index_new_identities()
+        except IonError, ex:
+            log.warn('Could not build the identity subject index: %s' % str(ex))
+        log.info('Identity subject index holds %d identities' % len(self.subject_index))
+
     @defer.inlineCallbacks
     def op_register_user_credentials(self, request, headers, msg):
         """
@@ -284,6 +407,8 @@ class IdentityRegistryService(ServiceProcess):
        
         yield self.rc.put_instance(identity, 'Adding identity %s' % identity.subject)
         log.debug('Commit completed, %s' % identity.ResourceIdentity)
+
+        yield self.subject_index.add(identity.subject, identity.ResourceIdentity)
         
         # Optionally map OOI ID to subject in admin role dictionary
         if subject_has_admin_role(identity.subject):
@@ -442,11 +567,11 @@ class IdentityRegistryService(ServiceProcess):
 
         identity, ooi_id = yield self._findUser(request.configuration.subject)
         if ooi_id != None:
-           log.debug('get_ooiid_for_user: ooi_id = '+ooi_id.key)
+           log.debug('get_ooiid_for_user: ooi_id = '+ooi_id)
            # Create the response object...
            Response = yield self.message_client.create_instance(RESOURCE_CFG_RESPONSE_TYPE, MessageName='IR response')
            Response.resource_reference = Response.CreateObject(USER_OOIID_TYPE)
-           Response.resource_reference.ooi_id = ooi_id.key
+           Response.resource_reference.ooi_id = ooi_id
            Response.result = "OK"
            defer.returnValue(Response)
         else:
@@ -611,10 +736,51 @@ class IdentityRegistryService(ServiceProcess):
     @defer.inlineCallbacks
     def _findUser(self, Subject):
         """
-        Implementation of User find that uses the registry and associations.
+        Implementation of User find that uses the subject index, falling back to the registry and associations
+        for identities which are not indexed yet.
+        @retval [identity resource instance, ooi_id] or [None, None] if there is no identity with the subject
         """
         log.debug('_findUser searching for "%s"' %Subject)
-        
+
+        Resource = yield self._getIndexedUser(Subject)
+        if Resource is None:
+            # The identity may have been registered through another identity registry
+            yield self._index_new_identities()
+            Resource = yield self._getIndexedUser(Subject)
+
+        if Resource is None:
+            log.debug('subject %s not found'%Subject)
+            defer.returnValue([None, None])
+
+        log.debug('subject %s found'%Subject)
+        defer.returnValue([Resource, Resource.ResourceIdentity])
+
+    @defer.inlineCallbacks
+    def _getIndexedUser(self, Subject):
+        """
+        Get the identity resource of a subject from the subject index. Stale entries are dropped.
+        """
+        ooi_id = self.subject_index.get(Subject)
+        if ooi_id is None:
+            defer.returnValue(None)
+
+        try:
+            Resource = yield self.rc.get_instance(ooi_id)
+        except ResourceClientError, ex:
+            log.warn('Identity %s of subject %s could not be found: %s' % (ooi_id, Subject, str(ex)))
+            Resource = None
+
+        if Resource is None or Resource.subject != Subject:
+            yield self.subject_index.discard(Subject)
+            defer.returnValue(None)
+
+        defer.returnValue(Resource)
+
+    @defer.inlineCallbacks
+    def _index_new_identities(self):
+        """
+        Add the identity resources which are not in the subject index yet, pulling them in batches.
+        """
         # get all the identity resources out of the Association Service
         request = yield self.message_client.create_instance(PREDICATE_OBJECT_QUERY_TYPE)
         pair = request.pairs.add()
@@ -631,15 +797,25 @@ class IdentityRegistryService(ServiceProcess):
    
         ooi_id_list = yield self.asc.get_subjects(request)     
 
-        # Now we have a list of ooi_ids. Gotta pull and search them individually.
-        for ooi_id in ooi_id_list.idrefs:
-            Resource = yield self.rc.get_instance(ooi_id)
-            if Subject == getattr(Resource, 'subject'):
-                log.debug('subject %s found'%Subject)
-                defer.returnValue([Resource, ooi_id])
-
-        log.debug('subject %s not found'%Subject)
-        defer.returnValue([None, None])
+        new_ids = [idref.key for idref in ooi_id_list.idrefs if not self.subject_index.has_ooi_id(idref.key)]
+        if not new_ids:
+            return
+
+        log.info('Adding %d identities to the subject index' % len(new_ids))
+        for i in xrange(0, len(new_ids), IDENTITY_INDEX_BATCH):
+            batch = new_ids[i:i + IDENTITY_INDEX_BATCH]
+            # An identity which could not be got with the rest of the batch is None - try it again on its own
+            resources = yield self.rc.get_instances(batch, skip_failed=True)
+            for n, ooi_id in enumerate(batch):
+                if resources[n] is None:
+                    log.warn('Could not get identity %s with the rest of the batch, getting it on its own' % ooi_id)
+                    try:
+                        resources[n] = yield self.rc.get_instance(ooi_id)
+                    except ResourceClientError:
+                        log.exception('Could not get identity %s' % ooi_id)
+            resources = [r for r in resources if r is not None]
+
+            yield self.subject_index.add_many([(r.subject, r.ResourceIdentity) for r in resources])
 
 
     def _CheckRequest(self, request):
@@ -11,6 +11,8 @@ create, get, put and update resources.
 Add methods to access the state of updates which are merging...
 """
 
+import time
+
 from twisted.internet import defer
 
 import ion.util.ionlog
@@ -30,6 +32,7 @@ from ion.services.coi.datastore_bootstrap import ion_preload_config
 from ion.services.coi.datastore_bootstrap.ion_preload_config import OWNED_BY_ID
 
 from ion.core.exception import ApplicationError
+from ion.util.cache import LRUDict
 
 from google.protobuf import message
 from google.protobuf.internal import containers
@@ -41,6 +44,11 @@ RESOURCE_TYPE = object_utils.create_type_identifier(object_id=1102, version=1)
 IDREF_TYPE = object_utils.create_type_identifier(object_id=4, version=1)
 
 CONF = ioninit.config(__name__)
+# Reuse resources a process already checked out when the datastore has nothing newer
+INSTANCE_CACHE = CONF.getValue('instance_cache', True)
+# Seconds a cached resource is used without asking the datastore for a newer head, 0 to always ask
+INSTANCE_CACHE_TTL = CONF.getValue('instance_cache_ttl', 0)
+INSTANCE_CACHE_SIZE = CONF.getValue('instance_cache_size', 1000)
 
 class ResourceClientError(ApplicationError):
     """
@@ -48,6 +56,83 @@ class ResourceClientError(ApplicationError):
     """
 
 
+class ResourceInstanceCache(object):
+    """
+    The state of the resources a process checked out with get_instance. A get_instance of a resource whose branch
+    head has not moved since is answered without a checkout, and within ttl seconds without a pull. An entry holds
+    only the keys of the checked out state - the repository is looked up in the workbench, so it stays under the
+    workbench cache management and an entry never keeps it alive.
+    """
+
+    def __init__(self, ttl=INSTANCE_CACHE_TTL, size=INSTANCE_CACHE_SIZE):
+        self.ttl = ttl
+        # key -> [head commit key, root object key, excluded types, time the head was checked]
+        self.entries = LRUDict(size)
+
+    def _state(self, repo, branchname):
+        """
+        @retval the keys of the checked out state of the repository if it is the unmodified head of the branch,
+        otherwise None
+        """
+        if repo is None or repo._workspace_root is None or repo._detached_head or repo.status != repo.UPTODATE:
+            return None
+
+        branch = repo.get_branch(branchname)
+        if branch is None or repo._current_branch is not branch or len(branch.commitrefs) != 1:
+            return None
+
+        excluded_types = tuple((t.object_id, t.version) for t in repo.excluded_types or [])
+        return [branch.commitrefs[0].MyId, repo._workspace_root.MyId, excluded_types]
+
+    def _current(self, key, repo, branchname):
+        """
+        @retval the entry if the repository still has the checked out state of the entry on the branch head
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        if self._state(repo, branchname) != entry[:3]:
+            return None
+        return entry
+
+    def fresh(self, key, repo, branchname):
+        """
+        @retval True if the entry is current and was checked against the datastore less than ttl seconds ago
+        """
+        entry = self._current(key, repo, branchname)
+        return entry is not None and time.time() - entry[3] < self.ttl
+
+    def validate(self, key, repo, branchname):
+        """
+        Call after a pull brought the repository up to date with the datastore.
+        @retval True if the checked out state is still the branch head
+        """
+        entry = self._current(key, repo, branchname)
+        if entry is None:
+            return False
+        entry[3] = time.time()
+        return True
+
+    def put(self, key, repo, branchname):
+        state = self._state(repo, branchname)
+        if state is None:
+            if key in self.entries:
+                del self.entries[key]
+            return
+        self.entries[key] = state + [time.time()]
+
+    def invalidate(self, resource_id=None):
+        """
+        @param resource_id forget the entries of this resource, or all entries if None
+        """
+        if resource_id is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries.keys() if key[0] == resource_id]:
+            del self.entries[key]
+
+
 class ResourceClient(object):
     """
     @brief This is the base class for a resource client. It is a factory for resource
@@ -86,6 +171,19 @@ class ResourceClient(object):
 
         self.registry_client = ResourceRegistryClient(proc=self.proc)
 
+    @property
+    def instance_cache(self):
+        """
+        The resource instance cache of the process, shared by its resource clients. None if disabled.
+        """
+        if not INSTANCE_CACHE:
+            return None
+        cache = getattr(self.proc, 'resource_instance_cache', None)
+        if cache is None:
+            cache = ResourceInstanceCache()
+            setattr(self.proc, 'resource_instance_cache', cache)
+        return cache
+
 
     @defer.inlineCallbacks
     def _check_init(self):
@@ -169,27 +267,14 @@ class ResourceClient(object):
         """
         yield self._check_init()
 
-        reference = None
-        branch = 'master'
-        commit = None
+        reference, branch = self._get_reference(resource_id)
 
-        # Get the type of the argument and act accordingly
-        if hasattr(resource_id, 'ObjectType') and resource_id.ObjectType == IDREF_TYPE:
-            # If it is a resource reference, unpack it.
-            if resource_id.branch:
-                branch = resource_id.branch
-
-            reference = resource_id.key
-            commit = resource_id.commit
+        cache = self.instance_cache
+        cache_key = self._cache_key(reference, branch, excluded_types)
 
-        elif isinstance(resource_id, (str, unicode)):
-            # if it is a string, us it as an identity
-            reference = resource_id
-            # @TODO Some reasonable test to make sure it is valid?
-
-        else:
-            raise ResourceClientError('''Illegal argument type in get_instance:
-                                      \n type: %s \nvalue: %s''' % (type(resource_id), str(resource_id)))
+        repo = self.workbench.get_repository(reference)
+        if cache is not None and cache.fresh(cache_key, repo, branch):
+            defer.returnValue(ResourceInstance(repo))
 
             # Pull the repository
         try:
@@ -199,14 +284,102 @@ class ResourceClient(object):
             raise ResourceClientError(
                 'Could not pull the requested resource from the datastore. Workbench exception: \n %s' % ex)
 
+        resource = yield self._checkout_instance(reference, branch, cache_key)
+        defer.returnValue(resource)
+
+    @defer.inlineCallbacks
+    def get_instances(self, resource_ids, excluded_types=None, skip_failed=False):
+        """
+        @brief Get the latest version of several resources from the data store. The resources are pulled
+        together rather than one after the other.
+        @param resource_ids a list of string resource identities or IDRef objects, as for get_instance
+        @param skip_failed if True, a resource which can not be pulled or checked out is None in the result
+        instead of failing the whole call
+        @retval a list of the specified ResourceInstances in the order of resource_ids
+        """
+        yield self._check_init()
+
+        references = [self._get_reference(resource_id) for resource_id in resource_ids]
+
+        cache = self.instance_cache
+        cache_keys = [self._cache_key(reference, branch, excluded_types) for reference, branch in references]
+
+        instances = [None] * len(references)
+        pull = []
+        for i, (reference, branch) in enumerate(references):
+            repo = self.workbench.get_repository(reference)
+            if cache is not None and cache.fresh(cache_keys[i], repo, branch):
+                instances[i] = ResourceInstance(repo)
+            elif reference not in pull:
+                pull.append(reference)
+
+        pulled = {}
+        if pull:
+            try:
+                pulled = yield self.workbench.pull_many(self.datastore_service, pull, excluded_types=excluded_types,
+                                                        skip_failed=skip_failed)
+            except workbench.WorkBenchError, ex:
+                log.error('Resource client error during pull operation: Resource IDs "%s" \nException - %s' % (pull, str(ex)))
+                raise ResourceClientError(
+                    'Could not pull the requested resources from the datastore. Workbench exception: \n %s' % ex)
+
+        for i, (reference, branch) in enumerate(references):
+            if instances[i] is not None or reference not in pulled:
+                continue
+            try:
+                instances[i] = yield self._checkout_instance(reference, branch, cache_keys[i])
+            except ResourceClientError:
+                if not skip_failed:
+                    raise
+
+        defer.returnValue(instances)
+
+    def _get_reference(self, resource_id):
+        """
+        @retval the resource identity and branch name of a get_instance argument
+        """
+        # Get the type of the argument and act accordingly
+        if hasattr(resource_id, 'ObjectType') and resource_id.ObjectType == IDREF_TYPE:
+            # If it is a resource reference, unpack it.
+            return resource_id.key, resource_id.branch or 'master'
+
+        elif isinstance(resource_id, (str, unicode)):
+            # if it is a string, us it as an identity
+            # @TODO Some reasonable test to make sure it is valid?
+            return resource_id, 'master'
+
+        raise ResourceClientError('''Illegal argument type in get_instance:
+                                  \n type: %s \nvalue: %s''' % (type(resource_id), str(resource_id)))
+
+    def _cache_key(self, reference, branch, excluded_types):
+        # None pulls with the default excluded types, an empty list excludes nothing
+        if excluded_types is None:
+            return reference, branch, None
+        return reference, branch, tuple((t.object_id, t.version) for t in excluded_types)
+
+    @defer.inlineCallbacks
+    def _checkout_instance(self, reference, branch, cache_key):
+        """
+        Check out the branch of a resource which has just been pulled.
+        @retval a ResourceInstance
+        """
         # Get the repository
         repo = self.workbench.get_repository(reference)
+
+        # Nothing new in the datastore - the state checked out last time is still the head
+        cache = self.instance_cache
+        if cache is not None and cache.validate(cache_key, repo, branch):
+            defer.returnValue(ResourceInstance(repo))
+
         try:
             yield repo.checkout(branch)
         except repository.RepositoryError, ex:
             log.exception('Could not check out branch "%s":\n Current repo state:\n %s' % (branch, str(repo)))
             raise ResourceClientError('Could not checkout branch during get_instance.')
 
+        if cache is not None:
+            cache.put(cache_key, repo, branch)
+
         # Create a resource instance to return
         # @TODO - Check and see if there is already one - what to do?
         resource = ResourceInstance(repo)
@@ -21,6 +21,7 @@ from ion.core.process.service_process import ServiceProcess, ServiceClient
 from ion.core.object import workbench
 
 from ion.services.coi.datastore_bootstrap.ion_preload_config import ANONYMOUS_USER_ID, ROOT_USER_ID, OWNED_BY_ID
+from ion.services.dm.distribution.events import OwnershipChangeEventPublisher
 
 
 from ion.core.object import object_utils
@@ -66,6 +67,10 @@ class ResourceRegistryService(ServiceProcess):
 
         self.owned_by = None
 
+        # Tells the policy interceptors to forget their ownership decisions for a resource
+        self._ownership_publisher = OwnershipChangeEventPublisher(process=self)
+        self.add_life_cycle_object(self._ownership_publisher)
+
         log.info('ResourceRegistryService.__init__()')
 
     @defer.inlineCallbacks
@@ -163,6 +168,10 @@ class ResourceRegistryService(ServiceProcess):
         yield self.push(self.datastore_service, resource_repository)
         # If the push fails hand back the workbench error
 
+        # The resource exists once the push succeeds - a failed notification must not fail the registration
+        d = self._ownership_publisher.create_and_publish_event(origin=resource.identity)
+        d.addErrback(lambda reason: log.error('Failed to publish ownership event for resource %s: %s' % (resource.identity, reason.getErrorMessage())))
+
         # Create the response object...
         response = yield self.message_client.create_instance(MessageContentTypeID=None)
 
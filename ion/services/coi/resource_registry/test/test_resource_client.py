@@ -107,6 +107,81 @@ class ResourceClientTest(IonTestCase):
 
         self.assertEqual(my_resource.ResourceName, 'Test AddressLink Resource')
 
+    @defer.inlineCallbacks
+    def test_get_instance_cached(self):
+
+        resource = yield self.rc.create_instance(ADDRESSLINK_TYPE, ResourceName='Test AddressLink Resource', ResourceDescription='A test resource')
+        res_id = resource.ResourceIdentity
+
+        services = [
+            {'name':'my_process','module':'ion.core.process.process','class':'Process'}]
+
+        sup = yield self._spawn_processes(services)
+
+        child_ps1 = yield self.sup.get_child_id('my_process')
+        proc_ps1 = self._get_procinstance(child_ps1)
+
+        my_rc = ResourceClient(proc=proc_ps1)
+        first = yield my_rc.get_instance(res_id)
+
+        # Nothing changed - the checked out state is used again
+        second = yield ResourceClient(proc=proc_ps1).get_instance(res_id)
+        self.assertIdentical(second.ResourceObject, first.ResourceObject)
+        self.assertEqual(len(proc_ps1.resource_instance_cache.entries), 1)
+
+        # A new head in the datastore is checked out
+        resource.ResourceName = 'New Name'
+        yield self.rc.put_instance(resource, 'Changing the name')
+
+        third = yield my_rc.get_instance(res_id)
+        self.assertEqual(third.ResourceName, 'New Name')
+        self.assertNotIdentical(third.ResourceObject, first.ResourceObject)
+
+        # An empty list excludes nothing and is cached apart from the default excluded types
+        fourth = yield my_rc.get_instance(res_id, excluded_types=[])
+        self.assertEqual(fourth.ResourceName, 'New Name')
+        self.assertEqual(len(proc_ps1.resource_instance_cache.entries), 2)
+
+        # The entries hold no repository - once the workbench drops it the resource is checked out again
+        proc_ps1.workbench.clear_repository_key(res_id)
+        fifth = yield my_rc.get_instance(res_id)
+        self.assertEqual(fifth.ResourceName, 'New Name')
+        self.assertNotIdentical(fifth.ResourceObject, third.ResourceObject)
+
+    @defer.inlineCallbacks
+    def test_get_instances(self):
+
+        names = ['Resource %d' % n for n in range(3)]
+        ids = []
+        for name in names:
+            resource = yield self.rc.create_instance(ADDRESSLINK_TYPE, ResourceName=name, ResourceDescription='A test resource')
+            ids.append(resource.ResourceIdentity)
+
+        services = [
+            {'name':'my_process','module':'ion.core.process.process','class':'Process'}]
+
+        sup = yield self._spawn_processes(services)
+
+        child_ps1 = yield self.sup.get_child_id('my_process')
+        proc_ps1 = self._get_procinstance(child_ps1)
+
+        my_rc = ResourceClient(proc=proc_ps1)
+        resources = yield my_rc.get_instances(ids)
+        self.assertEqual([resource.ResourceName for resource in resources], names)
+        self.assertEqual([resource.ResourceIdentity for resource in resources], ids)
+
+        # An existing instance is reused and a new one is pulled alongside it
+        resource = yield self.rc.create_instance(ADDRESSLINK_TYPE, ResourceName='Resource 3', ResourceDescription='A test resource')
+        more = yield my_rc.get_instances([ids[1], resource.ResourceIdentity])
+        self.assertIdentical(more[0].ResourceObject, resources[1].ResourceObject)
+        self.assertEqual(more[1].ResourceName, 'Resource 3')
+
+        yield self.failUnlessFailure(my_rc.get_instances([ids[0], 'not a resource id']), ResourceClientError)
+
+        skipped = yield my_rc.get_instances(['not a resource id', ids[2]], skip_failed=True)
+        self.assertEqual(skipped[0], None)
+        self.assertEqual(skipped[1].ResourceName, names[2])
+
     @defer.inlineCallbacks
     def test_resource_transaction(self):
 
@@ -33,7 +33,7 @@ from ion.core.data.storage_configuration_utility import BLOB_CACHE, COMMIT_CACHE
 
 from telephus.cassandra.ttypes import InvalidRequestException
 
-from ion.services.coi.datastore import ION_DATASETS_CFG, PRELOAD_CFG, ID_CFG, DataStoreClient, CDM_BOUNDED_ARRAY_TYPE
+from ion.services.coi.datastore import ION_DATASETS_CFG, PRELOAD_CFG, ID_CFG, DataStoreClient, CDM_BOUNDED_ARRAY_TYPE, hyperslab_slices
 # Pick three to test existence
 from ion.services.coi.datastore_bootstrap.ion_preload_config import HAS_A_ID, DATASET_RESOURCE_TYPE_ID, ROOT_USER_ID, NAME_CFG, CONTENT_ARGS_CFG, PREDICATE_CFG, ION_RESOURCE_TYPES_CFG, ION_PREDICATES_CFG, ION_IDENTITIES_CFG
 
@@ -424,6 +424,29 @@ class DataStoreTest(IonTestCase):
 
         self.assertEqual(ab.title,'Datastore Addressbook')
 
+    @defer.inlineCallbacks
+    def test_push_pull_not_modified(self):
+
+        result = yield self.wb1.workbench.push_by_name('datastore',self.repo_key)
+
+        self.assertEqual(result.MessageResponseCode, result.ResponseCodes.OK)
+
+        self.ds1.workbench.clear()
+
+        # The puller already has the head - the datastore answers without loading the repository
+        result = yield self.wb1.workbench.pull('datastore',self.repo_key)
+
+        self.assertEqual(result.MessageResponseCode, result.ResponseCodes.OK)
+        self.assertEqual(result.IsFieldSet('repo_head_element'), False)
+
+        repo = self.ds1.workbench.get_repository(self.repo_key)
+        self.assertEqual(repo,None)
+
+        repo = self.wb1.workbench.get_repository(self.repo_key)
+        ab = yield repo.checkout('master')
+
+        self.assertEqual(ab.title,'Datastore Addressbook')
+
     @defer.inlineCallbacks
     def test_push_clear_pull_again(self):
 
@@ -565,6 +588,43 @@ class DataStoreTest(IonTestCase):
             self.assertEqual(ab.title,'WB TITLE: %s' % str(n))
 
 
+    @defer.inlineCallbacks
+    def test_pull_many(self):
+
+        number = 5
+        key_list = self.create_many_repos(number)
+
+        result = yield self.wb1.workbench.push_by_name('datastore',key_list)
+        self.assertEqual(result.MessageResponseCode, result.ResponseCodes.OK)
+
+        # Clear all workbenchs
+        self.wb1.workbench.clear()
+        self.ds1.workbench.clear()
+
+        results = yield self.wb1.workbench.pull_many('datastore', key_list + key_list[:1])
+        self.assertEqual(sorted(results.keys()), sorted(key_list))
+
+        for n in range(number):
+            key = key_list[n]
+            self.assertEqual(results[key].MessageResponseCode, results[key].ResponseCodes.OK)
+
+            repo = self.wb1.workbench.get_repository(key)
+            ab = yield repo.checkout('master')
+            self.assertEqual(ab.title,'WB TITLE: %s' % str(n))
+
+    @defer.inlineCallbacks
+    def test_pull_many_not_found(self):
+
+        key_list = self.create_many_repos(2)
+        result = yield self.wb1.workbench.push_by_name('datastore',key_list)
+
+        yield self.failUnlessFailure(self.wb1.workbench.pull_many('datastore', key_list + ['not a repository key']),
+                                     workbench.WorkBenchError)
+
+        # The other pulls have all finished - skipping the failed one leaves them in the result
+        results = yield self.wb1.workbench.pull_many('datastore', key_list + ['not a repository key'], skip_failed=True)
+        self.assertEqual(sorted(results.keys()), sorted(key_list))
+
     def create_many_repos(self,number):
 
         key_list =[]
@@ -1274,3 +1334,33 @@ class DataStoreExtractDataTest(IonTestCase):
         # now the next index in our returned array
         nextidx = 10 * 10
         self.failUnlessEquals(int(bigndarray[nextidx]), nextval)
+
+
+class HyperslabSlicesTest(unittest.TestCase):
+
+    def test_full_array(self):
+        target, source = hyperslab_slices([(0, 20, 1), (0, 20, 1)], [(0, 20), (0, 20)])
+        self.assertEqual(target, (slice(0, 20), slice(0, 20)))
+        self.assertEqual(source, (slice(0, 20, 1), slice(0, 20, 1)))
+
+    def test_partial_intersection(self):
+        # request 10..15 in a bounded array covering 12..32
+        target, source = hyperslab_slices([(10, 5, 1)], [(12, 20)])
+        self.assertEqual(target, (slice(2, 5),))
+        self.assertEqual(source, (slice(0, 3, 1),))
+
+    def test_no_intersection(self):
+        self.assertEqual(hyperslab_slices([(0, 5, 1), (0, 5, 1)], [(0, 5), (5, 5)]), None)
+
+    def test_stride(self):
+        # request 0..20 stride 5 in a bounded array covering 7..27 - only 10 and 15 are in the array
+        target, source = hyperslab_slices([(0, 20, 5)], [(7, 20)])
+        self.assertEqual(target, (slice(2, 4),))
+        self.assertEqual(range(20)[source[0]], [3, 8])
+
+    def test_strided_out(self):
+        # the array intersects the request but holds none of the strided indices
+        self.assertEqual(hyperslab_slices([(0, 20, 5)], [(6, 3)]), None)
+
+    def test_scalar(self):
+        self.assertEqual(hyperslab_slices([], []), ((), ()))
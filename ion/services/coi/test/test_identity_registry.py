@@ -436,3 +436,35 @@ w/0z56l5aPSP52xpWjzPyywv+4ku+LXEyWF3qj4xJww8SVBP5nmTsYEJwu26g97ZWprehJzOOhWu
         yield self.irc.unset_role(user_id, role)
         self.failIf(user_has_role(user_id, role))
 
+
+    @defer.inlineCallbacks
+    def test_subject_index(self):
+        irs = self._get_service_by_name('identity_registry')
+
+        # the preloaded identities are indexed when the service is activated
+        self.assertEqual(irs.subject_index.get(self.user2_subject), self.user2_ooi_id)
+
+        IdentityRequest = yield self.mc.create_instance(RESOURCE_CFG_REQUEST_TYPE, MessageName='IR request')
+        IdentityRequest.configuration = IdentityRequest.CreateObject(IDENTITY_TYPE)
+        IdentityRequest.configuration.certificate = self.user1_certificate
+        IdentityRequest.configuration.rsa_private_key = self.user1_rsa_private_key
+
+        Response = yield self.irc.register_user(IdentityRequest)
+        ooi_id1 = Response.resource_reference.ooi_id
+        self.assertEqual(irs.subject_index.get(self.user1_subject), ooi_id1)
+
+        # an identity missing from the index, eg. registered by another identity registry, is found and indexed
+        irs.subject_index.ooi_ids.clear()
+        irs.subject_index.subjects.clear()
+
+        Response = yield self.irc.authenticate_user(IdentityRequest)
+        self.assertEqual(Response.resource_reference.ooi_id, ooi_id1)
+        self.assertEqual(irs.subject_index.get(self.user1_subject), ooi_id1)
+        self.assertEqual(irs.subject_index.get(self.user2_subject), self.user2_ooi_id)
+
+        # a stale entry is dropped
+        irs.subject_index._set('/CN=nobody', self.user2_ooi_id)
+        identity, ooi_id = yield irs._findUser('/CN=nobody')
+        self.assertEqual(identity, None)
+        self.assertEqual(irs.subject_index.get('/CN=nobody'), None)
+        self.assertEqual(irs.subject_index.get(self.user2_subject), self.user2_ooi_id)
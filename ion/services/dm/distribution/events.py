@@ -51,6 +51,7 @@ BUSINESS_STATE_MODIFICATION_EVENT_ID = 1112
 DATASET_CHANGE_EVENT_ID = 1113
 DATASOURCE_CHANGE_EVENT_ID = 1114
 INGESTION_PROCESSING_EVENT_ID = 1115
+OWNERSHIP_CHANGE_EVENT_ID = 1117
 DATASET_STREAMING_EVENT_ID = 1116           #  NOTE: There is no "Publisher" of this event - as it only comes from DatasetAgent (Java) and does not use the
                                             #  standard Message Types for events.  Instead, expect messages of ids 10001, 2001, and 2005.
 NEW_SUBSCRIPTION_EVENT_ID = 1201
@@ -361,6 +362,15 @@ class IngestionProcessingEventPublisher(ResourceModifiedEventPublisher):
     event_id = INGESTION_PROCESSING_EVENT_ID
     msg_type = INGESTION_PROCESSING_EVENT_MESSAGE_TYPE
     
+class OwnershipChangeEventPublisher(ResourceModifiedEventPublisher):
+    """
+    Event Notification Publisher for a change of the owner of a resource - Will cause the policy interceptor to
+    drop its ownership decisions for this UUID.
+
+    The "origin" parameter in this class' initializer should be the resource id (UUID).
+    """
+    event_id = OWNERSHIP_CHANGE_EVENT_ID
+
 class NewSubscriptionEventPublisher(EventPublisher):
     """
     Event Notification Publisher for Subscription Modifications.
@@ -615,6 +625,14 @@ class DatasetStreamingEventSubscriber(ResourceModifiedEventSubscriber):
     """
     event_id = DATASET_STREAMING_EVENT_ID
 
+class OwnershipChangeEventSubscriber(ResourceModifiedEventSubscriber):
+    """
+    Event Notification Subscriber for a change of the owner of a resource.
+
+    The "origin" parameter in this class' initializer should be the resource id (UUID).
+    """
+    event_id = OWNERSHIP_CHANGE_EVENT_ID
+
 class NewSubscriptionEventSubscriber(EventSubscriber):
     """
     Event Notification Subscriber for Subscription Modifications.
@@ -6,13 +6,13 @@
 @brief An example service definition that can be used as template for resource management.
 """
 import uuid
-from os import getcwd, chdir
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
-from ion.services.dm.inventory.ncml_generator import create_ncml, do_complete_rsync, check_for_ncml_files
+from ion.services.dm.inventory.ncml_generator import do_complete_rsync, ncml_contents, ncml_filename, \
+    ncml_hash, read_ncml_hashes, write_ncml_files
 from ion.core import ioninit
 
 from ion.core.process.process import ProcessFactory
@@ -180,6 +180,15 @@ class DatasetController(ServiceProcess):
 
 
 
+        # Dataset GUID to the hash of its NcML file as last written, read from
+        # ncml_path on the first sync. Only files whose hash changes are
+        # rewritten and pushed.
+        self._ncml_hashes = None
+        # The first sync, and any sync after a failed rsync, pushes the whole
+        # directory so the server catches up with whatever it missed.
+        self._full_sync_needed = True
+        self._sync_running = False
+
         log.debug('Update interval: %f' % self.update_interval)
         log.debug('NcML URL: %s Local path: %s' % (self.server_url, self.ncml_path))
         log.debug('Scheduler queue name: %s Task ID: %s' % (self.queue_name, self.task_id))
@@ -234,30 +243,60 @@ class DatasetController(ServiceProcess):
     def do_ncml_sync(self):
         """
         @brief On receipt of scheduler message, do rsync with server, moving
-        any new ncml files over.
+        any new ncml files over. Only the NcML files whose contents changed
+        since the last sync are written and pushed; ticks which arrive while a
+        sync is still running are skipped.
         """
+        if self._sync_running:
+            log.warn('Previous NcML sync still running, skipping this one')
+            defer.returnValue(None)
+
+        self._sync_running = True
+        try:
+            yield self._sync_changed_ncml()
+        finally:
+            self._sync_running = False
+
+    @defer.inlineCallbacks
+    def _sync_changed_ncml(self):
         log.debug('rsync scheduled beginning now')
-        #if check_for_ncml_files(self.ncml_path):
 
         query_result = yield self._get_active_dataset_resources()
 
+        if self._ncml_hashes is None:
+            self._ncml_hashes = yield threads.deferToThread(read_ncml_hashes, self.ncml_path)
+
+        changed = []
         for id_ref in query_result.idrefs:
-            create_ncml(id_ref.key, self.ncml_path)
+            if self._ncml_hashes.get(id_ref.key) != ncml_hash(ncml_contents(id_ref.key)):
+                changed.append(id_ref.key)
+
+        written = {}
+        if changed:
+            log.debug('Writing %d changed NcML files' % len(changed))
+            written = yield threads.deferToThread(write_ncml_files, self.ncml_path, changed)
+            self._ncml_hashes.update(written)
+
+        if self._full_sync_needed:
+            files = None
+        elif written:
+            files = sorted(ncml_filename(id_ref) for id_ref in written)
+        else:
+            log.debug('No NcML changes, skipping rsync')
+            defer.returnValue(None)
 
-        log.debug('NcML files found, invoking rsync')
-        self.cwd = getcwd()
-        chdir(self.ncml_path)
-        yield do_complete_rsync(self.ncml_path, self.server_url,
-                                    self.private_key, self.public_key)
+        log.debug('NcML files changed, invoking rsync')
+        try:
+            yield do_complete_rsync(self.ncml_path, self.server_url,
+                                    self.private_key, self.public_key, files=files)
+        except Exception:
+            # The files written this time were not pushed, catch up next time
+            self._full_sync_needed = True
+            raise
 
-        chdir(self.cwd)
+        self._full_sync_needed = False
         log.debug('rsync complete')
 
-        defer.returnValue(None)
-
-        #else:
-        #    log.debug('No ncml found, doing nothing')
-        
     #noinspection PyUnusedLocal
     @defer.inlineCallbacks
     def op_create_dataset_resource(self, request, headers, msg):
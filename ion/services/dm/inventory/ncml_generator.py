@@ -17,7 +17,9 @@ file_template = """<?xml version="1.0" encoding="UTF-8"?>\n<netcdf xmlns="http:/
 
 from os import path, environ, chmod, unlink, listdir, remove
 import fnmatch
+import hashlib
 import os
+import tempfile
 
 from twisted.internet import defer
 from ion.util.os_process import OSProcess
@@ -38,18 +40,81 @@ def create_ncml(id_ref, filepath=""):
     @retval File contents, as a string, or None if error
     """
 
-    full_filename = path.join(filepath, id_ref + '.ncml')
+    full_filename = path.join(filepath, ncml_filename(id_ref))
+    contents = ncml_contents(id_ref)
     log.debug('Generating NcML file %s' % full_filename)
     try:
         fh = open(full_filename, 'w')
-        fh.write(file_template % id_ref)
+        fh.write(contents)
         fh.close()
     except IOError:
         log.exception('Error writing NcML file')
         return None
 
+    return contents
+
+def ncml_filename(id_ref):
+    """
+    @brief The name of the NcML file of a dataset, relative to the NcML directory
+    """
+    return id_ref + '.ncml'
+
+def ncml_contents(id_ref):
+    """
+    @brief The NcML document of a dataset, as written by create_ncml
+    """
     return file_template % id_ref
 
+def ncml_hash(contents):
+    """
+    @brief Hash of the contents of an NcML file, used to tell whether it needs rewriting
+    """
+    return hashlib.sha1(contents).hexdigest()
+
+def write_ncml_files(local_filepath, id_refs):
+    """
+    @brief Write the NcML files of several datasets in one go. This blocks on
+    file IO, run it with threads.deferToThread rather than on the reactor.
+    @param local_filepath Output directory
+    @param id_refs Dataset GUIDs to write
+    @retval Dict of GUID to the hash of the contents written, only for the files
+    written without error
+    """
+    written = {}
+    for id_ref in id_refs:
+        contents = create_ncml(id_ref, local_filepath)
+        if contents is not None:
+            written[id_ref] = ncml_hash(contents)
+    return written
+
+def read_ncml_hashes(local_filepath):
+    """
+    @brief Hash the NcML files already on disk, so that a restarted controller
+    does not rewrite files which are up to date. Blocks on file IO.
+    @param local_filepath Directory of NcML files
+    @retval Dict of GUID to the hash of its file contents
+    """
+    hashes = {}
+    try:
+        allfiles = listdir(local_filepath)
+    except OSError:
+        log.exception('Error searching %s for ncml files' % local_filepath)
+        return hashes
+
+    for file in allfiles:
+        if not fnmatch.fnmatch(file, '*.ncml'):
+            continue
+        try:
+            fh = open(path.join(local_filepath, file), 'r')
+            try:
+                hashes[file[:-len('.ncml')]] = ncml_hash(fh.read())
+            finally:
+                fh.close()
+        except IOError:
+            log.exception('Error reading NcML file %s' % file)
+
+    return hashes
+
 def check_for_ncml_files(local_filepath):
     """
     Check for ncml files on disk.
@@ -100,26 +165,53 @@ def clear_ncml_files(local_filepath):
 
 
 
-def rsync_ncml(local_filepath, server_url):
+def rsync_args(local_filepath, server_url, files_from=None):
+    """
+    @brief Arguments to rsync for a full sync of the directory, or with
+    files_from for pushing only the files listed in that file.
+    """
+    if files_from is None:
+        return ['-r', '--perms', '--include', '"*.ncml"',
+                '-v', '-h', '--delete', local_filepath + '/', server_url]
+
+    # Paths in the list are relative to the source directory. There is no
+    # --delete here, it would only apply to the listed files anyway.
+    return ['--perms', '--files-from', files_from,
+            '-v', '-h', local_filepath + '/', server_url]
+
+def rsync_ncml(local_filepath, server_url, files=None):
     """
     @brief Method to perform a bidirectional sync with a remote server,
     probably via rsync, unison or similar. Should be called after generating all
     local ncml files.
     @param local_filepath Local directory for writing ncml file(s)
     @param server_url rsync URL of the server
-    @param ssh_key_filename the filename of the private key
+    @param files Names of the files to push, relative to local_filepath. If None
+    the whole directory is synced, deleting remote files which are gone locally
     @retval Deferred that will callback when rsync exits, or errback if rsync fails
     """
-    
-    args = ['-r', '--perms', '--include', '"*.ncml"',
-            '-v', '-h', '--delete', local_filepath + '/', server_url]
+    files_from = None
+    if files is not None:
+        fd, files_from = tempfile.mkstemp(prefix='rsync_ncml', suffix='.list')
+        fh = os.fdopen(fd, 'w')
+        fh.write(''.join(name + '\n' for name in files))
+        fh.close()
 
+    args = rsync_args(local_filepath, server_url, files_from)
 
     log.debug("rsync command %s " % (RSYNC_CMD,))
     
     rp = OSProcess(binary=RSYNC_CMD, spawnargs=args, env=environ.data)
     log.debug('Command is "%s"'% ' '.join(args))
-    return rp.spawn()
+    d = rp.spawn()
+
+    if files_from is not None:
+        def _remove_list(result):
+            unlink(files_from)
+            return result
+        d.addBoth(_remove_list)
+
+    return d
     
 
 def rsa_to_dot_ssh(private_key, public_key, delete_old=True):
@@ -166,10 +258,11 @@ def rsa_to_dot_ssh(private_key, public_key, delete_old=True):
 
 
 @defer.inlineCallbacks
-def do_complete_rsync(local_ncml_path, server_url, private_key, public_key):
+def do_complete_rsync(local_ncml_path, server_url, private_key, public_key, files=None):
     """
     Orchestration routine to tie it all together plus cleanup at the end.
-    Needs the inlineCallbacks to serialise.
+    Needs the inlineCallbacks to serialise. Pass files to push only those
+    files instead of the whole directory, see rsync_ncml.
     """
     #print private_key
     #log.debug("private_key is %s" % (private_key,))
@@ -183,13 +276,14 @@ def do_complete_rsync(local_ncml_path, server_url, private_key, public_key):
   
     ssh_cmd = "".join(("ssh -i ", skey, " -o StrictHostKeyChecking=no "))
     os.environ["RSYNC_RSH"] =  ssh_cmd
-    yield rsync_ncml(local_ncml_path, server_url)
-    del os.environ["RSYNC_RSH"]
-
+    try:
+        yield rsync_ncml(local_ncml_path, server_url, files)
+    finally:
+        del os.environ["RSYNC_RSH"]
 
-    # Delete the keys from the file system
-    unlink(skey)
-    unlink(pkey)
+        # Delete the keys from the file system
+        unlink(skey)
+        unlink(pkey)
 
 
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/dm/inventory/test/test_ncml_generator.py
+@test ion.services.dm.inventory.ncml_generator Incremental writing and syncing of NcML files
+"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from ion.services.dm.inventory import ncml_generator
+from ion.services.dm.inventory.ncml_generator import ncml_contents, ncml_hash, read_ncml_hashes, \
+    rsync_args, rsync_ncml, write_ncml_files
+
+
+class NcMLGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ncml_path = tempfile.mkdtemp(prefix='ncml')
+
+    def tearDown(self):
+        shutil.rmtree(self.ncml_path)
+
+    def test_write_and_read_hashes(self):
+        written = write_ncml_files(self.ncml_path, ['ds1', 'ds2'])
+        self.assertEqual(written, {'ds1': ncml_hash(ncml_contents('ds1')),
+                                   'ds2': ncml_hash(ncml_contents('ds2'))})
+        self.assertEqual(sorted(os.listdir(self.ncml_path)), ['ds1.ncml', 'ds2.ncml'])
+
+        open(os.path.join(self.ncml_path, 'notes.txt'), 'w').close()
+        self.assertEqual(read_ncml_hashes(self.ncml_path), written)
+
+    def test_write_error(self):
+        written = write_ncml_files(os.path.join(self.ncml_path, 'missing'), ['ds1'])
+        self.assertEqual(written, {})
+        self.assertEqual(read_ncml_hashes(os.path.join(self.ncml_path, 'missing')), {})
+
+    def test_rsync_args(self):
+        full = rsync_args(self.ncml_path, 'server:/ncml')
+        self.assertIn('--delete', full)
+        self.assertEqual(full[-2:], [self.ncml_path + '/', 'server:/ncml'])
+
+        changed = rsync_args(self.ncml_path, 'server:/ncml', '/tmp/list')
+        self.assertNotIn('--delete', changed)
+        self.assertEqual(changed[changed.index('--files-from') + 1], '/tmp/list')
+        self.assertEqual(changed[-2:], [self.ncml_path + '/', 'server:/ncml'])
+
+    @defer.inlineCallbacks
+    def test_rsync_changed_files(self):
+        if ncml_generator.RSYNC_CMD != 'echo':
+            raise unittest.SkipTest('rsync is not configured as echo')
+
+        result = yield rsync_ncml(self.ncml_path, 'server:/ncml', ['ds1.ncml', 'ds2.ncml'])
+        args = ''.join(result['outlines']).split()
+        files_from = args[args.index('--files-from') + 1]
+
+        # The list of files is removed once rsync exits
+        self.assertFalse(os.path.exists(files_from))
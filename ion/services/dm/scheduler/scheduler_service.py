@@ -15,8 +15,9 @@ from ion.core.object.repository import ObjectContainer
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 import re
+import random
 from uuid import uuid4
 
 from ion.core.data import cassandra, store
@@ -27,6 +28,7 @@ from ion.core.messaging.message_client import MessageClient
 from ion.core.object import object_utils
 from ion.services.dm.distribution.events import TriggerEventPublisher, ScheduleEventPublisher
 from ion.core.data.storage_configuration_utility import get_cassandra_configuration, STORAGE_PROVIDER, PERSISTENT_ARCHIVE
+from ion.services.dm.scheduler.task_heap import ScheduledTask, TaskTimer, task_shard, shard_service_name
 
 from ion.util.iontime import IonTime
 
@@ -36,6 +38,12 @@ import ion.util.procutils as pu
 from ion.core import ioninit
 CONF = ioninit.config(__name__)
 
+# Number of scheduler workers the tasks are sharded across, by task_id. With more than one, worker n is spawned
+# with the spawn args servicename scheduler_<n> and shard n.
+SHARD_COUNT = CONF.getValue('shard_count', 1)
+# Tasks due within this many seconds of each other are published together
+SCHEDULER_TICK = CONF.getValue('tick', 0.5)
+
 # constants from https://confluence.oceanobservatories.org/display/syseng/Scheduler+Events
 # import these and use them to schedule your events, they should be in the "desired origin" field
 SCHEDULE_TYPE_PERFORM_INGESTION_UPDATE="1001"
@@ -198,8 +206,13 @@ class SchedulerService(ServiceProcess):
 
         self.mc = MessageClient(proc=self)
 
-        # maps task_ids to IDelayedCall objects, popped off when callback is called, used to cancel tasks
-        self._callback_tasks = {}
+        self.shard_count = int(self.spawn_args.get('shard_count', SHARD_COUNT))
+        self.shard = int(self.spawn_args.get('shard', 0))
+        assert 0 <= self.shard < self.shard_count, 'Scheduler shard %d is not in range of the %d shards' % (self.shard, self.shard_count)
+
+        # The decoded definitions of the tasks of this shard, fired from a timing heap. The index store is written
+        # through on add and remove and only read when the service is activated.
+        self._task_timer = TaskTimer(self._publish_tasks, tick=self.spawn_args.get('tick', SCHEDULER_TICK))
 
         # will move pub through the lifecycle states with the service
         self.pub = ScheduleEventPublisher(process=self)
@@ -226,21 +239,40 @@ class SchedulerService(ServiceProcess):
         rows = yield self.scheduled_events.query(query)
 
         for task_id, tdef in rows.iteritems():
+            if not self._owns_task(task_id):
+                continue
+
             log.debug("slc_activate: scheduling %s" % task_id)
-            self._schedule_event(int(tdef['start_time']), int(tdef['interval_seconds']), task_id)
+            starttime = tdef['start_time']
+            if starttime == 'None':
+                starttime = None
+            else:
+                starttime = int(starttime)
+            self._schedule_event(starttime, int(tdef['interval_seconds']), self._decode_task(task_id, tdef))
+
+        log.info('Scheduler shard %d of %d activated with %d tasks' % (self.shard, self.shard_count, len(self._task_timer)))
 
     def slc_terminate(self):
         """
         Called before terminate, this is a good place to tear down the AS and jobs.
-        @todo iterate over the list
-        foreach task in op_query:
-          rm_task(task)
         """
-        for k, v in self._callback_tasks.iteritems():
-            if v.active():
-                v.cancel()
+        self._task_timer.stop()
+
+    def _owns_task(self, task_id):
+        return task_shard(task_id, self.shard_count) == self.shard
+
+    def _decode_task(self, task_id, tdef):
+        """
+        Make the in memory definition of a task from its row in the store, parsing the payload once.
+        """
+        try:
+            payload = StructureElement.parse_structure_element(tdef['payload'], trusted=True)
+        except TypeError:
+            payload = None
 
-    def _schedule_event(self, starttime, interval, task_id):
+        return ScheduledTask(task_id, tdef['desired_origin'], tdef['user_id'], int(tdef['interval_seconds']), payload)
+
+    def _schedule_event(self, starttime, interval, task):
         """
         Helper method to schedule and record a callback in the service.
         Used by op_add_task and on startup.
@@ -252,9 +284,9 @@ class SchedulerService(ServiceProcess):
                             epoch format, in ms. You will have to convert the output from time.time() in Python, or
                             use the IonTime utility class.
         @param  interval    The interval to trigger scheduler events, in seconds.
-        @param  task_id     The task_id to trigger.
+        @param  task        The ScheduledTask to trigger.
         """
-        assert interval and task_id and interval > 0
+        assert interval and task and interval > 0
         curtime = IonTime().time_ms
         starttime = starttime or curtime
 
@@ -270,8 +302,7 @@ class SchedulerService(ServiceProcess):
 
         log.debug("_schedule_event: calculated next callback time of %d" % calctime)
 
-        ccl = reactor.callLater(calctime, self._send_and_reschedule, task_id)
-        self._callback_tasks[task_id] = ccl
+        self._task_timer.add(task, calctime)
 
     @defer.inlineCallbacks
     def op_add_task(self, content, headers, msg):
@@ -283,7 +314,7 @@ class SchedulerService(ServiceProcess):
         @retval reply_ok or reply_err
         """
         try:
-            task_id         = content.task_id or str(uuid4())
+            task_id         = content.task_id or self._new_task_id()
             msg_interval    = content.interval_seconds
             desired_origin  = content.desired_origin
             if content.IsFieldSet('start_time'):
@@ -325,10 +356,17 @@ class SchedulerService(ServiceProcess):
 
         log.debug('AddTask: about to add task %s' % task_id)
 
+        if not self._owns_task(task_id):
+            raise SchedulerError("Task %s belongs to scheduler shard %d, not %d" % (task_id, task_shard(task_id, self.shard_count), self.shard),
+                                 content.ResponseCodes.BAD_REQUEST)
+
         resp = yield self.mc.create_instance(ADDTASK_RSP_TYPE)
 
-        # check to see if the task_id already exists in the store
-        existing_task = yield self.scheduled_events.get(task_id)
+        # check to see if the task_id is already scheduled or exists in the store
+        if task_id in self._task_timer:
+            existing_task = task_id
+        else:
+            existing_task = yield self.scheduled_events.get(task_id)
         if existing_task is not None:
             log.warn("Already have task with id %s scheduled." % task_id)
             resp.duplicate = True
@@ -340,21 +378,22 @@ class SchedulerService(ServiceProcess):
         resp.origin     = desired_origin
 
         # extract content of message
-        self.scheduled_events.put(task_id,
+        tdef = {'task_id': task_id,
+                'constant': '1',    # used for being able to pull all tasks
+                'user_id': user_id,
+                'start_time': str(starttime),
+                'end_time': str(endtime),
+                'interval_seconds': str(msg_interval),
+                'desired_origin': desired_origin,
+                'payload': payload}
+        yield self.scheduled_events.put(task_id,
                                   task_id,  # ok to use for value? seems kind of silly
-                                  index_attributes={'task_id': task_id,
-                                                    'constant': '1',    # used for being able to pull all tasks
-                                                    'user_id': user_id,
-                                                    'start_time': str(starttime),
-                                                    'end_time': str(endtime),
-                                                    'interval_seconds': str(msg_interval),
-                                                    'desired_origin': desired_origin,
-                                                    'payload': payload})
+                                  index_attributes=tdef)
 
         # Now that task is stored into registry, add to messaging callback
         log.debug('Adding task to scheduler')
 
-        self._schedule_event(starttime, msg_interval, task_id)
+        self._schedule_event(starttime, msg_interval, self._decode_task(task_id, tdef))
 
         log.debug('Add completed OK')
 
@@ -363,8 +402,7 @@ class SchedulerService(ServiceProcess):
     @defer.inlineCallbacks
     def op_rm_task(self, content, headers, msg):
         """
-        Remove a task from the list/store. Will be dropped from the reactor
-        when the timer fires and _send_and_reschedule checks the registry.
+        Remove a task from the timing heap and the store.
         """
         task_id = content.task_id
 
@@ -375,9 +413,7 @@ class SchedulerService(ServiceProcess):
             return
 
         # if the task is active, remove it
-        if self._callback_tasks.has_key(task_id):
-            self._callback_tasks[task_id].cancel()
-            del self._callback_tasks[task_id]
+        self._task_timer.remove(task_id)
 
         log.debug('Removing task_id %s from store...' % task_id)
         yield self.scheduled_events.remove(task_id)
@@ -391,53 +427,49 @@ class SchedulerService(ServiceProcess):
     ##################################################
     # Internal methods
 
-    @defer.inlineCallbacks
-    def _send_and_reschedule(self, task_id):
+    def _new_task_id(self):
         """
-        Check to see if we're still in the store - if not, we've been removed
-        and should abort the run.
+        A new task id which belongs to the shard of this scheduler.
         """
-        log.debug('Worker activated for task %s' % task_id)
+        task_id = str(uuid4())
+        while not self._owns_task(task_id):
+            task_id = str(uuid4())
+        return task_id
 
-        q = Query()
-        q.add_predicate_eq('task_id', task_id)
-
-        tdefs = yield self.scheduled_events.query(q)
-        assert len(tdefs) == 1
+    @defer.inlineCallbacks
+    def _publish_tasks(self, tasks):
+        """
+        Called by the task timer with the tasks due in this tick. Each task has its own event origin so the events
+        are published separately, but all at once rather than one timer callback at a time.
+        """
+        log.debug('Publishing events for %d tasks' % len(tasks))
 
-        tdef = tdefs.values()[0]
+        results = yield defer.DeferredList([self._send_task_event(task) for task in tasks], consumeErrors=True)
 
-        # pop callback object off of scheduled items
-        assert self._callback_tasks.has_key(task_id)
-        del self._callback_tasks[task_id]
+        for task, (success, result) in zip(tasks, results):
+            if not success:
+                log.error('Failed to send the event of task %s: %s' % (task.task_id, result.getErrorMessage()))
 
-        # deserialize and objectify payload
-        log.debug('Time to send to "%s", id "%s"' % (tdef['desired_origin'], task_id))
+    @defer.inlineCallbacks
+    def _send_task_event(self, task):
+        log.debug('Time to send to "%s", id "%s"' % (task.desired_origin, task.task_id))
 
-        msg = yield self.pub.create_event(origin=tdef['desired_origin'],
-                                          task_id=tdef['task_id'],
-                                          user_id=tdef['user_id'])
+        msg = yield self.pub.create_event(origin=task.desired_origin,
+                                          task_id=task.task_id,
+                                          user_id=task.user_id)
 
-        try:
-            se = StructureElement.parse_structure_element(tdef['payload'])
-            payload = msg.Repository._load_element(se)
-            msg.Repository.index_hash[payload.MyId]=se
+        if task.payload is not None:
+            payload = msg.Repository._load_element(task.payload)
+            msg.Repository.index_hash[payload.MyId] = task.payload
 
             msg.additional_data.payload = payload
-        except TypeError:
+        else:
             log.info('No payload found')
 
-        yield self.pub.publish_event(msg, origin=tdef['desired_origin'])
-
-        log.debug('Send completed, rescheduling %s' % task_id)
+        yield self.pub.publish_event(msg, origin=task.desired_origin)
 
         self.workbench.cache_repository(msg.Repository)
 
-        # start time of None is fine, we just happened so we can be sure interval_seconds is just about right
-        self._schedule_event(None, int(tdef['interval_seconds']), task_id)
-
-        log.debug('Task %s rescheduled for %s seconds OK' % (task_id, tdef['interval_seconds']))
-
 class SchedulerServiceClient(ServiceClient):
     """
     Client class for the SchedulerService, simple muster/send/reply.
@@ -445,9 +477,24 @@ class SchedulerServiceClient(ServiceClient):
     def __init__(self, proc=None, **kwargs):
         if not 'targetname' in kwargs:
             kwargs['targetname'] = 'scheduler'
+        self.shard_count = kwargs.pop('shard_count', SHARD_COUNT)
+        self.targetname = kwargs['targetname']
         ServiceClient.__init__(self, proc, **kwargs)
         self.mc = MessageClient(proc=proc)
 
+    def _shard_target(self, task_id):
+        """
+        The scheduler shard to send a request for task_id to. Tasks without an id can go to any shard.
+        """
+        if self.shard_count <= 1:
+            return self.target
+
+        if task_id:
+            shard = task_shard(task_id, self.shard_count)
+        else:
+            shard = random.randrange(self.shard_count)
+        return self.proc.get_scoped_name('system', shard_service_name(self.targetname, shard))
+
     @defer.inlineCallbacks
     def add_task(self, msg):
         """
@@ -459,7 +506,7 @@ class SchedulerServiceClient(ServiceClient):
         """
         yield self._check_init()
 
-        (ret, heads, message) = yield self.rpc_send('add_task', msg)
+        (ret, heads, message) = yield self.proc.rpc_send(self._shard_target(msg.task_id), 'add_task', msg)
         defer.returnValue(ret)
 
 
@@ -476,7 +523,7 @@ class SchedulerServiceClient(ServiceClient):
         #log.info("In SchedulerServiceClient: rm_task")
         yield self._check_init()
 
-        (ret, heads, message) = yield self.rpc_send('rm_task', msg)
+        (ret, heads, message) = yield self.proc.rpc_send(self._shard_target(msg.task_id), 'rm_task', msg)
         defer.returnValue(ret)
 
 # Spawn of the process using the module name
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/dm/scheduler/task_heap.py
+@package ion.services.dm.scheduler.task_heap In memory timing heap of the scheduler tasks
+@brief The scheduler keeps the decoded definition of each of its tasks in a heap ordered by the time the task is
+next due, driven by a single reactor timer. Tasks which fall due in the same tick are handed over together.
+"""
+
+import heapq
+import itertools
+import math
+import zlib
+
+from twisted.internet import defer, reactor
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+
+def task_shard(task_id, shard_count):
+    """
+    The shard of the scheduler which owns a task.
+    @param task_id the task id
+    @param shard_count the number of scheduler shards
+    @retval an int in range(shard_count)
+    """
+    if shard_count <= 1:
+        return 0
+    return (zlib.crc32(task_id) & 0xffffffff) % shard_count
+
+
+def shard_service_name(name, shard):
+    """
+    The service name of one shard of the scheduler, eg. scheduler_0
+    """
+    return '%s_%d' % (name, shard)
+
+
+class ScheduledTask(object):
+    """
+    The decoded definition of a scheduler task, as held in memory between firings.
+    """
+    __slots__ = ('task_id', 'desired_origin', 'user_id', 'interval', 'payload', 'due')
+
+    def __init__(self, task_id, desired_origin, user_id, interval, payload=None):
+        """
+        @param interval the seconds between firings
+        @param payload the parsed StructureElement of the payload or None
+        """
+        self.task_id = task_id
+        self.desired_origin = desired_origin
+        self.user_id = user_id
+        self.interval = interval
+        self.payload = payload
+        self.due = None
+
+    def __repr__(self):
+        return 'ScheduledTask(%r, interval=%r, due=%r)' % (self.task_id, self.interval, self.due)
+
+
+class TaskHeap(object):
+    """
+    A heap of ScheduledTasks ordered by the time they are next due. Removing a task leaves its heap entry in place,
+    stale entries are skipped when they reach the top and dropped when the heap is compacted.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def get(self, task_id):
+        return self.tasks.get(task_id)
+
+    def push(self, task, due):
+        """
+        Add a task, or move it to a new due time.
+        """
+        task.due = due
+        self.tasks[task.task_id] = task
+        heapq.heappush(self._heap, (due, self._seq.next(), task))
+
+        if len(self._heap) > 2 * len(self.tasks) + 64:
+            self._compact()
+
+    def remove(self, task_id):
+        """
+        @retval the removed task or None
+        """
+        return self.tasks.pop(task_id, None)
+
+    def next_due(self):
+        """
+        @retval the time the first task is due or None if the heap is empty
+        """
+        heap = self._heap
+        while heap and not self._is_current(heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        """
+        Take all of the tasks due at or before now off the heap. The tasks remain known to the heap until they
+        are removed, push them again with their next due time.
+        @retval a list of tasks in the order they are due
+        """
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if self._is_current(entry):
+                due.append(entry[2])
+        return due
+
+    def _is_current(self, entry):
+        due, seq, task = entry
+        return self.tasks.get(task.task_id) is task and task.due == due
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._is_current(entry)]
+        heapq.heapify(self._heap)
+
+
+class TaskTimer(object):
+    """
+    Fires the tasks of a TaskHeap as they fall due with one reactor timer for the earliest task, instead of a
+    timer per task. Tasks due within tick seconds of each other are fired together in one call to fire, and each
+    is rescheduled one interval after its due time before fire is called.
+    """
+
+    def __init__(self, fire, tick=0.5, clock=None):
+        """
+        @param fire a callable taking the list of due tasks, may return a Deferred
+        @param tick the seconds within which due tasks are coalesced
+        @param clock an IReactorTime provider, the reactor by default
+        """
+        self.fire = fire
+        self.tick = tick
+        self.clock = clock or reactor
+        self.heap = TaskHeap()
+        self._call = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, task_id):
+        return task_id in self.heap
+
+    def add(self, task, delay):
+        """
+        Schedule a task to fire delay seconds from now and then every task.interval seconds.
+        """
+        self.heap.push(task, self.clock.seconds() + delay)
+        self._arm()
+
+    def remove(self, task_id):
+        """
+        Stop firing a task.
+        @retval the removed task or None
+        """
+        return self.heap.remove(task_id)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _arm(self):
+        due = self.heap.next_due()
+        if due is None:
+            return
+
+        if self._call is not None and self._call.active():
+            if self._call.getTime() <= due:
+                return
+            self._call.cancel()
+
+        self._call = self.clock.callLater(max(0, due - self.clock.seconds()), self._tick)
+
+    def _tick(self):
+        self._call = None
+        now = self.clock.seconds()
+
+        tasks = self.heap.pop_due(now + self.tick)
+        for task in tasks:
+            next_due = task.due + task.interval
+            if next_due <= now:
+                # Missed firings are skipped rather than fired in a burst
+                next_due += math.ceil((now - next_due) / task.interval + 1e-9) * task.interval
+            self.heap.push(task, next_due)
+
+        self._arm()
+
+        if tasks:
+            d = defer.maybeDeferred(self.fire, tasks)
+            d.addErrback(lambda reason: log.error('Failed to fire %d scheduled tasks: %s' % (len(tasks), reason.getErrorMessage())))
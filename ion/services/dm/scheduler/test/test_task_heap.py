@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+@file ion/services/dm/scheduler/test/test_task_heap.py
+@test ion.services.dm.scheduler.task_heap The timing heap and sharding of scheduler tasks
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from ion.services.dm.scheduler.task_heap import ScheduledTask, TaskHeap, TaskTimer, task_shard
+
+
+class TaskHeapTest(unittest.TestCase):
+
+    def test_pop_due(self):
+        heap = TaskHeap()
+        for i, due in enumerate([5, 1, 3, 2, 4]):
+            heap.push(ScheduledTask('t%d' % i, 'origin', 'user', 10), due)
+
+        self.assertEqual(heap.next_due(), 1)
+        self.assertEqual([t.task_id for t in heap.pop_due(3)], ['t1', 't3', 't2'])
+        self.assertEqual(heap.next_due(), 4)
+        self.assertEqual(len(heap), 5)
+
+    def test_remove_and_move(self):
+        heap = TaskHeap()
+        t0 = ScheduledTask('t0', 'origin', 'user', 10)
+        t1 = ScheduledTask('t1', 'origin', 'user', 10)
+        heap.push(t0, 1)
+        heap.push(t1, 2)
+
+        self.assertEqual(heap.remove('t0'), t0)
+        self.assertFalse('t0' in heap)
+        self.assertEqual(heap.next_due(), 2)
+
+        heap.push(t1, 7)
+        self.assertEqual(heap.pop_due(5), [])
+        self.assertEqual(heap.pop_due(7), [t1])
+
+    def test_compact(self):
+        heap = TaskHeap()
+        t0 = ScheduledTask('t0', 'origin', 'user', 10)
+        for due in xrange(1000):
+            heap.push(t0, due)
+        self.assertTrue(len(heap._heap) < 100)
+        self.assertEqual(heap.pop_due(2000), [t0])
+
+
+class TaskTimerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fired = []
+        self.timer = TaskTimer(self._fire, tick=0.5, clock=self.clock)
+
+    def _fire(self, tasks):
+        self.fired.append((self.clock.seconds(), sorted(t.task_id for t in tasks)))
+
+    def test_one_timer(self):
+        for i in range(100):
+            self.timer.add(ScheduledTask('t%d' % i, 'origin', 'user', 10), 5 + i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(5)
+        self.assertEqual(self.fired, [(5, ['t0'])])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_coalesce(self):
+        self.timer.add(ScheduledTask('a', 'origin', 'user', 10), 1)
+        self.timer.add(ScheduledTask('b', 'origin', 'user', 10), 1.3)
+        self.timer.add(ScheduledTask('c', 'origin', 'user', 10), 2)
+
+        self.clock.pump([1, 1])
+        self.assertEqual(self.fired, [(1, ['a', 'b']), (2, ['c'])])
+
+        # the cadence of each task is kept
+        self.clock.advance(9)
+        self.assertEqual(self.fired[-1], (11, ['a', 'b']))
+        self.assertEqual(self.timer.heap.get('b').due, 21.3)
+
+    def test_remove(self):
+        self.timer.add(ScheduledTask('a', 'origin', 'user', 1), 1)
+        self.timer.add(ScheduledTask('b', 'origin', 'user', 1), 1)
+        self.clock.advance(1)
+        self.timer.remove('a')
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [(1, ['a', 'b']), (2, ['b'])])
+
+        self.timer.remove('b')
+        self.clock.advance(1)
+        self.assertEqual(len(self.fired), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_earlier_task_rearms(self):
+        self.timer.add(ScheduledTask('late', 'origin', 'user', 100), 50)
+        self.timer.add(ScheduledTask('early', 'origin', 'user', 100), 5)
+        self.assertEqual([c.getTime() for c in self.clock.getDelayedCalls()], [5])
+
+    def test_fire_error(self):
+        def fire(tasks):
+            return defer.fail(ValueError('publish failed'))
+        self.timer.fire = fire
+        self.timer.add(ScheduledTask('a', 'origin', 'user', 1), 1)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(self.timer.heap.get('a').due, 3)
+
+
+class TaskShardTest(unittest.TestCase):
+
+    def test_task_shard(self):
+        counts = [0] * 4
+        for i in xrange(4000):
+            shard = task_shard('task_%d' % i, 4)
+            self.assertEqual(shard, task_shard('task_%d' % i, 4))
+            counts[shard] += 1
+        self.assertTrue(min(counts) > 800)
+        self.assertEqual(task_shard('task', 1), 0)
@@ -6,8 +6,90 @@
 @brief Simple caching utilities.
 """
 
+import bisect
+import mmap
+import os
+from collections import deque
 from time import time
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.5 and 2.6 - just the part of OrderedDict which LRUDict uses
+    class OrderedDict(dict):
+        """
+        Dictionary which iterates in insertion order, kept in a doubly linked list of [prev, next, key] links.
+        """
+
+        def __init__(self):
+            dict.__init__(self)
+            self._links = {}
+            self._root = root = []
+            root[:] = [root, root, None]
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                root = self._root
+                last = root[0]
+                last[1] = root[0] = self._links[key] = [last, root, key]
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            prev, next_link, key = self._links.pop(key)
+            prev[1] = next_link
+            next_link[0] = prev
+
+        def __iter__(self):
+            root = self._root
+            link = root[1]
+            while link is not root:
+                yield link[2]
+                link = link[1]
+
+        iterkeys = __iter__
+
+        def pop(self, key, *default):
+            if key in self:
+                value = dict.__getitem__(self, key)
+                del self[key]
+                return value
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        def popitem(self, last=True):
+            if not self:
+                raise KeyError('dictionary is empty')
+            if last:
+                key = self._root[0][2]
+            else:
+                key = self._root[1][2]
+            return key, self.pop(key)
+
+        def keys(self):
+            return list(self)
+
+        def values(self):
+            return [dict.__getitem__(self, key) for key in self]
+
+        def items(self):
+            return [(key, dict.__getitem__(self, key)) for key in self]
+
+        def itervalues(self):
+            for key in self:
+                yield dict.__getitem__(self, key)
+
+        def iteritems(self):
+            for key in self:
+                yield key, dict.__getitem__(self, key)
+
+        def clear(self):
+            dict.clear(self)
+            self._links.clear()
+            root = self._root
+            root[:] = [root, root, None]
+
 class memoize(object):
     """
     Memoize with timeout.
@@ -60,144 +142,295 @@ class memoize(object):
 
 class LRUDict(object):
     """
-    Amortized O(1) LRU cache with a dict-like interface. Based on http://code.activestate.com/recipes/252524/ (r3)
+    Amortized O(1) cache with a dict-like interface. Originally based on http://code.activestate.com/recipes/252524/ (r3)
     Copyright 2003 Josiah Carlson.
     Modified by Adam R. Smith to support sizes and to be more dict-like.
     Licensed under the PSF License: http://docs.python.org/license.html
-    """
 
-    class Node(object):
-        __slots__ = ['prev', 'next', 'me', 'size']
-        def __init__(self, prev, me, size=1):
-            self.prev = prev
-            self.me = me
-            self.next = None
-            self.size = size
+    Three eviction policies are supported:
+    'lru' - least recently used.
+    '2q'  - new entries go in a FIFO which holds a quarter of the limit. Only keys which are used again after they
+            leave it - remembered in a ghost list - get into the main LRU list, so a scan does not flush it.
+    'arc' - adaptive replacement cache. Entries seen once and entries seen more than once are kept in separate LRU
+            lists and the split between them adapts to the hits on recently evicted keys.
+
+    With use_size the size of an entry is measured again each time it is used, so entries which grow while they are
+    cached are accounted for. Values must have a cheap __sizeof__. Evicted values which have a clear method are
+    cleared.
+
+    With the 2q and arc policies a value taken out with pop and put back again is treated as used again - the
+    workbench checks repositories out of its cache this way.
+    """
 
+    LRU = 'lru'
+    TWO_Q = '2q'
+    ARC = 'arc'
 
-    def __init__(self, limit, pairs=None, use_size=False):
+    def __init__(self, limit, pairs=None, use_size=False, policy=LRU):
         """ limit is either an integer item count or a size in bytes. """
 
+        if policy not in (self.LRU, self.TWO_Q, self.ARC):
+            raise ValueError('Unknown cache policy: "%s"' % policy)
+
         self.limit = max(limit, 1)
-        self.d = {}
-        self.first = None
-        self.last = None
         self.use_size = use_size
-        self.total_size = 0
+        self.policy = policy
+
+        # t1 is the lru list, the 2q FIFO or the arc recent list. t2 is the 2q or arc frequent list.
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._t1_size = 0
+        self._t2_size = 0
+
+        # Ghost lists of the sizes of keys recently evicted from t1 and t2 - b2 is only used by arc
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._b1_size = 0
+        self._b2_size = 0
+
+        # Sizes of the keys recently taken out with pop
+        self._popped = OrderedDict()
+        self._popped_size = 0
+
+        # The size of each entry as it is accounted
+        self._sizes = {}
+
+        # Target size of t1 for arc
+        self._p = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
         if pairs is None: pairs = []
         for key, value in pairs:
             self[key] = value
 
+    @property
+    def total_size(self):
+        return self._t1_size + self._t2_size
+
+    def _sizeof(self, val):
+        if self.use_size and hasattr(val, '__sizeof__'):
+            return val.__sizeof__()
+        return 1
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
     def __contains__(self, key):
-        return key in self.d
+        return key in self._t1 or key in self._t2
 
     def has_key(self, key):
-        return key in self.d
+        return key in self
+
+    def _peek(self, key):
+        if key in self._t1:
+            return self._t1[key]
+        return self._t2[key]
+
+    def _account(self, key, size):
+        """ Set the accounted size of an entry """
+        delta = size - self._sizes[key]
+        self._sizes[key] = size
+        if key in self._t1:
+            self._t1_size += delta
+        else:
+            self._t2_size += delta
+
+    def _touch(self, key):
+        """ Record a use of an entry according to the policy """
+        if key in self._t1:
+            if self.policy == self.LRU:
+                self._t1[key] = self._t1.pop(key)
+            elif self.policy == self.ARC:
+                size = self._sizes[key]
+                self._t1_size -= size
+                self._t2[key] = self._t1.pop(key)
+                self._t2_size += size
+            # 2q leaves entries in its FIFO where they are
+        else:
+            self._t2[key] = self._t2.pop(key)
 
     def __getitem__(self, key):
-        a = self.d[key].me
-        self[a[0]] = a[1]
-        return a[1]
+        if key not in self._t1 and key not in self._t2:
+            self.misses += 1
+            raise KeyError(key)
 
-    def __setitem__(self, key, val):
-        if key in self.d:
-            del self[key]
+        self.hits += 1
+        self._touch(key)
+        val = self._peek(key)
 
-        size = 1
-        if self.use_size and hasattr(val, '__sizeof__'):
-            size = val.__sizeof__()
-        self.total_size += size
-
-        nobj = LRUDict.Node(self.last, (key, val), size)
-        if self.first is None:
-            self.first = nobj
-        if self.last:
-            self.last.next = nobj
-        self.last = nobj
-        self.d[key] = nobj
-
-        self.purge()
-
-    def purge(self):
-        while self.total_size > self.limit:
-            if self.first == self.last:
-                self.first = None
-                self.last = None
-                self.total_size = 0
-                return
-
-            a = self.first
-            self.total_size -= a.size
-            a.next.prev = None
-            self.first = a.next
-            a.next = None
-
-            nobj = self.d[a.me[0]]
-            obj = nobj.me[1]
-            if hasattr(obj, 'clear'):
-                obj.clear()
+        if self.use_size:
+            self._account(key, self._sizeof(val))
+            self.purge(key)
 
-            del self.d[a.me[0]]
-            del a
+        return val
 
-    def __delitem__(self, key):
-        nobj = self.d[key]
-        self.total_size -= nobj.size
+    def __setitem__(self, key, val):
+        size = self._sizeof(val)
+
+        if key in self._t1 or key in self._t2:
+            if key in self._t1:
+                self._t1[key] = val
+            else:
+                self._t2[key] = val
+            self._account(key, size)
+            self._touch(key)
+
+        elif self.policy == self.LRU:
+            self._insert(self._t1, key, val, size)
+
+        elif key in self._popped:
+            self._popped_size -= self._popped.pop(key)
+            self._insert(self._t2, key, val, size)
+
+        elif key in self._b1:
+            if self.policy == self.ARC:
+                # Evicted from the recent list too soon - grow its target
+                delta = max(self._b2_size / max(self._b1_size, 1), 1) * size
+                self._p = min(self.limit, self._p + delta)
+            self._b1_size -= self._b1.pop(key)
+            self._insert(self._t2, key, val, size)
+
+        elif key in self._b2:
+            # Evicted from the frequent list too soon - shrink the recent target
+            delta = max(self._b1_size / max(self._b2_size, 1), 1) * size
+            self._p = max(0, self._p - delta)
+            self._b2_size -= self._b2.pop(key)
+            self._insert(self._t2, key, val, size)
 
-        if nobj.prev:
-            nobj.prev.next = nobj.next
         else:
-            self.first = nobj.next
-        if nobj.next:
-            nobj.next.prev = nobj.prev
+            self._insert(self._t1, key, val, size)
+
+        self.purge(key)
+
+    def _insert(self, lst, key, val, size):
+        lst[key] = val
+        self._sizes[key] = size
+        if lst is self._t1:
+            self._t1_size += size
+        else:
+            self._t2_size += size
+
+    def _victim_list(self, protect):
+        """ Choose the list to evict from - avoid evicting the protected key while there is anything else """
+        if self.policy == self.LRU:
+            use_t1 = True
+        elif self.policy == self.TWO_Q:
+            use_t1 = bool(self._t1) and (self._t1_size > self.limit / 4 or not self._t2)
+        else:
+            use_t1 = bool(self._t1) and (self._t1_size > self._p or not self._t2)
+
+        lst, other = (self._t1, self._t2) if use_t1 else (self._t2, self._t1)
+        if not lst or (len(lst) == 1 and other and iter(lst).next() == protect):
+            lst = other
+        return lst
+
+    def purge(self, protect=None):
+        while self._t1_size + self._t2_size > self.limit and (self._t1 or self._t2):
+
+            lst = self._victim_list(protect)
+            key, obj = lst.popitem(last=False)
+            size = self._sizes.pop(key)
+
+            if lst is self._t1:
+                self._t1_size -= size
+                if self.policy != self.LRU:
+                    self._b1[key] = size
+                    self._b1_size += size
+            else:
+                self._t2_size -= size
+                if self.policy == self.ARC:
+                    self._b2[key] = size
+                    self._b2_size += size
+
+            self.evictions += 1
+            self._evicted(key, obj)
+
+        # Keep the ghost lists bounded
+        if self.policy == self.TWO_Q:
+            while self._b1 and self._b1_size > self.limit / 2:
+                self._b1_size -= self._b1.popitem(last=False)[1]
+        elif self.policy == self.ARC:
+            while self._b1 and self._t1_size + self._b1_size > self.limit:
+                self._b1_size -= self._b1.popitem(last=False)[1]
+            while self._b2 and self._b1_size + self._b2_size > self.limit:
+                self._b2_size -= self._b2.popitem(last=False)[1]
+
+    def shrink(self, size):
+        """ Evict entries in the order of the policy until the cache holds at most size """
+        limit = self.limit
+        self.limit = max(size, 0)
+        try:
+            self.purge()
+        finally:
+            self.limit = limit
+
+    def _evicted(self, key, obj):
+        """ Called with each entry evicted by purge """
+        if hasattr(obj, 'clear'):
+            obj.clear()
+
+    def __delitem__(self, key):
+        size = self._sizes.pop(key)
+        if key in self._t1:
+            del self._t1[key]
+            self._t1_size -= size
         else:
-            self.last = nobj.prev
-        del self.d[key]
+            del self._t2[key]
+            self._t2_size -= size
 
     def __iter__(self):
-        cur = self.first
-        while cur != None:
-            cur2 = cur.next
-            yield cur.me[1]
-            cur = cur2
+        for val in self._t1.values():
+            yield val
+        for val in self._t2.values():
+            yield val
 
     def iteritems(self):
-        cur = self.first
-        while cur != None:
-            cur2 = cur.next
-            yield cur.me
-            cur = cur2
+        for item in self._t1.items():
+            yield item
+        for item in self._t2.items():
+            yield item
 
     def iterkeys(self):
-        return iter(self.d)
+        for key in self._t1.keys():
+            yield key
+        for key in self._t2.keys():
+            yield key
 
     def itervalues(self):
-        for i,j in self.iteritems():
-            yield j
+        return iter(self)
 
     def keys(self):
-        return self.d.keys()
+        return self._t1.keys() + self._t2.keys()
 
     def pop(self, key):
-        obj = self.get(key)
+        obj = self._peek(key)
+        size = self._sizes[key]
         del self[key]
+
+        if self.policy != self.LRU:
+            self._popped[key] = size
+            self._popped_size += size
+            while self._popped_size > self.limit:
+                self._popped_size -= self._popped.popitem(last=False)[1]
+
         return obj
 
     def touch(self, key):
         """ Recalculate the size of the object at the given key, and update its access time. """
-        val = self[key]
-        if self.use_size and hasattr(val, '__sizeof__'):
-            old_size = val.size
-            val.size = val.__sizeof__()
-            self.total_size += val.size - old_size
+        self._touch(key)
+        val = self._peek(key)
+        self._account(key, self._sizeof(val))
 
-        self.purge()
+        self.purge(key)
         return val
 
     def get(self, key, default=None):
-        if key in self.d:
+        if key in self:
             return self[key]
+        self.misses += 1
         return default
 
     def update(self, d):
@@ -206,16 +439,319 @@ class LRUDict(object):
 
     def clear(self):
 
-        for nobj in self.d.itervalues():
-            obj = nobj.me[1]
-
+        for obj in self:
             if hasattr(obj, 'clear'):
                 obj.clear()
 
-        self.d.clear()
-        self.total_size = 0
-        self.first = None
-        self.last = None
+        self._t1.clear()
+        self._t2.clear()
+        self._b1.clear()
+        self._b2.clear()
+        self._popped.clear()
+        self._sizes.clear()
+        self._t1_size = self._t2_size = self._b1_size = self._b2_size = self._popped_size = 0
+        self._p = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache counters
+        """
+        requests = self.hits + self.misses
+        return {'hits':self.hits,
+                'misses':self.misses,
+                'hit_ratio':float(self.hits) / requests if requests else 0.0,
+                'evictions':self.evictions,
+                'items':len(self),
+                'size':self.total_size,
+                'limit':self.limit,
+                'policy':self.policy,
+                }
+
+
+class SpillFile(object):
+    """
+    Fixed size memory mapped file used as a ring buffer for values evicted from a BlobCache.
+    Values are appended at a cursor which wraps to the start of the file. Any held value which a new value overlaps
+    is dropped, so the oldest spilled values are forgotten first.
+    """
+
+    def __init__(self, filename, size):
+
+        self.filename = filename
+        self.size = max(int(size), 1)
+
+        self._file = open(filename, 'w+b')
+        self._file.truncate(self.size)
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+        # key -> (offset, length)
+        self._index = {}
+        # Sorted offsets of the held values and the key at each offset. Held values never overlap.
+        self._offsets = []
+        self._keys = {}
+        self._cursor = 0
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def put(self, key, value):
+        length = len(value)
+        if length > self.size:
+            return False
+
+        self._remove(key)
+
+        if self._cursor + length > self.size:
+            self._cursor = 0
+
+        start = self._cursor
+        end = start + length
+
+        # Drop every held value which this one overwrites - the one starting before start if it runs past it and
+        # all of those starting in [start, end). An empty value still displaces a value at the same offset.
+        offsets = self._offsets
+        first = bisect.bisect_left(offsets, start)
+        if first > 0:
+            offset = offsets[first - 1]
+            if offset + self._index[self._keys[offset]][1] > start:
+                first -= 1
+        last = bisect.bisect_left(offsets, max(end, start + 1))
+
+        for offset in offsets[first:last]:
+            del self._index[self._keys.pop(offset)]
+        offsets[first:last] = [start]
+
+        self._map[start:end] = value
+        self._keys[start] = key
+        self._index[key] = (start, length)
+        self._cursor = end
+        return True
+
+    def _remove(self, key):
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return None
+
+        offset = entry[0]
+        del self._keys[offset]
+        del self._offsets[bisect.bisect_left(self._offsets, offset)]
+        return entry
+
+    def pop(self, key):
+        """
+        Remove the value from the spill file and return it, or None if it is not held
+        """
+        entry = self._remove(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._map[offset:offset + length]
+
+    def clear(self):
+        self._index.clear()
+        self._keys.clear()
+        self._offsets = []
+        self._cursor = 0
+
+    def close(self):
+        self.clear()
+        self._map.close()
+        self._file.close()
+        os.remove(self.filename)
+
+
+class BlobCache(LRUDict):
+    """
+    Byte bounded cache of immutable string values such as serialized structure elements keyed by their sha1.
+    Supports the LRUDict policies - 'arc' or '2q' keep a single large scan from flushing the frequently used values.
+
+    If a spill file is given, evicted values are written to a memory mapped file and promoted back on a hit.
+    """
+
+    def __init__(self, limit, policy=LRUDict.LRU, spill_file=None, spill_size=0):
+        """
+        @param limit is the maximum number of bytes of values held in memory
+        @param policy is one of the LRUDict policies
+        @param spill_file is an optional file name for values evicted from memory
+        @param spill_size is the size of the spill file in bytes
+        """
+        self._spill = None
+        if spill_file is not None and spill_size > 0:
+            self._spill = SpillFile(spill_file, spill_size)
+
+        self.spill_hits = 0
+
+        LRUDict.__init__(self, limit, use_size=True, policy=policy)
+
+    def _sizeof(self, val):
+        return len(val)
+
+    def __contains__(self, key):
+        return LRUDict.__contains__(self, key) or (self._spill is not None and key in self._spill)
+
+    def get(self, key, default=None):
+
+        if LRUDict.__contains__(self, key):
+            self.hits += 1
+            # Values are immutable - no need to measure them again
+            self._touch(key)
+            return self._peek(key)
+
+        if self._spill is not None:
+            value = self._spill.pop(key)
+            if value is not None:
+                self.spill_hits += 1
+                self.put(key, value)
+                return value
+
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get_many(self, keys):
+        """
+        Returns a dictionary of the values found for keys and a list of the keys which were not found
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        return found, missing
+
+    def put(self, key, value):
+
+        if len(value) > self.limit:
+            return
+
+        # Values are immutable - just record the use
+        if LRUDict.__contains__(self, key):
+            self._touch(key)
+            return
+
+        if self._spill is not None:
+            self._spill.pop(key)
+
+        LRUDict.__setitem__(self, key, value)
+
+    __setitem__ = put
+
+    def _evicted(self, key, value):
+        if self._spill is not None:
+            self._spill.put(key, value)
+
+    def clear(self):
+        LRUDict.clear(self)
+        if self._spill is not None:
+            self._spill.clear()
+
+    def close(self):
+        self.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def stats(self):
+        """
+        Returns a dictionary of the cache counters
+        """
+        stats = LRUDict.stats(self)
+        requests = self.hits + self.spill_hits + self.misses
+        stats.update({'spill_hits':self.spill_hits,
+                      'hit_ratio':float(self.hits + self.spill_hits) / requests if requests else 0.0,
+                      'bytes':self.total_size,
+                      'spilled_items':len(self._spill) if self._spill is not None else 0,
+                      })
+        return stats
+
+class TimedPins(object):
+    """
+    Strong references to values which must stay available for a while even though nothing else holds them. Each
+    pin lasts for pin_time seconds after it was last renewed. The pinned bytes are bounded - pin refuses a value
+    which does not fit rather than dropping a pin before it expires.
+    """
+
+    def __init__(self, limit, pin_time, clock=time):
+        """
+        @param limit is the maximum number of bytes of pinned values
+        @param pin_time is the seconds a pin lasts
+        @param clock is a callable returning the time in seconds
+        """
+        self.limit = limit
+        self.pin_time = pin_time
+        self.clock = clock
+        self.size = 0
+
+        # key -> [value, size, expiry]
+        self._pins = {}
+        # (expiry, key) in the order the pins were made or renewed
+        self._expiry = deque()
+
+    def __len__(self):
+        return len(self._pins)
+
+    def __contains__(self, key):
+        self.expire()
+        return key in self._pins
+
+    def pin(self, key, value, size):
+        """
+        Pin a value, or renew the pin if it is already held.
+        @retval True if the value is pinned, False if there is no room for it
+        """
+        now = self.clock()
+        self.expire(now)
+
+        expiry = now + self.pin_time
+        entry = self._pins.get(key)
+        if entry is None:
+            if self.size + size > self.limit:
+                return False
+            self._pins[key] = [value, size, expiry]
+            self.size += size
+        else:
+            entry[2] = expiry
+
+        self._expiry.append((expiry, key))
+        return True
+
+    def get(self, key, default=None):
+        self.expire()
+        entry = self._pins.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def expire(self, now=None):
+        """
+        Drop the pins which have not been renewed in pin_time seconds
+        """
+        if now is None:
+            now = self.clock()
+
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            key = expiry.popleft()[1]
+            entry = self._pins.get(key)
+            if entry is not None and entry[2] <= now:
+                del self._pins[key]
+                self.size -= entry[1]
+
+    def clear(self):
+        self._pins.clear()
+        self._expiry.clear()
+        self.size = 0
 
 if __name__ == '__main__':
     def main():
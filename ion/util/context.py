@@ -10,6 +10,8 @@ import sys
 import weakref
 import threading
 
+from twisted.internet import defer
+
 class temp(object):
     def __init__(self, f):
         self.f = f
@@ -127,6 +129,129 @@ class ContextLocal(threading.local):
     def clear(self):
         self.__dict__.clear()
 
+
+class RequestContext(object):
+    """
+    Holds the context of one request, eg. the user-id from the request message.
+    """
+
+    def get(self, key, defaultVal=None):
+        return self.__dict__.get(key, defaultVal)
+
+    def clear(self):
+        self.__dict__.clear()
+
+
+class ReactorContextLocal(threading.local):
+    """
+    Request context storage for code running in the reactor thread. Attribute access goes to the
+    active RequestContext. Message processing activates its own context, and a Deferred bound with
+    bind() fires with the context that was active when it was bound, so the context follows a
+    request through the Deferred chain instead of a thread. Once follow_deferreds() is called the
+    same holds for every callback added while a request context is active, so a handler resumes in
+    its own context after any Deferred it waits on. Between events the previous context is
+    restored. Each thread other than the reactor thread has its own active context.
+    """
+
+    def __init__(self):
+        base = RequestContext()
+        threading.local.__setattr__(self, '_base', base)
+        threading.local.__setattr__(self, '_active', base)
+
+    @property
+    def current(self):
+        """
+        The active RequestContext
+        """
+        return self._active
+
+    def activate(self, context):
+        """
+        Makes a RequestContext the active context
+        @retval the previously active context
+        """
+        previous = self._active
+        threading.local.__setattr__(self, '_active', context)
+        return previous
+
+    def call_in_context(self, context, f, *args, **kwargs):
+        """
+        Calls f with the given context active, restoring the previous context when f returns.
+        Code in f which runs later, after a Deferred fires, runs in the context if that Deferred is
+        bound with bind() or follow_deferreds() has been called.
+        """
+        previous = self.activate(context)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.activate(previous)
+
+    def bind(self, d, context=None):
+        """
+        @param d A Deferred
+        @param context The context to fire in, by default the active context
+        @retval A Deferred which fires with the result of d, with the context active while its
+            callbacks run
+        """
+        if context is None:
+            context = self._active
+
+        bound = defer.Deferred()
+        d.addCallbacks(lambda result: self.call_in_context(context, bound.callback, result),
+                       lambda reason: self.call_in_context(context, bound.errback, reason))
+        return bound
+
+    def follow_deferreds(self):
+        """
+        Makes every callback added to a Deferred while a request context is active run with that
+        context active - code which resumes after a store call, a thread or an RPC result keeps the
+        context of the request it belongs to. Callbacks added in the base context are left as they
+        are. Applies to all Deferreds in the process, so it is called once, for the container's
+        request context.
+        """
+        add_callbacks = defer.Deferred.addCallbacks
+        local = self
+
+        def addCallbacks(d, callback, errback=None, callbackArgs=None, callbackKeywords=None,
+                         errbackArgs=None, errbackKeywords=None):
+            context = local._active
+            if context is not local._base:
+                callback = _in_context(local, context, callback)
+                errback = _in_context(local, context, errback or defer.passthru)
+            return add_callbacks(d, callback, errback, callbackArgs, callbackKeywords,
+                                 errbackArgs, errbackKeywords)
+
+        addCallbacks.__doc__ = add_callbacks.__doc__
+        defer.Deferred.addCallbacks = addCallbacks
+
+    def get(self, key, defaultVal=None):
+        return self._active.get(key, defaultVal)
+
+    def clear(self):
+        self._active.clear()
+
+    def __getattr__(self, key):
+        try:
+            return getattr(self._active, key)
+        except AttributeError:
+            raise AttributeError('There is no attribute named "%s" in the current request context' % key)
+
+    def __setattr__(self, key, val):
+        setattr(self._active, key, val)
+
+    def __delattr__(self, key):
+        delattr(self._active, key)
+
+
+def _in_context(local, context, f):
+    """
+    @retval a callable which calls f with context active in local
+    """
+    def call(*args, **kwargs):
+        return local.call_in_context(context, f, *args, **kwargs)
+    return call
+
+
 if __name__ == '__main__':
     context = StackLocal()
     frame = sys._getframe()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+"""
+@file ion/util/test/test_cache.py
+@brief Tests for the caching utilities
+"""
+
+import os
+import tempfile
+
+from twisted.trial import unittest
+
+import ion.util.ionlog
+log = ion.util.ionlog.getLogger(__name__)
+
+from ion.util.cache import BlobCache, LRUDict, SpillFile, TimedPins
+
+
+class Sized(object):
+    """ A value which can grow while it is cached """
+    def __init__(self, size):
+        self.size = size
+        self.cleared = False
+    def __sizeof__(self):
+        return self.size
+    def clear(self):
+        self.cleared = True
+
+
+class LRUDictTest(unittest.TestCase):
+
+    def test_lru(self):
+
+        lru = LRUDict(3)
+        for key in 'abc':
+            lru[key] = key
+        self.assertEqual(lru['a'], 'a')
+        lru['d'] = 'd'
+
+        self.assertEqual(set(lru.keys()), set('acd'))
+        self.assertEqual(len(lru), 3)
+        self.assertRaises(KeyError, lru.__getitem__, 'b')
+        self.assertEqual(lru.get('b', 5), 5)
+
+        stats = lru.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_evicted_values_cleared(self):
+
+        lru = LRUDict(10, use_size=True)
+        a = Sized(6)
+        lru['a'] = a
+        lru['b'] = Sized(6)
+
+        self.assertNotIn('a', lru)
+        self.assertEqual(a.cleared, True)
+        self.assertEqual(lru.total_size, 6)
+
+    def test_size_follows_growth(self):
+
+        lru = LRUDict(100, use_size=True)
+        a = Sized(10)
+        b = Sized(10)
+        lru['a'] = a
+        lru['b'] = b
+        self.assertEqual(lru.total_size, 20)
+
+        # The size is measured again when the value is used
+        b.size = 50
+        lru.get('b')
+        self.assertEqual(lru.total_size, 60)
+
+        # Growing past the limit evicts the other entries
+        b.size = 95
+        lru.touch('b')
+        self.assertEqual(lru.total_size, 95)
+        self.assertNotIn('a', lru)
+        self.assertIn('b', lru)
+
+    def test_shrink(self):
+
+        lru = LRUDict(100, use_size=True)
+        for key in 'abc':
+            lru[key] = Sized(20)
+        lru.get('a')
+
+        lru.shrink(45)
+        self.assertEqual(set(lru.keys()), set('ac'))
+        self.assertEqual(lru.total_size, 40)
+        self.assertEqual(lru.limit, 100)
+
+        lru.shrink(0)
+        self.assertEqual(len(lru), 0)
+
+    def _scan(self, policy):
+
+        cache = LRUDict(10, policy=policy)
+
+        # The working set is used a few times
+        for i in range(3):
+            for key in ('hot1', 'hot2'):
+                if key in cache:
+                    cache[key]
+                else:
+                    cache[key] = key
+                    # Checked out and back in again, as the workbench does with repositories
+                    cache[key] = cache.pop(key)
+
+        # A scan of many values used only once
+        for i in range(100):
+            cache['scan%d' % i] = i
+
+        return cache
+
+    def test_scan_resistance(self):
+
+        for policy in (LRUDict.TWO_Q, LRUDict.ARC):
+            cache = self._scan(policy)
+            self.assertIn('hot1', cache)
+            self.assertIn('hot2', cache)
+            self.assertEqual(len(cache), 10)
+
+        cache = self._scan(LRUDict.LRU)
+        self.assertNotIn('hot1', cache)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, LRUDict, 10, policy='mru')
+
+
+class BlobCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+
+        cache = BlobCache(100, policy=BlobCache.LRU)
+        for key in 'abc':
+            cache[key] = key * 30
+
+        # Use 'a' so that 'b' is the least recently used
+        self.assertEqual(cache.get('a'), 'a' * 30)
+        cache['d'] = 'd' * 30
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.total_size, 90)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertRaises(KeyError, cache.__getitem__, 'b')
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_too_big(self):
+
+        cache = BlobCache(10)
+        cache['a'] = 'a' * 11
+        self.assertNotIn('a', cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_get_many(self):
+
+        cache = BlobCache(100)
+        cache.update({'a':'1', 'b':'2'})
+
+        found, missing = cache.get_many(['a', 'b', 'c'])
+        self.assertEqual(found, {'a':'1', 'b':'2'})
+        self.assertEqual(missing, ['c'])
+
+    def test_arc_scan_resistance(self):
+
+        arc = BlobCache(100, policy=BlobCache.ARC)
+        lru = BlobCache(100, policy=BlobCache.LRU)
+
+        for cache in (arc, lru):
+            cache['a'] = 'a' * 30
+            cache['b'] = 'b' * 30
+            cache.get('a')
+            cache.get('b')
+
+            # A scan of values that are only used once
+            for i in range(20):
+                cache['scan%d' % i] = 's' * 30
+
+        self.assertIn('a', arc)
+        self.assertIn('b', arc)
+
+        self.assertNotIn('a', lru)
+        self.assertNotIn('b', lru)
+
+    def test_spill(self):
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+
+        cache = BlobCache(60, spill_file=filename, spill_size=100)
+        self.addCleanup(cache.close)
+
+        for key in 'abcd':
+            cache[key] = key * 30
+
+        # 'a' and 'b' were evicted from memory to the spill file
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+
+        self.assertEqual(cache.get('a'), 'a' * 30)
+        self.assertEqual(cache.stats()['spill_hits'], 1)
+
+        # Fill the spill file until 'a' is overwritten
+        for i in range(10):
+            cache['x%d' % i] = str(i) * 30
+
+        self.assertEqual(cache.get('a'), None)
+
+    def test_spill_file_wrap(self):
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+
+        spill = SpillFile(filename, 100)
+        self.addCleanup(spill.close)
+
+        for key, length in [('a', 40), ('b', 30), ('t', 30), ('c', 40), ('d', 65)]:
+            self.assertTrue(spill.put(key, key * length))
+
+        # 'd' wrapped over 'c' and 'b' even though the older 't' was left alone
+        self.assertNotIn('c', spill)
+        self.assertNotIn('b', spill)
+        self.assertEqual(spill.pop('c'), None)
+        self.assertEqual(spill.pop('t'), 't' * 30)
+        self.assertEqual(spill.pop('d'), 'd' * 65)
+        self.assertEqual(len(spill), 0)
+
+        # The cursor is at 65 - 'e' fits at the end, 'f' wraps to 0, 'h' overwrites 'e' and 'i' wraps over 'f'
+        for key in 'efgh':
+            spill.put(key, key * 30)
+        spill.put('i', 'i' * 20)
+        self.assertEqual(sorted(k for k in 'efghi' if k in spill), ['g', 'h', 'i'])
+        self.assertEqual(spill.pop('g'), 'g' * 30)
+        self.assertEqual(spill.pop('h'), 'h' * 30)
+        self.assertEqual(spill.pop('i'), 'i' * 20)
+
+
+
+class TimedPinsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.pins = TimedPins(10, 5, clock=lambda: self.now)
+
+    def test_expiry(self):
+        self.assertTrue(self.pins.pin('a', 'A', 4))
+        self.now = 3
+        self.assertTrue(self.pins.pin('b', 'B', 4))
+        self.assertEqual(self.pins.get('a'), 'A')
+
+        # Renewing a pin keeps it past its first expiry
+        self.assertTrue(self.pins.pin('a', 'A', 4))
+        self.now = 6
+        self.pins.expire()
+        self.assertEqual(self.pins.get('a'), 'A')
+
+        self.now = 8
+        self.pins.expire()
+        self.assertEqual(self.pins.get('a'), None)
+        self.assertEqual(self.pins.get('b'), None)
+        self.assertEqual(self.pins.size, 0)
+
+    def test_lookup_expires(self):
+        self.assertTrue(self.pins.pin('a', 'A', 4))
+        self.assertTrue('a' in self.pins)
+
+        # A pin whose time is up is not found, even if nothing has been pinned since
+        self.now = 5
+        self.assertFalse('a' in self.pins)
+        self.assertEqual(self.pins.get('a'), None)
+        self.assertEqual(self.pins.size, 0)
+
+    def test_limit(self):
+        self.assertTrue(self.pins.pin('a', 'A', 6))
+        self.assertFalse(self.pins.pin('b', 'B', 6))
+        self.assertEqual(self.pins.get('b'), None)
+
+        # Room is made by expiry, never by dropping a live pin
+        self.now = 5
+        self.assertTrue(self.pins.pin('b', 'B', 6))
+        self.assertEqual(self.pins.get('a'), None)
+        self.assertEqual(len(self.pins), 1)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+@file ion/util/test/test_context.py
+@brief Tests for the request context storage
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task, threads
+
+from ion.util.context import ReactorContextLocal, RequestContext
+
+
+class ReactorContextLocalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = ReactorContextLocal()
+
+    def test_attributes(self):
+        self.request.user_id = 'alice'
+        self.assertEqual(self.request.user_id, 'alice')
+        self.assertEqual(self.request.current.user_id, 'alice')
+        self.assertEqual(self.request.get('expiry', '0'), '0')
+        self.assertRaises(AttributeError, getattr, self.request, 'expiry')
+
+        self.request.clear()
+        self.assertEqual(self.request.get('user_id'), None)
+
+    def test_call_in_context(self):
+        self.request.user_id = 'root'
+        context = RequestContext()
+
+        def f():
+            self.request.user_id = 'alice'
+            return self.request.user_id
+
+        self.assertEqual(self.request.call_in_context(context, f), 'alice')
+        self.assertEqual(context.user_id, 'alice')
+        self.assertEqual(self.request.user_id, 'root')
+
+    def test_bind(self):
+        """
+        Two requests waiting on deferreds each resume in their own context,
+        whatever context is active when the deferreds fire.
+        """
+        seen = []
+        waiting = {}
+
+        @defer.inlineCallbacks
+        def handle(user_id):
+            self.request.user_id = user_id
+            waiting[user_id] = defer.Deferred()
+            yield self.request.bind(waiting[user_id])
+            seen.append((user_id, self.request.user_id))
+
+        d1 = self.request.call_in_context(RequestContext(), handle, 'alice')
+        d2 = self.request.call_in_context(RequestContext(), handle, 'bob')
+
+        self.assertEqual(self.request.get('user_id'), None)
+
+        waiting['bob'].callback(None)
+        waiting['alice'].callback(None)
+
+        self.assertEqual(seen, [('bob', 'bob'), ('alice', 'alice')])
+        self.assertEqual(self.request.get('user_id'), None)
+        return defer.DeferredList([d1, d2])
+
+    def test_bind_errback(self):
+        context = RequestContext()
+        context.user_id = 'alice'
+
+        d = defer.Deferred()
+        bound = self.request.bind(d, context)
+
+        def check(reason):
+            reason.trap(ValueError)
+            self.assertEqual(self.request.user_id, 'alice')
+        bound.addCallbacks(lambda _: self.fail('should errback'), check)
+
+        d.errback(ValueError('failed'))
+        self.assertEqual(self.request.get('user_id'), None)
+        return bound
+
+
+class FollowDeferredsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = ReactorContextLocal()
+        # follow_deferreds patches the Deferred class - put it back after the test
+        self.patch(defer.Deferred, 'addCallbacks', defer.Deferred.__dict__['addCallbacks'])
+        self.request.follow_deferreds()
+
+    @defer.inlineCallbacks
+    def test_resume_after_unbound_deferreds(self):
+        """
+        A request resumes in its own context after a thread and a deferred fired from the base
+        context, as when a handler waits on a store call and then sends an RPC.
+        """
+        sent = []
+
+        @defer.inlineCallbacks
+        def handle(user_id, delay):
+            self.request.user_id = user_id
+            yield threads.deferToThread(lambda: None)
+            yield task.deferLater(reactor, delay, lambda: None)
+            sent.append((user_id, self.request.get('user_id', 'ANONYMOUS')))
+
+        d1 = self.request.call_in_context(RequestContext(), handle, 'alice', 0.02)
+        d2 = self.request.call_in_context(RequestContext(), handle, 'bob', 0.0)
+        yield defer.DeferredList([d1, d2], fireOnOneErrback=True)
+
+        self.assertEqual(sorted(sent), [('alice', 'alice'), ('bob', 'bob')])
+
+    def test_base_context_callbacks(self):
+        seen = []
+        d = defer.Deferred()
+        d.addCallback(lambda _: seen.append(self.request.get('user_id')))
+
+        context = RequestContext()
+        context.user_id = 'alice'
+        self.request.call_in_context(context, d.callback, None)
+
+        # A callback added outside of any request runs in whatever context fires it
+        self.assertEqual(seen, ['alice'])